@@ -1,6 +1,8 @@
 """
 Расширенная админ-панель с фильтрами, поиском и аналитикой
 """
+import html
+import time
 from datetime import datetime, timedelta
 from typing import Optional, List
 from aiogram import Router, F
@@ -11,7 +13,12 @@ from aiogram.fsm.state import State, StatesGroup
 from loguru import logger
 
 from config import ADMIN_IDS
-from database import DatabaseManager, async_session_maker, Application
+from database import DatabaseManager, async_session_maker, read_session, admin_roles, Application
+from middleware import rate_limiter
+from metrics import metrics
+from codes_import import import_codes_csv
+from keyboards_enhanced import get_pagination_row
+from pagination import parse_page_callback
 
 router = Router()
 
@@ -38,24 +45,29 @@ class DepositAmountsStates(StatesGroup):
 
 async def check_admin_rights(user_id: int) -> bool:
     """
-    Проверка прав администратора через базу данных
+    Проверка прав администратора по карте ролей в памяти
     Возвращает True, если пользователь является администратором
     """
     # Сначала проверяем в config.ADMIN_IDS (обратная совместимость)
     if user_id in ADMIN_IDS:
         return True
     
-    # Проверяем в базе данных
-    async with async_session_maker() as session:
-        return await DatabaseManager.is_admin(session, user_id)
+    if not admin_roles.loaded:
+        async with async_session_maker() as session:
+            await DatabaseManager.load_admin_roles(session)
+    
+    return admin_roles.get(user_id) in ["admin", "superadmin"]
 
 async def check_superadmin_rights(user_id: int) -> bool:
     """
-    Проверка прав суперадминистратора через базу данных
+    Проверка прав суперадминистратора по карте ролей в памяти
     Возвращает True, если пользователь является суперадминистратором
     """
-    async with async_session_maker() as session:
-        return await DatabaseManager.is_superadmin(session, user_id)
+    if not admin_roles.loaded:
+        async with async_session_maker() as session:
+            await DatabaseManager.load_admin_roles(session)
+    
+    return admin_roles.get(user_id) == "superadmin"
 
 def get_admin_panel_keyboard() -> InlineKeyboardMarkup:
     """Главная админ-панель"""
@@ -198,7 +210,7 @@ async def cmd_admin_panel(message: Message):
         await message.answer("❌ У вас нет прав администратора")
         return
     
-    async with async_session_maker() as session:
+    async with read_session() as session:
         # Быстрая статистика
         stats = await DatabaseManager.get_stats(session, days=1)
         
@@ -223,6 +235,40 @@ async def cmd_admin_panel(message: Message):
     
     await message.answer(text, reply_markup=get_admin_panel_keyboard(), parse_mode="HTML")
 
+@router.message(Command("perf"))
+async def cmd_perf(message: Message):
+    """Производительность обработчиков с запуска: перцентили времени, ошибки, запросы"""
+    if not await check_admin_rights(message.from_user.id):
+        await message.answer("❌ У вас нет прав администратора")
+        return
+    
+    rows = metrics.summary()
+    if not rows:
+        await message.answer("⏱️ Пока нет обработанных апдейтов")
+        return
+    
+    total = sum(row["count"] for row in rows)
+    errors = sum(row["errors"] for row in rows)
+    started = datetime.fromtimestamp(metrics.started_at).strftime('%d.%m %H:%M')
+    text = (
+        "⏱️ <b>ПРОИЗВОДИТЕЛЬНОСТЬ</b>\n"
+        f"С {started}: апдейтов {total}, ошибок {errors}\n"
+        "<i>p50 / p95 / p99 мс | запросов БД и API на апдейт</i>\n\n"
+    )
+    for row in rows[:20]:
+        text += (
+            f"• <code>{html.escape(row['handler'])}</code> × {row['count']}\n"
+            f"   {row['p50_ms']:.0f} / {row['p95_ms']:.0f} / {row['p99_ms']:.0f} мс"
+            f" | БД {row['db_per_update']:.1f} | API {row['api_per_update']:.1f}"
+        )
+        if row["errors"]:
+            text += f" | ❌ {row['errors']}"
+        text += "\n"
+    if len(rows) > 20:
+        text += f"\n… и еще {len(rows) - 20} обработчиков (полностью - /metrics)"
+    
+    await message.answer(text, parse_mode="HTML")
+
 @router.callback_query(F.data == "admin_panel")
 async def show_admin_panel(callback: CallbackQuery):
     """Показать админ-панель"""
@@ -235,22 +281,20 @@ async def show_admin_panel(callback: CallbackQuery):
     await cmd_admin_panel(callback.message)
 
 @router.callback_query(F.data == "admin_pending")
+@router.callback_query(F.data.startswith("pending:"))
 async def show_pending_applications(callback: CallbackQuery):
-    """Показать заявки в ожидании"""
+    """Показать заявки в ожидании (по 10 на странице, старые сверху)"""
     if not await check_admin_rights(callback.from_user.id):
         await callback.answer("❌ Нет прав", show_alert=True)
         return
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        from sqlalchemy import select
-        query = select(Application).where(
-            Application.status == "pending"
-        ).order_by(Application.created_at)
-        
-        result = await session.execute(query)
-        applications = result.scalars().all()
+    direction, cursor = parse_page_callback(callback.data)
+    
+    async with read_session(callback.from_user.id) as session:
+        page = await DatabaseManager.get_pending_applications_page(session, cursor=cursor, direction=direction)
+        applications = page.items
         
         if not applications:
             await callback.message.edit_text(
@@ -261,10 +305,11 @@ async def show_pending_applications(callback: CallbackQuery):
             )
             return
         
-        text = f"⏳ <b>Заявки в ожидании ({len(applications)}):</b>\n\n"
+        total = await DatabaseManager.count_pending_applications(session)
+        text = f"⏳ <b>Заявки в ожидании ({total}):</b>\n\n"
         
         buttons = []
-        for app in applications[:10]:  # Показываем первые 10
+        for app in applications:
             waiting_time = datetime.utcnow() - app.created_at
             hours = int(waiting_time.total_seconds() // 3600)
             minutes = int((waiting_time.total_seconds() % 3600) // 60)
@@ -275,8 +320,9 @@ async def show_pending_applications(callback: CallbackQuery):
                 callback_data=f"admin_view_{app.id}"
             )])
         
-        if len(applications) > 10:
-            text += f"<i>Показаны первые 10 из {len(applications)}</i>\n\n"
+        pagination_row = get_pagination_row("pending", page)
+        if pagination_row:
+            buttons.append(pagination_row)
         
         buttons.append([
             InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_pending"),
@@ -298,8 +344,12 @@ async def view_application_details(callback: CallbackQuery):
     
     app_id = int(callback.data.split("_")[2])
     
-    async with async_session_maker() as session:
+    async with read_session(callback.from_user.id) as session:
         application = await DatabaseManager.get_application_by_id(session, app_id)
+        if not application:
+            # Заявка из свежего уведомления могла еще не дойти до реплики
+            async with read_session(primary=True) as primary_session:
+                application = await DatabaseManager.get_application_by_id(primary_session, app_id)
         
         if not application:
             await callback.answer("❌ Заявка не найдена", show_alert=True)
@@ -334,11 +384,12 @@ async def show_detailed_stats(callback: CallbackQuery):
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        # Статистика за разные периоды
-        stats_today = await DatabaseManager.get_stats(session, days=1)
-        stats_week = await DatabaseManager.get_stats(session, days=7)
-        stats_month = await DatabaseManager.get_stats(session, days=30)
+    async with read_session(callback.from_user.id) as session:
+        # Все периоды одним запросом
+        stats = await DatabaseManager.get_stats_windows(session)
+        stats_today = stats['today']
+        stats_week = stats['week']
+        stats_month = stats['month']
         
         text = (
             "📊 <b>ДЕТАЛЬНАЯ СТАТИСТИКА</b>\n\n"
@@ -362,24 +413,15 @@ async def show_detailed_stats(callback: CallbackQuery):
             "<b>🎟️ Остаток кодов:</b>\n"
         )
         
-        for amount, count in stats_today['codes_remaining'].items():
+        for amount, count in stats['codes_remaining'].items():
             emoji = "🔴" if count < 3 else "🟡" if count < 5 else "🟢"
             text += f"{emoji} ${amount} USD — <b>{count}</b> шт.\n"
         
         # Средняя скорость обработки
-        from sqlalchemy import select, func
-        query = select(func.avg(
-            func.julianday(Application.updated_at) - func.julianday(Application.created_at)
-        )).where(
-            Application.status.in_(["approved", "rejected"]),
-            Application.updated_at.isnot(None),
-            Application.created_at >= datetime.utcnow() - timedelta(days=7)
-        )
-        result = await session.execute(query)
-        avg_time_days = result.scalar()
+        avg_time_minutes = stats['avg_processing_minutes']
         
-        if avg_time_days:
-            avg_time_minutes = int(avg_time_days * 24 * 60)
+        if avg_time_minutes:
+            avg_time_minutes = int(avg_time_minutes)
             hours = avg_time_minutes // 60
             minutes = avg_time_minutes % 60
             text += f"\n⏱️ <b>Среднее время обработки:</b> {hours}ч {minutes}мин\n"
@@ -410,17 +452,18 @@ async def apply_filter(callback: CallbackQuery):
     await show_pending_applications(callback)
 
 @router.callback_query(F.data == "admin_all")
+@router.callback_query(F.data.startswith("allapps:"))
 async def show_all_applications(callback: CallbackQuery):
-    """Показать все заявки"""
+    """Показать все заявки (по 15 на странице, новые сверху)"""
     if not await check_admin_rights(callback.from_user.id):
         await callback.answer("❌ Нет прав", show_alert=True)
         return
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        from sqlalchemy import select
-        
+    direction, cursor = parse_page_callback(callback.data)
+    
+    async with read_session(callback.from_user.id) as session:
         # Получаем фильтр для админа
         filter_type = admin_filters.get(callback.from_user.id, "today")
         
@@ -434,12 +477,10 @@ async def show_all_applications(callback: CallbackQuery):
         else:
             date_filter = datetime(2000, 1, 1)  # Все
         
-        query = select(Application).where(
-            Application.created_at >= date_filter
-        ).order_by(Application.created_at.desc()).limit(20)
-        
-        result = await session.execute(query)
-        applications = result.scalars().all()
+        page = await DatabaseManager.get_applications_page(
+            session, date_filter, cursor=cursor, direction=direction
+        )
+        applications = page.items
         
         if not applications:
             await callback.message.edit_text(
@@ -459,7 +500,7 @@ async def show_all_applications(callback: CallbackQuery):
         
         text = f"📋 <b>Все заявки за {filter_names.get(filter_type, 'период')}:</b>\n\n"
         
-        for app in applications[:15]:
+        for app in applications:
             status_emoji = {
                 "pending": "⏳",
                 "approved": "✅",
@@ -469,7 +510,12 @@ async def show_all_applications(callback: CallbackQuery):
             
             text += f"{status_emoji} #{app.id} | ${app.amount} | {app.user_name} | {app.created_at.strftime('%d.%m %H:%M')}\n"
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        buttons = []
+        pagination_row = get_pagination_row("allapps", page)
+        if pagination_row:
+            buttons.append(pagination_row)
+        
+        buttons += [
             [
                 InlineKeyboardButton(text="🔍 Фильтры", callback_data="admin_filters"),
                 InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_all")
@@ -477,7 +523,8 @@ async def show_all_applications(callback: CallbackQuery):
             [
                 InlineKeyboardButton(text="◀️ Назад", callback_data="admin_panel")
             ]
-        ])
+        ]
+        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
         
         await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
 
@@ -519,12 +566,9 @@ async def export_to_google_sheets(callback: CallbackQuery):
     try:
         from google_sheets_integration import export_applications_to_sheets
         
-        async with async_session_maker() as session:
-            # Получаем все заявки
-            from sqlalchemy import select
-            query = select(Application).order_by(Application.created_at.desc())
-            result = await session.execute(query)
-            applications = result.scalars().all()
+        async with read_session(callback.from_user.id) as session:
+            # Все заявки с кодами активации одним запросом, без ORM-объектов
+            applications = await DatabaseManager.get_application_rows(session)
             
             # Экспортируем
             sheet_url = await export_applications_to_sheets(applications)
@@ -587,7 +631,7 @@ async def show_settings(callback: CallbackQuery):
     
     from config import MAX_APPLICATIONS_PER_DAY, RATE_LIMIT_PER_MINUTE, MAX_FILE_SIZE
     
-    async with async_session_maker() as session:
+    async with read_session(callback.from_user.id) as session:
         # Проверяем, является ли пользователь суперадмином
         is_superadmin = await DatabaseManager.is_superadmin(session, callback.from_user.id)
         
@@ -623,6 +667,36 @@ async def show_settings(callback: CallbackQuery):
     if not admins_list:
         text += "• Нет администраторов в базе данных\n"
     
+    # Пул соединений с базой (для подбора DB_POOL_SIZE)
+    pool_stats = DatabaseManager.get_pool_stats()
+    if pool_stats:
+        text += (
+            "\n<b>🗄️ Пул соединений БД:</b>\n"
+            f"• Занято: {pool_stats['checked_out']} из {pool_stats['size']} "
+            f"(+{pool_stats['overflow']}/{pool_stats['max_overflow']} временных)\n"
+            f"• Ожидание: среднее {pool_stats['avg_wait_ms']:.1f} мс, макс. {pool_stats['max_wait_ms']:.0f} мс\n"
+            f"• Таймаутов: {pool_stats['timeouts']}\n"
+        )
+    
+    limiter_stats = rate_limiter.stats()
+    text += (
+        "\n<b>🚦 Лимитер запросов:</b>\n"
+        f"• Пользователей в памяти: {sum(limiter_stats['users'].values())} "
+        f"(≈{limiter_stats['memory_bytes'] / 2 ** 20:.1f} МБ)\n"
+        f"• Отклонено запросов: {limiter_stats['throttled']} из "
+        f"{limiter_stats['allowed'] + limiter_stats['throttled']}\n"
+    )
+    
+    read_pool_stats = DatabaseManager.get_read_pool_stats()
+    if read_pool_stats:
+        text += (
+            "\n<b>📖 Пул чтения (реплика):</b>\n"
+            f"• Занято: {read_pool_stats['checked_out']} из {read_pool_stats['size']}, "
+            f"выдано {read_pool_stats['checkouts']}\n"
+            f"• Ожидание: среднее {read_pool_stats['avg_wait_ms']:.1f} мс, "
+            f"таймаутов {read_pool_stats['timeouts']}\n"
+        )
+    
     # Кнопки
     buttons = [
         [
@@ -665,7 +739,7 @@ async def refresh_panel(callback: CallbackQuery):
     
     await callback.answer("🔄 Обновлено", show_alert=False)
     
-    async with async_session_maker() as session:
+    async with read_session(callback.from_user.id) as session:
         stats = await DatabaseManager.get_stats(session, days=1)
     
     text = (
@@ -692,11 +766,8 @@ async def show_approved(callback: CallbackQuery):
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        from sqlalchemy import select
-        query = select(Application).where(Application.status == "approved").order_by(Application.updated_at.desc()).limit(10)
-        result = await session.execute(query)
-        applications = result.scalars().all()
+    async with read_session(callback.from_user.id) as session:
+        applications = await DatabaseManager.get_recent_applications_by_status(session, "approved", limit=10)
     
     if not applications:
         text = "✅ <b>Одобренные заявки</b>\n\nНет одобренных заявок"
@@ -732,11 +803,8 @@ async def show_rejected(callback: CallbackQuery):
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        from sqlalchemy import select
-        query = select(Application).where(Application.status == "rejected").order_by(Application.updated_at.desc()).limit(10)
-        result = await session.execute(query)
-        applications = result.scalars().all()
+    async with read_session(callback.from_user.id) as session:
+        applications = await DatabaseManager.get_recent_applications_by_status(session, "rejected", limit=10)
     
     if not applications:
         text = "❌ <b>Отклоненные заявки</b>\n\nНет отклоненных заявок"
@@ -1061,7 +1129,7 @@ async def manage_codes_menu(callback: CallbackQuery):
     """Меню управления кодами активации"""
     user_id = callback.from_user.id
     
-    async with async_session_maker() as session:
+    async with read_session(callback.from_user.id) as session:
         is_superadmin = await DatabaseManager.is_superadmin(session, user_id)
         
         if not is_superadmin:
@@ -1281,7 +1349,7 @@ async def import_codes_csv_start(callback: CallbackQuery, state: FSMContext):
         "XYZ789,25\n"
         "PROMO2024,50</code>\n\n"
         "⚠️ <b>Важно:</b>\n"
-        "• Первая строка - заголовок (пропускается)\n"
+        "• Строка-заголовок (если есть) пропускается\n"
         "• Разделитель: запятая или точка с запятой\n"
         "• Дубликаты будут пропущены\n\n"
         "Отправьте /cancel для отмены"
@@ -1318,44 +1386,34 @@ async def import_codes_csv_process(message: Message, state: FSMContext):
             return
         
         try:
-            # Скачиваем файл
-            import tempfile
-            import csv
-            import os
-            
-            file_info = await message.bot.get_file(message.document.file_id)
+            # Скачиваем файл в память
+            buffer = await message.bot.download(message.document.file_id)
+            data = buffer.getvalue()
             
-            # Создаем временный файл
-            with tempfile.NamedTemporaryFile(mode='w+b', delete=False, suffix='.csv') as tmp_file:
-                tmp_path = tmp_file.name
-                await message.bot.download(file=message.document.file_id, destination=tmp_path)
+            progress_message = await message.answer("⏳ Импорт кодов: 0%")
+            last_edit = 0.0
             
-            # Читаем CSV
-            codes_data = []
-            with open(tmp_path, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                next(reader, None)  # Пропускаем заголовок
-                
-                for row in reader:
-                    if len(row) >= 2:
-                        code_value = row[0].strip()
-                        try:
-                            amount = float(row[1].strip().replace(",", "."))
-                            codes_data.append((code_value, amount))
-                        except ValueError:
-                            logger.warning(f"Пропущена строка с неверной суммой: {row}")
+            async def show_progress(progress: dict):
+                # Редактируем сообщение не чаще раза в секунду
+                nonlocal last_edit
+                now = time.monotonic()
+                if now - last_edit < 1 or progress["processed"] >= progress["lines"]:
+                    return
+                last_edit = now
+                percent = progress["processed"] * 100 // max(progress["lines"], 1)
+                await progress_message.edit_text(
+                    f"⏳ Импорт кодов: {percent}%\n"
+                    f"• Добавлено: {progress['added']}\n"
+                    f"• Дубликаты: {progress['skipped']}"
+                )
             
-            # Удаляем временный файл
-            os.unlink(tmp_path)
+            result = await import_codes_csv(session, data, on_progress=show_progress)
             
-            if not codes_data:
-                await message.answer("❌ В файле не найдено корректных данных.")
+            if not result['total']:
+                await progress_message.edit_text("❌ В файле не найдено корректных данных.")
                 await state.clear()
                 return
             
-            # Импортируем коды
-            result = await DatabaseManager.import_codes_from_list(session, codes_data)
-            
             # Логируем действие
             await DatabaseManager.log_admin_action(
                 session,
@@ -1371,14 +1429,15 @@ async def import_codes_csv_process(message: Message, state: FSMContext):
                 f"• Пропущено (дубликаты): {result['skipped']}\n"
             )
             
-            if result['errors']:
+            if result['invalid']:
+                text += f"• Некорректных строк: {result['invalid']}\n"
                 text += f"\n⚠️ <b>Ошибки:</b>\n"
                 for error in result['errors'][:5]:
                     text += f"• {error}\n"
-                if len(result['errors']) > 5:
-                    text += f"• ... и еще {len(result['errors']) - 5}\n"
+                if result['invalid'] > 5:
+                    text += f"• ... и еще {result['invalid'] - 5}\n"
             
-            await message.answer(text, parse_mode="HTML")
+            await progress_message.edit_text(text, parse_mode="HTML")
             await state.clear()
             
         except Exception as e:
@@ -1387,11 +1446,13 @@ async def import_codes_csv_process(message: Message, state: FSMContext):
             await state.clear()
 
 @router.callback_query(F.data == "codes_view_all")
+@router.callback_query(F.data.startswith("codes:"))
 async def view_all_codes(callback: CallbackQuery):
-    """Просмотр всех кодов"""
+    """Просмотр свободных кодов (по 20 на странице, по возрастанию номинала)"""
     user_id = callback.from_user.id
+    direction, cursor = parse_page_callback(callback.data)
     
-    async with async_session_maker() as session:
+    async with read_session(callback.from_user.id) as session:
         is_superadmin = await DatabaseManager.is_superadmin(session, user_id)
         
         if not is_superadmin:
@@ -1400,48 +1461,40 @@ async def view_all_codes(callback: CallbackQuery):
         
         await callback.answer()
         
-        codes = await DatabaseManager.get_all_codes(session)
+        page = await DatabaseManager.get_unused_codes_page(session, cursor=cursor, direction=direction)
+        # Остатки по номиналам - только на первой странице
+        remaining = await DatabaseManager.get_codes_remaining(session) if cursor is None else None
     
-    if not codes:
-        text = "📋 <b>Коды активации</b>\n\n⚠️ В системе нет кодов активации."
+    if not page.items:
+        text = "📋 <b>Коды активации</b>\n\n⚠️ В системе нет свободных кодов активации."
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_manage_codes")]
         ])
         await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
         return
     
-    # Группируем по суммам
-    codes_by_amount = {}
-    for code in codes:
-        amount = float(code.amount)
-        if amount not in codes_by_amount:
-            codes_by_amount[amount] = []
-        codes_by_amount[amount].append(code)
-    
-    text = f"📋 <b>Все коды активации ({len(codes)} шт.)</b>\n\n"
+    text = "📋 <b>Свободные коды активации</b>\n\n"
     
-    for amount in sorted(codes_by_amount.keys()):
-        codes_list = codes_by_amount[amount]
-        unused = [c for c in codes_list if not c.is_used]
-        used = [c for c in codes_list if c.is_used]
-        
-        text += f"💰 <b>${int(amount)} USD</b> ({len(unused)} доступно / {len(used)} использовано)\n"
-        
-        # Показываем первые 5 доступных кодов
-        for code in unused[:5]:
-            text += f"  🟢 <code>{code.code_value}</code> (ID: {code.id})\n"
-        
-        if len(unused) > 5:
-            text += f"  ... и еще {len(unused) - 5}\n"
-        
+    if remaining:
+        for amount, count in remaining.items():
+            text += f"💰 ${int(amount)} USD — {count} доступно\n"
         text += "\n"
     
-    if len(text) > 4000:
-        text = text[:4000] + "\n\n... (список слишком длинный)"
+    # Заголовок номинала перед первым кодом каждой группы на странице
+    current_amount = None
+    for code in page.items:
+        if code.amount != current_amount:
+            current_amount = code.amount
+            text += f"\n💰 <b>${int(current_amount)} USD</b>\n"
+        text += f"  🟢 <code>{code.code_value}</code> (ID: {code.id})\n"
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_manage_codes")]
-    ])
+    buttons = []
+    pagination_row = get_pagination_row("codes", page)
+    if pagination_row:
+        buttons.append(pagination_row)
+    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="admin_manage_codes")])
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
 
@@ -2,7 +2,6 @@
 Дополнительные функции для админ-панели (часть 2)
 Управление номиналами депозита, логи безопасности, настройка языков
 """
-import json
 from datetime import datetime
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
@@ -11,8 +10,10 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from loguru import logger
 
-from database import DatabaseManager, async_session_maker
+from database import DatabaseManager, async_session_maker, read_session, bot_settings
 from admin_enhanced import DepositAmountsStates, check_superadmin_rights
+from keyboards_enhanced import get_pagination_row
+from pagination import parse_page_callback
 
 router = Router()
 
@@ -143,8 +144,9 @@ async def edit_amounts_process(message: Message, state: FSMContext):
 # ==================== ЛОГИ БЕЗОПАСНОСТИ ====================
 
 @router.callback_query(F.data == "admin_security_logs")
+@router.callback_query(F.data.startswith("seclogs:"))
 async def security_logs_menu(callback: CallbackQuery):
-    """Просмотр логов безопасности"""
+    """Просмотр логов безопасности (по 10 на странице)"""
     user_id = callback.from_user.id
     
     if not await check_superadmin_rights(user_id):
@@ -153,9 +155,11 @@ async def security_logs_menu(callback: CallbackQuery):
     
     await callback.answer()
     
-    async with async_session_maker() as session:
-        # Получаем последние логи
-        logs = await DatabaseManager.get_admin_logs(session, limit=20, days=7)
+    direction, cursor = parse_page_callback(callback.data)
+    
+    async with read_session(callback.from_user.id) as session:
+        page = await DatabaseManager.get_admin_logs_page(session, days=7, cursor=cursor, direction=direction)
+    logs = page.items
     
     if not logs:
         text = "🔐 <b>Логи безопасности</b>\n\n⚠️ Нет записей за последние 7 дней."
@@ -165,7 +169,7 @@ async def security_logs_menu(callback: CallbackQuery):
         await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
         return
     
-    text = f"🔐 <b>Логи безопасности</b>\n\n📊 Последние {len(logs)} действий (за 7 дней):\n\n"
+    text = "🔐 <b>Логи безопасности</b>\n\n📊 Действия за 7 дней, новые сверху:\n\n"
     
     action_names = {
         "add_admin": "➕ Добавлен админ",
@@ -193,16 +197,19 @@ async def security_logs_menu(callback: CallbackQuery):
         
         text += "\n\n"
     
-    if len(text) > 4000:
-        text = text[:4000] + "\n\n... (список обрезан)"
+    buttons = []
+    pagination_row = get_pagination_row("seclogs", page)
+    if pagination_row:
+        buttons.append(pagination_row)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    buttons += [
         [
             InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_security_logs"),
             InlineKeyboardButton(text="📅 За месяц", callback_data="security_logs_month")
         ],
         [InlineKeyboardButton(text="◀️ Назад к настройкам", callback_data="admin_settings")]
-    ])
+    ]
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
 
@@ -217,7 +224,7 @@ async def security_logs_month(callback: CallbackQuery):
     
     await callback.answer()
     
-    async with async_session_maker() as session:
+    async with read_session(callback.from_user.id) as session:
         logs = await DatabaseManager.get_admin_logs(session, limit=50, days=30)
     
     if not logs:
@@ -273,11 +280,10 @@ async def payment_settings(callback: CallbackQuery):
     
     await callback.answer()
     
-    async with async_session_maker() as session:
-        # Получаем токен провайдера
-        provider_token = await DatabaseManager.get_setting(session, "payment_provider_token")
-        currency = await DatabaseManager.get_setting(session, "payment_currency") or "USD"
-        commission = await DatabaseManager.get_setting(session, "payment_commission") or "0"
+    # Действующие настройки (из админ-панели или .env)
+    provider_token = bot_settings.get("payment_provider_token")
+    currency = bot_settings.get("payment_currency")
+    commission = bot_settings.get("payment_commission")
     
     # Проверяем, настроена ли система
     token_status = "✅ Настроен" if provider_token else "❌ Не настроен"
@@ -600,17 +606,8 @@ async def manage_languages(callback: CallbackQuery):
     
     from localization import LANGUAGES
     
-    async with async_session_maker() as session:
-        # Получаем настройки активных языков
-        enabled_langs_json = await DatabaseManager.get_setting(session, "enabled_languages")
-        
-        if enabled_langs_json:
-            try:
-                enabled_langs = json.loads(enabled_langs_json)
-            except:
-                enabled_langs = list(LANGUAGES.keys())
-        else:
-            enabled_langs = list(LANGUAGES.keys())
+    # Настройки активных языков
+    enabled_langs = bot_settings.get("enabled_languages")
     
     text = (
         "🌐 <b>Настройка языков</b>\n\n"
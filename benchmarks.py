@@ -0,0 +1,1033 @@
+"""
+Нагрузочные тесты и бенчмарки базы данных
+По умолчанию работают на временной SQLite базе, рабочая база не затрагивается
+"""
+import argparse
+import asyncio
+import html
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, insert, update
+from sqlalchemy.orm import joinedload
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+
+import database
+from database import (
+    Base, Application, ActivationCode, Transaction, AdminLog, ProcessedEvent, DatabaseManager,
+    SQLiteWriter, SQLiteWriteLock, AuditWriter, UNIT_OF_WORK_KEY, create_database_engine,
+    create_sqlite_writer_engine
+)
+
+
+def temp_sqlite_url() -> str:
+    """URL временной SQLite базы"""
+    path = os.path.join(tempfile.mkdtemp(prefix="bot_bench_"), "bench.db")
+    return f"sqlite+aiosqlite:///{path}"
+
+
+async def make_engine(url: str):
+    """Движок и фабрика сессий для бенчмарка (схема создается с нуля)"""
+    connect_args = {"timeout": 30} if url.startswith("sqlite") else {}
+    engine = create_async_engine(url, echo=False, connect_args=connect_args)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    return engine, async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# ==================== ВЫДАЧА КОДОВ ====================
+
+async def bench_claim_codes(url: str, amounts: list, codes: int, claims: int) -> bool:
+    """
+    Конкурентная выдача кодов: на каждый номинал запускается `claims`
+    одновременных claim_activation_code при `codes` кодах в базе.
+    Проверяет, что каждый код выдан ровно один раз.
+    """
+    engine, session_maker = await make_engine(url)
+
+    async with session_maker() as session:
+        session.add_all([
+            ActivationCode(code_value=f"BENCH-{amount}-{i:06d}", amount=amount)
+            for amount in amounts
+            for i in range(codes)
+        ])
+        await session.commit()
+
+    async def claim(amount):
+        async with session_maker() as session:
+            code = await DatabaseManager.claim_activation_code(session, amount)
+            return (amount, code.id) if code else None
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[
+        claim(amount) for amount in amounts for _ in range(claims)
+    ])
+    elapsed = time.perf_counter() - started
+
+    issued = [r for r in results if r]
+    duplicates = [code_id for code_id, n in Counter(code_id for _, code_id in issued).items() if n > 1]
+    per_amount = Counter(amount for amount, _ in issued)
+
+    async with session_maker() as session:
+        used_in_db = (await session.execute(
+            select(func.count(ActivationCode.id)).where(ActivationCode.is_used == True)
+        )).scalar()
+
+    await engine.dispose()
+
+    expected = min(codes, claims)
+    ok = (
+        not duplicates
+        and all(per_amount[amount] == expected for amount in amounts)
+        and used_in_db == len(issued)
+    )
+
+    print(f"📊 Выдача кодов ({url.split(':')[0]})")
+    print(f"   Номиналы: {amounts}, кодов на номинал: {codes}, запросов на номинал: {claims}")
+    print(f"   Выдано: {len(issued)} (ожидалось {expected * len(amounts)}), помечено в БД: {used_in_db}")
+    print(f"   Дубликаты: {len(duplicates)}")
+    print(f"   Время: {elapsed:.2f} с, {len(results) / elapsed:.0f} claims/s")
+    print("✅ Каждый код выдан ровно один раз" if ok else "❌ Нарушена уникальность выдачи")
+    return ok
+
+
+# ==================== ИНДЕКСЫ (EXPLAIN) ====================
+
+# Горячие запросы бота в виде SQL с литералами (частичный индекс codes
+# применим только при литеральном is_used, как в запросах SQLAlchemy)
+HOT_QUERIES = {
+    "Фильтр заявок за неделю": (
+        "SELECT id FROM applications WHERE created_at >= '{week_ago}' "
+        "ORDER BY created_at DESC LIMIT 20"
+    ),
+    "Очередь ожидающих": (
+        "SELECT id FROM applications WHERE status = 'pending' "
+        "ORDER BY created_at LIMIT 10"
+    ),
+    "Заявки пользователя": (
+        "SELECT id FROM applications WHERE user_id = {user_id} "
+        "ORDER BY created_at DESC"
+    ),
+    "История операций заявки": (
+        "SELECT id FROM transactions WHERE application_id = {application_id}"
+    ),
+    "Свободный код номинала": (
+        "SELECT id FROM codes WHERE amount = 50 AND is_used = {false} "
+        "ORDER BY id LIMIT 1"
+    ),
+}
+
+
+async def seed_history(engine, rows: int, batch: int = 20000) -> None:
+    """Заявки за год, по операции на заявку и коды (почти все выданы)"""
+    now = datetime.utcnow()
+    users = max(rows // 10, 1)
+    statuses = ["approved"] * 80 + ["rejected"] * 15 + ["cancelled"] * 4 + ["pending"]
+
+    async with engine.begin() as conn:
+        for start in range(0, rows, batch):
+            size = min(batch, rows - start)
+            applications = []
+            for i in range(start, start + size):
+                created = now - timedelta(seconds=random.randint(0, 365 * 24 * 3600))
+                applications.append({
+                    "id": i + 1,
+                    "user_id": random.randint(1, users),
+                    "login": f"user{i}",
+                    "amount": random.choice([10, 25, 50, 100]),
+                    "file_id": "seed",
+                    "status": random.choice(statuses),
+                    "created_at": created,
+                    "updated_at": created + timedelta(minutes=random.randint(1, 600))
+                })
+            await conn.execute(insert(Application), applications)
+            await conn.execute(insert(Transaction), [
+                {"application_id": app["id"], "action": "created", "timestamp": app["created_at"]}
+                for app in applications
+            ])
+
+        code_rows = max(rows // 2, 1)
+        for start in range(0, code_rows, batch):
+            size = min(batch, code_rows - start)
+            await conn.execute(insert(ActivationCode), [
+                {"code_value": f"SEED-{i:08d}", "amount": random.choice([10, 25, 50, 100]),
+                 "is_used": i < code_rows * 0.99}
+                for i in range(start, start + size)
+            ])
+
+
+async def explain_hot_queries(engine, params: dict, repeats: int = 20) -> dict:
+    """План и среднее время каждого горячего запроса"""
+    dialect = engine.dialect.name
+    explain = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    results = {}
+
+    async with engine.connect() as conn:
+        for name, template in HOT_QUERIES.items():
+            sql = template.format(**params, false="0" if dialect == "sqlite" else "false")
+            plan = (await conn.exec_driver_sql(explain + sql)).all()
+            # SQLite: (id, parent, notused, detail), PostgreSQL: (строка плана,)
+            plan_lines = [row[-1] for row in plan]
+
+            started = time.perf_counter()
+            for _ in range(repeats):
+                (await conn.exec_driver_sql(sql)).all()
+            elapsed_ms = (time.perf_counter() - started) * 1000 / repeats
+
+            results[name] = (plan_lines, elapsed_ms)
+
+    return results
+
+
+def print_explain(title: str, results: dict) -> None:
+    print(f"\n{title}")
+    for name, (plan_lines, elapsed_ms) in results.items():
+        print(f"   {name}: {elapsed_ms:.2f} мс")
+        for line in plan_lines:
+            print(f"      {line}")
+
+
+async def bench_explain_indexes(url: str, rows: int) -> bool:
+    """
+    EXPLAIN горячих запросов на базе с `rows` заявками до и после миграций.
+    Проверяет, что после миграций ни один запрос не сканирует таблицу целиком.
+    """
+    from migrations import run_migrations
+
+    engine, _ = await make_engine(url)
+
+    started = time.perf_counter()
+    await seed_history(engine, rows)
+    print(f"📦 Засеяно {rows} заявок, {rows} операций, {max(rows // 2, 1)} кодов за {time.perf_counter() - started:.1f} с")
+
+    params = {
+        "week_ago": (datetime.utcnow() - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S"),
+        "user_id": 1,
+        "application_id": rows // 2 or 1,
+    }
+
+    before = await explain_hot_queries(engine, params)
+    print_explain("📊 До миграций", before)
+
+    started = time.perf_counter()
+    await run_migrations(engine)
+    print(f"\n🔧 Миграции применены за {time.perf_counter() - started:.1f} с")
+
+    after = await explain_hot_queries(engine, params)
+    print_explain("📊 После миграций", after)
+
+    await engine.dispose()
+
+    # Полный проход: "SCAN <table>" без индекса (SQLite) или "Seq Scan" (PostgreSQL)
+    def full_scan(plan_lines):
+        return any(
+            "Seq Scan" in line or (line.startswith("SCAN ") and "INDEX" not in line)
+            for line in plan_lines
+        )
+
+    scans = [name for name, (plan_lines, _) in after.items() if full_scan(plan_lines)]
+
+    print("\n   Запрос: до -> после")
+    for name in HOT_QUERIES:
+        print(f"   {name}: {before[name][1]:.2f} мс -> {after[name][1]:.2f} мс")
+
+    print("✅ Все горячие запросы используют индексы" if not scans else f"❌ Полный проход таблицы: {scans}")
+    return not scans
+
+
+# ==================== ПОСТРАНИЧНЫЕ СПИСКИ ====================
+
+async def bench_pagination(url: str, rows: int, page_size: int = 15, repeats: int = 20) -> bool:
+    """
+    Время страницы списка всех заявок на разной глубине: OFFSET против курсора.
+    Курсор страницы берется из записи на этой глубине (в замер не входит).
+    """
+    from migrations import run_migrations
+    from pagination import encode_cursor
+
+    engine, session_maker = await make_engine(url)
+    await seed_history(engine, rows)
+    await run_migrations(engine)
+    print(f"📦 Засеяно {rows} заявок, страница - {page_size} записей")
+
+    since = datetime(2000, 1, 1)
+    ordered = select(Application).where(Application.created_at >= since).order_by(
+        Application.created_at.desc(), Application.id.desc()
+    )
+    depths = [d for d in (0, 100, 1000, 10000, 50000) if d * page_size < rows]
+    results = {}
+
+    async with session_maker() as session:
+        for depth in depths:
+            offset = depth * page_size
+            cursor = None
+            if offset:
+                previous = (await session.execute(ordered.offset(offset - 1).limit(1))).scalar_one()
+                cursor = encode_cursor(previous.created_at, previous.id)
+
+            started = time.perf_counter()
+            for _ in range(repeats):
+                (await session.execute(ordered.offset(offset).limit(page_size))).scalars().all()
+            offset_ms = (time.perf_counter() - started) * 1000 / repeats
+
+            started = time.perf_counter()
+            for _ in range(repeats):
+                page = await DatabaseManager.get_applications_page(session, since, cursor=cursor, limit=page_size)
+            keyset_ms = (time.perf_counter() - started) * 1000 / repeats
+
+            results[depth] = (offset_ms, keyset_ms, len(page.items))
+
+    await engine.dispose()
+
+    print("   Страница: OFFSET -> курсор")
+    for depth, (offset_ms, keyset_ms, count) in results.items():
+        print(f"   №{depth + 1}: {offset_ms:.2f} мс -> {keyset_ms:.2f} мс ({count} записей)")
+
+    first = results[depths[0]][1]
+    deepest = results[depths[-1]][1]
+    ok = deepest <= max(first * 3, first + 1)
+    print("✅ Стоимость страницы не зависит от глубины" if ok else "❌ Глубокие страницы заметно медленнее первой")
+    return ok
+
+
+# ==================== ПРОЕКЦИИ ДЛЯ СПИСКОВ И ЭКСПОРТА ====================
+
+async def measure_load(session_maker, load) -> tuple:
+    """
+    Время загрузки (с) и память: пик во время загрузки и удерживаемый
+    результатом объем (байт, вместе с identity map сессии)
+    """
+    async with session_maker() as session:
+        started = time.perf_counter()
+        rows = await load(session)
+        elapsed = time.perf_counter() - started
+        count = len(rows)
+    del rows
+
+    async with session_maker() as session:
+        tracemalloc.start()
+        rows = await load(session)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del rows
+    return count, elapsed, peak, retained
+
+
+async def bench_projection(url: str, rows: int) -> bool:
+    """
+    Выгрузка всех заявок с кодами активации, как для экспорта в Google Sheets:
+    ORM-объекты с ленивой подгрузкой кода (N+1), ORM-объекты с JOIN и
+    проекция в ApplicationRow одним запросом.
+    """
+    engine, session_maker = await make_engine(url)
+    await seed_history(engine, rows)
+    async with engine.begin() as conn:
+        # Одобренным заявкам - выданные коды (у половины заявок есть код)
+        await conn.execute(
+            update(Application)
+            .where(Application.status == "approved", Application.id <= rows // 2)
+            .values(activation_code_id=Application.id)
+        )
+    print(f"📦 Засеяно {rows} заявок")
+
+    async def orm_lazy(session):
+        def load(sync_session):
+            applications = sync_session.execute(select(Application)).scalars().all()
+            for application in applications:
+                application.activation_code
+            return applications
+        return await session.run_sync(load)
+
+    async def orm_joined(session):
+        result = await session.execute(select(Application).options(joinedload(Application.activation_code)))
+        return result.scalars().all()
+
+    async def projection(session):
+        return await DatabaseManager.get_application_rows(session)
+
+    results = {}
+    for title, load in (
+        ("ORM + ленивый код (N+1)", orm_lazy),
+        ("ORM + JOIN", orm_joined),
+        ("ApplicationRow", projection),
+    ):
+        results[title] = await measure_load(session_maker, load)
+    await engine.dispose()
+
+    print("   Способ: время, пик памяти, память результата")
+    for title, (count, elapsed, peak, retained) in results.items():
+        print(
+            f"   {title}: {elapsed * 1000:.0f} мс, {peak / 2 ** 20:.1f} МБ, "
+            f"{retained / 2 ** 20:.1f} МБ ({count} заявок)"
+        )
+
+    orm = results["ORM + JOIN"]
+    rows_result = results["ApplicationRow"]
+    ok = rows_result[0] == orm[0] and rows_result[3] < orm[3]
+    print(
+        f"✅ Проекция: в {orm[3] / max(rows_result[3], 1):.1f} раза меньше памяти, "
+        f"в {orm[1] / max(rows_result[1], 1e-9):.1f} раза быстрее ORM + JOIN"
+        if ok else "❌ Проекция не экономит память"
+    )
+    return ok
+
+
+# ==================== ЛИМИТЕР ЗАПРОСОВ ====================
+
+class LegacyRateLimiter:
+    """Прежнее состояние RateLimitMiddleware: три словаря без вытеснения"""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.user_last_request = {}
+        self.user_request_count = {}
+        self.user_request_reset = {}
+
+    def hit(self, user_id: int, now: float) -> int:
+        if user_id in self.user_request_reset and now - self.user_request_reset[user_id] > 60:
+            self.user_request_count[user_id] = 0
+            self.user_request_reset[user_id] = now
+        if user_id not in self.user_request_count:
+            self.user_request_count[user_id] = 0
+            self.user_request_reset[user_id] = now
+        if user_id in self.user_last_request and now - self.user_last_request[user_id] < self.min_interval:
+            return 0
+        self.user_last_request[user_id] = now
+        self.user_request_count[user_id] += 1
+        return self.user_request_count[user_id]
+
+
+def run_limiter(make_hit, events: list) -> tuple:
+    """
+    Прогон потока событий на новом лимитере: (отклонено, нс на проверку,
+    удерживаемая память в байтах). Память - отдельным прогоном под tracemalloc
+    """
+    hit = make_hit()
+    started = time.perf_counter()
+    throttled = 0
+    for user_id, now in events:
+        if not hit(user_id, now):
+            throttled += 1
+    elapsed = time.perf_counter() - started
+    del hit
+
+    tracemalloc.start()
+    hit = make_hit()
+    for user_id, now in events:
+        hit(user_id, now)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return throttled, elapsed * 1e9 / len(events), retained
+
+
+def bench_rate_limit(users: int, duration: float) -> bool:
+    """
+    `users` разных пользователей пишут боту за `duration` секунд модельного
+    времени, каждый десятый сразу повторяет сообщение (двойное нажатие).
+    Сравнивает прежние словари и RateLimiter: решения, скорость, память.
+    """
+    from middleware import RateLimiter, EVENT_LIMITS
+
+    step = duration / users
+    events = []
+    for user_id in range(users):
+        now = user_id * step
+        events.append((user_id, now))
+        if user_id % 10 == 0:
+            events.append((user_id, now + 0.1))
+    events.sort(key=lambda event: event[1])
+
+    min_interval = EVENT_LIMITS["message"].min_interval
+    legacy_result = run_limiter(lambda: LegacyRateLimiter(min_interval).hit, events)
+
+    limiters = []
+
+    def make_limiter():
+        limiters[:] = [RateLimiter()]
+        return lambda user_id, now: limiters[0].hit("message", user_id, now)
+
+    limiter_result = run_limiter(make_limiter, events)
+    limiter = limiters[0]
+    stats = limiter.stats()
+
+    print(f"📊 {users} пользователей за {duration:.0f} с, {len(events)} сообщений")
+    for title, (throttled, ns, retained) in (("Словари", legacy_result), ("RateLimiter", limiter_result)):
+        print(f"   {title}: {ns:.0f} нс/проверка, отклонено {throttled}, память {retained / 2 ** 20:.1f} МБ")
+    print(
+        f"   RateLimiter: в памяти {stats['users']['message']} пользователей "
+        f"(оценка {stats['memory_bytes'] / 2 ** 20:.1f} МБ), забыто по простою {stats['expired']}, "
+        f"вытеснено {stats['evicted']}"
+    )
+
+    ok = limiter_result[0] == legacy_result[0] and stats["users"]["message"] <= limiter.max_users
+    print("✅ Те же решения при ограниченной памяти" if ok else "❌ Решения лимитера расходятся")
+    return ok
+
+
+# ==================== ЛОГИРОВАНИЕ ====================
+
+# Прежний формат консоли из main.py
+LEGACY_LOG_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
+)
+
+
+def log_updates(updates: int) -> float:
+    """
+    Логи `updates` апдейтов: две строки middleware (вход и лимитер) и три строки
+    обработчика, как в process_payment_file. Возвращает время в вызовах logger, с
+    """
+    from loguru import logger
+
+    request_logger = logger.patch(lambda record: record.update(name="middleware"))
+    spent = 0.0
+    for n in range(updates):
+        user_id = 100000 + n % 5000
+        started = time.perf_counter()
+        request_logger.info(f"Сообщение от {user_id} (@user{user_id}): отправил файл...")
+        request_logger.info(f"Пользователь {user_id} сделал запрос #{n % 7 + 1}")
+        logger.info(f"Получен файл от пользователя {user_id}")
+        logger.info(f"✅ Заявка #{n} создана в базе данных")
+        logger.info(f"Отправляем уведомления админам о заявке #{n}")
+        spent += time.perf_counter() - started
+    return spent
+
+
+def bench_logging(updates: int) -> bool:
+    """
+    Время event loop в логировании на `updates` апдейтов: прежний синхронный
+    sink loguru против очереди с записью в фоне (текст и JSON с прореживанием)
+    """
+    from loguru import logger
+    from logging_setup import setup_logging
+
+    log_dir = tempfile.mkdtemp(prefix="bot_bench_logs_")
+    results = {}
+
+    with open(os.path.join(log_dir, "legacy.log"), "w", encoding="utf-8") as stream:
+        logger.remove()
+        logger.add(stream, format=LEGACY_LOG_FORMAT, level="INFO")
+        results["legacy"] = (log_updates(updates), 0.0)
+        logger.remove()
+
+    for mode, log_format, sampling in (("text", "text", ""), ("json", "json", "middleware=0.1")):
+        with open(os.path.join(log_dir, f"{mode}.log"), "w", encoding="utf-8") as stream:
+            sink = setup_logging(stream, "INFO", log_format, sampling)
+            spent = log_updates(updates)
+            started = time.perf_counter()
+            sink.stop()
+            results[mode] = (spent, time.perf_counter() - started)
+            logger.remove()
+
+    lines = {}
+    for mode in results:
+        with open(os.path.join(log_dir, f"{mode}.log"), encoding="utf-8") as stream:
+            lines[mode] = sum(1 for _ in stream)
+
+    print(f"📊 Логирование {updates} апдейтов (5 строк на апдейт), логи в {log_dir}")
+    for mode, title in (
+        ("legacy", "Синхронный sink"),
+        ("text", "Очередь, текст"),
+        ("json", "Очередь, JSON, middleware=0.1"),
+    ):
+        spent, drain = results[mode]
+        line = f"   {title}: {spent * 1000:.0f} мс в event loop, {lines[mode]} строк"
+        if drain:
+            line += f", дозапись очереди после прогона {drain * 1000:.0f} мс"
+        print(line)
+
+    expected_json = updates * 3 + updates * 2 // 10
+    ok = lines["text"] == updates * 5 and lines["json"] == expected_json and results["json"][0] < results["legacy"][0]
+    print("✅ Логирование дешевле для event loop, строки не потеряны" if ok else "❌ Потеряны строки или нет выигрыша")
+    return ok
+
+
+# ==================== ПРОПУСКНАЯ СПОСОБНОСТЬ SQLITE ====================
+
+async def submit_application(session: AsyncSession, user_id: int):
+    """Запись новой заявки, как в process_payment_file"""
+    application = await DatabaseManager.create_application(
+        session, user_id, f"User{user_id}", f"login{user_id}", 25, "bench"
+    )
+    await DatabaseManager.log_transaction(session, application.id, "created")
+    await DatabaseManager.acquire_rate_limit(session, user_id)
+    return application
+
+
+async def run_sqlite_load(url: str, profile: bool, workers: int, readers: int, duration: float) -> dict:
+    """
+    `workers` пользователей непрерывно создают заявки, `readers` админов
+    открывают панель статистики. Четные пользователи пишут в сессии апдейта
+    (unit of work: проверка лимита, затем запись, один коммит), нечетные -
+    как отправка чека: без профиля - отдельной транзакцией, с профилем - через
+    очередь писателя. С профилем сессии и очередь делят блокировку записи.
+    """
+    schema_engine, _ = await make_engine(url)
+    await schema_engine.dispose()
+    # Журнал пишется в той же транзакции, что и заявка (буфер бота смотрит в рабочую базу)
+    database.audit_writer = None
+
+    engine = create_database_engine(url, sqlite_profile=profile)
+    session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    writer = None
+    writer_engine = None
+    if profile:
+        write_lock = SQLiteWriteLock()
+        write_lock.install(engine)
+        writer_engine = create_sqlite_writer_engine(url)
+        writer = SQLiteWriter(
+            async_sessionmaker(writer_engine, class_=AsyncSession, expire_on_commit=False),
+            write_lock=write_lock
+        )
+
+    counters = Counter()
+    deadline = time.perf_counter() + duration
+
+    async def user(worker_id: int):
+        n = 0
+        while time.perf_counter() < deadline:
+            user_id = worker_id * 1000000 + n
+            n += 1
+            try:
+                if worker_id % 2 == 0:
+                    async with session_maker() as session:
+                        session.info[UNIT_OF_WORK_KEY] = True
+                        await DatabaseManager.check_user_rate_limit(session, user_id)
+                        await submit_application(session, user_id)
+                        await session.commit()
+                    counters["session_writes"] += 1
+                elif writer:
+                    await writer.submit(lambda session: submit_application(session, user_id))
+                    counters["queued_writes"] += 1
+                else:
+                    async with session_maker() as session:
+                        await submit_application(session, user_id)
+                counters["applications"] += 1
+            except Exception as e:
+                counters["locked" if "locked" in str(e) else "errors"] += 1
+
+    async def admin():
+        while time.perf_counter() < deadline:
+            async with session_maker() as session:
+                await DatabaseManager.get_stats_windows(session)
+            counters["reads"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[user(i) for i in range(workers)], *[admin() for _ in range(readers)])
+    elapsed = time.perf_counter() - started
+
+    if writer:
+        await writer.stop()
+        counters["batches"] = writer.batches
+        await writer_engine.dispose()
+    await engine.dispose()
+
+    return {**counters, "elapsed": elapsed}
+
+
+async def bench_sqlite_throughput(workers: int, readers: int, duration: float) -> bool:
+    """Заявок в секунду на SQLite без профиля и с профилем (WAL + блокировка записи + очередь писателя)"""
+    results = {}
+    for profile in (False, True):
+        results[profile] = await run_sqlite_load(temp_sqlite_url(), profile, workers, readers, duration)
+
+    print(f"📊 Поток заявок SQLite: {workers} пользователей, {readers} читателей, {duration:.0f} с")
+    for profile, title in ((False, "Без профиля"), (True, "WAL + блокировка записи")):
+        r = results[profile]
+        line = (
+            f"   {title}: {r.get('applications', 0) / r['elapsed']:.0f} заявок/с, "
+            f"{r.get('reads', 0) / r['elapsed']:.0f} чтений/с, "
+            f"locked: {r.get('locked', 0)}, ошибки: {r.get('errors', 0)}"
+        )
+        if r.get("batches"):
+            # Групповой коммит только у очереди: сессии апдейтов коммитят каждая свою транзакцию
+            line += f", в очереди заявок на коммит: {r.get('queued_writes', 0) / r['batches']:.1f}"
+        print(line)
+
+    with_profile = results[True]
+    ok = not with_profile.get("locked") and not with_profile.get("errors")
+    print("✅ С профилем ни одной ошибки блокировки" if ok else "❌ Ошибки записи с профилем")
+    return ok
+
+
+# ==================== БУФЕР АУДИТА ====================
+
+def percentile(values: list, p: float) -> float:
+    """Перцентиль p (0..100) отсортированного списка"""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run_approvals(session_maker, application_ids: list, concurrency: int) -> list:
+    """
+    Одобрение заявок как в process_admin_action: статус, запись в историю
+    и в журнал администратора, один коммит на заявку. Возвращает задержки, с
+    """
+    queue = asyncio.Queue()
+    for application_id in application_ids:
+        queue.put_nowait(application_id)
+    latencies = []
+
+    async def admin(admin_id: int):
+        while not queue.empty():
+            application_id = queue.get_nowait()
+            started = time.perf_counter()
+            async with session_maker() as session:
+                session.info[UNIT_OF_WORK_KEY] = True
+                await DatabaseManager.update_application_status(session, application_id, "approved", admin_id=admin_id)
+                await DatabaseManager.log_transaction(session, application_id, "approved", admin_id=admin_id)
+                await DatabaseManager.log_admin_action(
+                    session, admin_id, "approve_application", target_id=application_id
+                )
+                await session.commit()
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*[admin(i + 1) for i in range(concurrency)])
+    return sorted(latencies)
+
+
+async def bench_audit(url: str, approvals: int, concurrency: int) -> bool:
+    """
+    Задержка одобрения заявки с синхронной записью аудита (INSERT в транзакции
+    запроса) и с буфером AuditWriter (многострочный INSERT в фоне).
+    Проверяет, что после остановки буфера в базе все записи аудита.
+    """
+    engine, session_maker = await make_engine(url)
+    now = datetime.utcnow()
+    async with session_maker() as session:
+        await session.execute(insert(Application), [
+            {"user_id": i, "user_name": f"User{i}", "login": f"login{i}", "amount": 25,
+             "file_id": "bench", "status": "pending", "created_at": now, "updated_at": now}
+            for i in range(approvals * 2)
+        ])
+        await session.commit()
+
+    results = {}
+    ids = list(range(1, approvals * 2 + 1))
+    for mode, application_ids in (("sync", ids[:approvals]), ("buffered", ids[approvals:])):
+        writer = AuditWriter(session_maker) if mode == "buffered" else None
+        database.audit_writer = writer
+        started = time.perf_counter()
+        latencies = await run_approvals(session_maker, application_ids, concurrency)
+        elapsed = time.perf_counter() - started
+        if writer:
+            await writer.stop()
+            results["flushes"] = writer.flushes
+        results[mode] = (latencies, elapsed)
+    database.audit_writer = None
+
+    async with session_maker() as session:
+        transactions = (await session.execute(select(func.count(Transaction.id)))).scalar()
+        admin_logs = (await session.execute(select(func.count(AdminLog.id)))).scalar()
+    await engine.dispose()
+
+    print(f"📊 Одобрение {approvals} заявок, {concurrency} админов одновременно")
+    for mode, title in (("sync", "Аудит в транзакции"), ("buffered", "Буфер аудита")):
+        latencies, elapsed = results[mode]
+        print(
+            f"   {title}: p50 {percentile(latencies, 50) * 1000:.2f} мс, "
+            f"p95 {percentile(latencies, 95) * 1000:.2f} мс, "
+            f"p99 {percentile(latencies, 99) * 1000:.2f} мс, {approvals / elapsed:.0f} одобрений/с"
+        )
+    print(f"   Пачек аудита: {results['flushes']}, записей на INSERT: {approvals * 2 / max(results['flushes'], 1):.1f}")
+
+    ok = transactions == approvals * 2 and admin_logs == approvals * 2
+    print("✅ Все записи аудита в базе" if ok else f"❌ Записей аудита: {transactions} + {admin_logs}, ожидалось {approvals * 4}")
+    return ok
+
+
+# ==================== КЛЮЧ ДЕЙСТВИЯ И ОТКАТ ====================
+
+async def bench_decision_rollback(url: str) -> bool:
+    """
+    Ключ решения по заявке записывается в SAVEPOINT (record_processed_event).
+    Проверяет, что RELEASE SAVEPOINT не применяет отложенные изменения сессии:
+    после отката внешней транзакции нет ни записи аудита, ни ключа в базе,
+    а ключ в памяти освобожден; после коммита - запись и ключ на месте.
+    Так же для пачки SQLiteWriter: упавшая операция не оставляет аудита.
+    """
+    schema_engine, _ = await make_engine(url)
+    await schema_engine.dispose()
+    # Движок бота без профиля: блокировка записи не открывает транзакцию до SAVEPOINT
+    engine = create_database_engine(url, sqlite_profile=False)
+    session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    database.audit_writer = AuditWriter(session_maker)
+    writer = SQLiteWriter(session_maker)
+
+    async def decide(application_id: int, commit: bool) -> None:
+        key = f"application:{application_id}:decision"
+        async with session_maker() as session:
+            session.info[UNIT_OF_WORK_KEY] = True
+            DatabaseManager.claim_recent_key(session, key)
+            # Запись аудита до SAVEPOINT и после него
+            await DatabaseManager.log_transaction(session, application_id, "viewed", admin_id=1)
+            await DatabaseManager.record_processed_event(session, key)
+            await DatabaseManager.log_transaction(session, application_id, "approved", admin_id=1)
+            if commit:
+                await session.commit()
+            else:
+                await session.rollback()
+
+    async def job(session: AsyncSession, application_id: int, fail: bool):
+        await DatabaseManager.log_transaction(session, application_id, "created")
+        if fail:
+            raise RuntimeError("операция упала")
+
+    await decide(1, commit=False)
+    await decide(2, commit=True)
+    jobs = [writer.submit(lambda s, i=i: job(s, i, fail=(i == 4))) for i in (3, 4)]
+    await asyncio.gather(*jobs, return_exceptions=True)
+    await writer.stop()
+    await database.audit_writer.stop()
+    database.audit_writer = None
+
+    async with session_maker() as session:
+        audit = set((await session.execute(select(Transaction.application_id))).scalars())
+        events = set((await session.execute(select(ProcessedEvent.event_key))).scalars())
+    await engine.dispose()
+    released = database.recent_keys.claim("application:1:decision")
+    still_claimed = not database.recent_keys.claim("application:2:decision")
+
+    print("📊 Ключ решения в SAVEPOINT и откат внешней транзакции")
+    print(f"   Аудит по заявкам: {sorted(audit)}, ключи в базе: {sorted(events)}")
+    print(f"   Ключ отката освобожден: {released}, ключ коммита занят: {still_claimed}")
+    ok = audit == {2, 3} and events == {"application:2:decision"} and released and still_claimed
+    print("✅ Откат не оставляет аудита и ключей" if ok else "❌ Изменения применены до коммита")
+    return ok
+
+
+# ==================== ШАРДИРОВАНИЕ ====================
+
+def render_page(work_ms: float) -> None:
+    """CPU-работа обработчика: текст и клавиатура страницы из 15 заявок, не меньше work_ms"""
+    deadline = time.perf_counter() + work_ms / 1000
+    while time.perf_counter() < deadline:
+        rows = [f"<b>#{i}</b> {html.escape(f'<login{i}>')} - {i * 25} USD ⏳" for i in range(15)]
+        keyboard = [[{"text": f"#{i}", "callback_data": f"admin_view_{i}"}] for i in range(15)]
+        json.dumps({"text": "\n".join(rows), "reply_markup": {"inline_keyboard": keyboard}}, ensure_ascii=False)
+
+
+def run_shard_worker(work_ms: float, report_dir: str) -> None:
+    """
+    Процесс-воркер для shard-scaling: обработчик сообщений рендерит страницу и
+    проверяет порядок сообщений пользователя; итог - в report_dir/worker-N.json
+    """
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Message
+    from loguru import logger
+    from config import SHARD_INDEX, SHARD_FRONT_PORT, SHARD_TOKEN
+    from sharding import ShardWorker
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    dp = Dispatcher()
+    last_seen = {}
+    report = {"processed": 0, "out_of_order": 0}
+
+    @dp.message()
+    async def handle(message: Message):
+        sequence = int(message.text)
+        if sequence <= last_seen.get(message.from_user.id, -1):
+            report["out_of_order"] += 1
+        last_seen[message.from_user.id] = sequence
+        render_page(work_ms)
+        report["processed"] += 1
+
+    worker = ShardWorker(Bot("42:BENCH"), dp, SHARD_INDEX)
+    asyncio.run(worker.run(SHARD_FRONT_PORT, SHARD_TOKEN))
+    with open(os.path.join(report_dir, f"worker-{SHARD_INDEX}.json"), "w") as stream:
+        json.dump(report, stream)
+
+
+def shard_update(n: int, users: int) -> dict:
+    """n-е сообщение потока: пользователи по кругу, текст - номер сообщения пользователя"""
+    user_id = 100000 + n % users
+    return {
+        "update_id": n + 1,
+        "message": {
+            "message_id": n + 1, "date": 1700000000, "text": str(n // users),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        }
+    }
+
+
+async def bench_shard_scaling(worker_counts: list, updates: int, users: int, work_ms: float) -> bool:
+    """
+    Апдейтов в секунду через фронт и N процессов-воркеров при CPU-работе
+    обработчика work_ms. Проверяет, что все апдейты обработаны и сообщения
+    каждого пользователя - по порядку
+    """
+    from sharding import ShardSupervisor
+
+    results = {}
+    for workers in worker_counts:
+        report_dir = tempfile.mkdtemp(prefix="bot_bench_shards_")
+        command = [
+            sys.executable, os.path.abspath(__file__), "shard-worker",
+            "--work-ms", str(work_ms), "--report-dir", report_dir
+        ]
+        supervisor = ShardSupervisor(command, workers)
+        await supervisor.start()
+        if not await supervisor.wait_connected():
+            await supervisor.stop()
+            print(f"❌ Воркеры не подключились ({workers})")
+            return False
+
+        started = time.perf_counter()
+        for n in range(updates):
+            await supervisor.dispatch(shard_update(n, users))
+        await supervisor.wait_drained()
+        elapsed = time.perf_counter() - started
+        await supervisor.stop()
+
+        reports = []
+        for index in range(workers):
+            with open(os.path.join(report_dir, f"worker-{index}.json")) as stream:
+                reports.append(json.load(stream))
+        results[workers] = (
+            elapsed,
+            sum(report["processed"] for report in reports),
+            sum(report["out_of_order"] for report in reports),
+            [report["processed"] for report in reports]
+        )
+
+    cpus = os.cpu_count() or 1
+    print(f"📊 {updates} апдейтов от {users} пользователей, {work_ms:g} мс CPU на апдейт, ядер: {cpus}")
+    base = updates / results[worker_counts[0]][0]
+    for workers in worker_counts:
+        elapsed, processed, out_of_order, per_worker = results[workers]
+        rate = updates / elapsed
+        print(
+            f"   Воркеров {workers}: {rate:.0f} апдейтов/с (x{rate / base:.2f}), "
+            f"по воркерам {per_worker}, не по порядку {out_of_order}"
+        )
+
+    correct = all(processed == updates and not out_of_order for _, processed, out_of_order, _ in results.values())
+    # Рост ожидается до числа ядер: сравниваем наибольшее число воркеров, на которое их хватает
+    most = max((workers for workers in worker_counts if workers <= cpus), default=worker_counts[0])
+    scaled = most == worker_counts[0] or updates / results[most][0] > base * 1.3
+    if most == worker_counts[0]:
+        print(f"   ⚠️ Ядер: {cpus} - процессы делят их, рост с числом воркеров не проверяется")
+    if not correct:
+        print("❌ Потеряны апдейты или нарушен порядок сообщений пользователя")
+    elif not scaled:
+        print(f"❌ Нет роста с числом воркеров до {most}")
+    elif most == worker_counts[0]:
+        print("✅ Все апдейты обработаны по порядку")
+    else:
+        print(f"✅ Все апдейты обработаны по порядку, пропускная способность растет до {most} воркеров")
+    return correct and scaled
+
+
+def main():
+    """Точка входа"""
+    parser = argparse.ArgumentParser(description="Бенчмарки бота депозитов")
+    parser.add_argument("--url", default=None, help="DATABASE_URL (по умолчанию временная SQLite)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    claim_parser = commands.add_parser("claim-codes", help="Конкурентная выдача кодов активации")
+    claim_parser.add_argument("--amounts", default="10,25,50,100")
+    claim_parser.add_argument("--codes", type=int, default=200, help="Кодов на номинал")
+    claim_parser.add_argument("--claims", type=int, default=300, help="Одновременных запросов на номинал")
+
+    explain_parser = commands.add_parser("explain-indexes", help="EXPLAIN горячих запросов до и после миграций")
+    explain_parser.add_argument("--rows", type=int, default=1000000, help="Заявок в засеянной базе")
+
+    pages_parser = commands.add_parser("pagination", help="Страница списка на глубине: OFFSET против курсора")
+    pages_parser.add_argument("--rows", type=int, default=1000000, help="Заявок в засеянной базе")
+
+    sqlite_parser = commands.add_parser("sqlite-throughput", help="Заявок в секунду на SQLite с профилем и без")
+    sqlite_parser.add_argument("--workers", type=int, default=50, help="Одновременных пользователей")
+    sqlite_parser.add_argument("--readers", type=int, default=4, help="Одновременных читателей")
+    sqlite_parser.add_argument("--duration", type=float, default=10, help="Длительность каждого прогона, с")
+
+    projection_parser = commands.add_parser("projection", help="Выгрузка заявок для экспорта: ORM против проекции")
+    projection_parser.add_argument("--rows", type=int, default=100000, help="Заявок в засеянной базе")
+
+    limiter_parser = commands.add_parser("rate-limit", help="Память и скорость лимитера на миллионе пользователей")
+    limiter_parser.add_argument("--users", type=int, default=1000000, help="Разных пользователей")
+    limiter_parser.add_argument("--duration", type=float, default=3600, help="Модельное время потока, с")
+
+    logging_parser = commands.add_parser("logging", help="Время event loop в логировании: синхронно против очереди")
+    logging_parser.add_argument("--updates", type=int, default=10000, help="Апдейтов в прогоне")
+
+    audit_parser = commands.add_parser("audit", help="Задержка одобрения: аудит в транзакции против буфера")
+    audit_parser.add_argument("--approvals", type=int, default=2000, help="Одобрений в каждом прогоне")
+    audit_parser.add_argument("--concurrency", type=int, default=10, help="Одновременных админов")
+
+    shards_parser = commands.add_parser("shard-scaling", help="Апдейтов в секунду в зависимости от числа воркеров")
+    shards_parser.add_argument("--workers", default="1,2,4", help="Числа воркеров через запятую")
+    shards_parser.add_argument("--updates", type=int, default=5000, help="Апдейтов в каждом прогоне")
+    shards_parser.add_argument("--users", type=int, default=500, help="Разных пользователей")
+    shards_parser.add_argument("--work-ms", type=float, default=2, help="CPU-работа обработчика на апдейт, мс")
+
+    commands.add_parser("decision-rollback", help="Откат после ключа решения: без аудита и с освобожденным ключом")
+
+    # Служебная команда: процесс-воркер, который запускает shard-scaling
+    worker_parser = commands.add_parser("shard-worker")
+    worker_parser.add_argument("--work-ms", type=float, default=2)
+    worker_parser.add_argument("--report-dir", required=True)
+
+    args = parser.parse_args()
+    url = args.url or temp_sqlite_url()
+
+    if args.command == "shard-worker":
+        run_shard_worker(args.work_ms, args.report_dir)
+        return
+
+    if args.command == "shard-scaling":
+        worker_counts = sorted(int(w) for w in args.workers.split(","))
+        ok = asyncio.run(bench_shard_scaling(worker_counts, args.updates, args.users, args.work_ms))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "claim-codes":
+        amounts = [int(a) for a in args.amounts.split(",")]
+        ok = asyncio.run(bench_claim_codes(url, amounts, args.codes, args.claims))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "sqlite-throughput":
+        ok = asyncio.run(bench_sqlite_throughput(args.workers, args.readers, args.duration))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "pagination":
+        ok = asyncio.run(bench_pagination(url, args.rows))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "logging":
+        ok = bench_logging(args.updates)
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "rate-limit":
+        ok = bench_rate_limit(args.users, args.duration)
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "projection":
+        ok = asyncio.run(bench_projection(url, args.rows))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "audit":
+        ok = asyncio.run(bench_audit(url, args.approvals, args.concurrency))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "decision-rollback":
+        ok = asyncio.run(bench_decision_rollback(url))
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "explain-indexes":
+        ok = asyncio.run(bench_explain_indexes(url, args.rows))
+        raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
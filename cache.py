@@ -0,0 +1,103 @@
+"""
+In-process кэш с ограничением размера (LRU) и временем жизни записей (TTL)
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# Маркер отсутствия значения (None тоже может быть закэширован)
+MISSING = object()
+
+
+class TTLCache:
+    """
+    LRU кэш с TTL и счетчиками попаданий/промахов.
+    Не потокобезопасен: рассчитан на один event loop.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Значение по ключу или default (по умолчанию MISSING)"""
+        entry = self._data.get(key)
+
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Сохранить значение, вытесняя самые старые записи при переполнении"""
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """Удалить запись"""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Очистить кэш (счетчики сохраняются)"""
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Счетчики кэша"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+class RecentKeys:
+    """
+    Недавно обработанные ключи (идемпотентность в пределах процесса).
+    claim() занимает ключ и возвращает False, если он уже занят;
+    ключи забываются через ttl или вытесняются при переполнении.
+    """
+
+    def __init__(self, maxsize: int = 100000, ttl: float = 3600):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.duplicates = 0
+
+    def claim(self, key: Hashable) -> bool:
+        if self._cache.get(key, False):
+            self.duplicates += 1
+            return False
+        self._cache.set(key, True)
+        return True
+
+    def release(self, key: Hashable) -> None:
+        """Освободить ключ (действие не выполнено и может быть повторено)"""
+        self._cache.invalidate(key)
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "maxsize": self._cache.maxsize,
+            "duplicates": self.duplicates
+        }
@@ -0,0 +1,133 @@
+"""
+Потоковый импорт кодов активации из CSV
+Файл читается из памяти, разбирается порциями вне event loop
+и вставляется пакетами INSERT ... ON CONFLICT DO NOTHING
+"""
+import asyncio
+import csv
+from typing import Awaitable, Callable, List, Optional
+
+from loguru import logger
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import DatabaseManager
+
+# Строк CSV, разбираемых за один проход в отдельном потоке
+PARSE_CHUNK_SIZE = 5000
+# Кодов в одном INSERT (2 параметра на код, с запасом под лимит SQLite в 999 переменных)
+INSERT_BATCH_SIZE = 400
+# Сколько текстов ошибок сохранять для отчета
+MAX_REPORTED_ERRORS = 20
+
+ProgressCallback = Callable[[dict], Awaitable[None]]
+
+
+def _detect_format(first_line: str) -> tuple:
+    """
+    Разделитель и позиции колонок по первой строке.
+    Возвращает (delimiter, code_index, amount_index, has_header)
+    """
+    delimiter = ";" if first_line.count(";") > first_line.count(",") else ","
+    cells = [cell.strip().lower() for cell in next(csv.reader([first_line], delimiter=delimiter), [])]
+
+    if "code_value" in cells and "amount" in cells:
+        return delimiter, cells.index("code_value"), cells.index("amount"), True
+
+    # Заголовок с произвольными названиями: вторая колонка не число
+    has_header = len(cells) >= 2 and _parse_amount(cells[1]) is None
+    return delimiter, 0, 1, has_header
+
+
+def _parse_amount(value: str) -> Optional[float]:
+    """Сумма кода или None, если значение некорректно"""
+    try:
+        amount = float(value.strip().replace(",", "."))
+    except ValueError:
+        return None
+    return amount if amount > 0 else None
+
+
+def _parse_chunk(lines: List[str], delimiter: str, code_index: int, amount_index: int, first_line_no: int) -> tuple:
+    """Разбор порции строк (выполняется в отдельном потоке)"""
+    codes = []
+    errors = []
+    invalid = 0
+    min_len = max(code_index, amount_index) + 1
+
+    for offset, row in enumerate(csv.reader(lines, delimiter=delimiter)):
+        if not row or not any(cell.strip() for cell in row):
+            continue
+
+        line_no = first_line_no + offset
+        if len(row) < min_len:
+            invalid += 1
+            errors.append(f"Строка {line_no}: ожидается код и сумма")
+            continue
+
+        code_value = row[code_index].strip()
+        amount = _parse_amount(row[amount_index])
+
+        if not code_value or len(code_value) > 50:
+            invalid += 1
+            errors.append(f"Строка {line_no}: некорректный код")
+        elif amount is None:
+            invalid += 1
+            errors.append(f"Строка {line_no}: неверная сумма '{row[amount_index].strip()}'")
+        else:
+            codes.append((code_value, amount))
+
+    return codes, invalid, errors[:MAX_REPORTED_ERRORS]
+
+
+async def import_codes_csv(
+    session: AsyncSession,
+    data: bytes,
+    on_progress: Optional[ProgressCallback] = None
+) -> dict:
+    """
+    Импорт кодов из содержимого CSV файла.
+    Поддерживаются форматы 'code_value,amount' (с заголовком) и 'код,сумма'
+    (первая строка-заголовок пропускается), разделитель - запятая или точка с запятой.
+    Возвращает {"total", "added", "skipped", "invalid", "errors", "lines", "processed"},
+    где skipped - дубликаты, lines/processed - строк в файле/обработано.
+    on_progress вызывается после каждой порции с текущими счетчиками.
+    """
+    text = await asyncio.to_thread(data.decode, "utf-8-sig")
+    lines = await asyncio.to_thread(str.splitlines, text)
+    del text
+
+    result = {"total": 0, "added": 0, "skipped": 0, "invalid": 0, "errors": [], "lines": len(lines), "processed": 0}
+    if not lines:
+        return result
+
+    delimiter, code_index, amount_index, has_header = _detect_format(lines[0])
+    start = 1 if has_header else 0
+
+    for chunk_start in range(start, len(lines), PARSE_CHUNK_SIZE):
+        chunk = lines[chunk_start:chunk_start + PARSE_CHUNK_SIZE]
+        codes, invalid, errors = await asyncio.to_thread(
+            _parse_chunk, chunk, delimiter, code_index, amount_index, chunk_start + 1
+        )
+
+        for batch_start in range(0, len(codes), INSERT_BATCH_SIZE):
+            batch = codes[batch_start:batch_start + INSERT_BATCH_SIZE]
+            added = await DatabaseManager.bulk_insert_codes(session, batch)
+            result["added"] += added
+            result["skipped"] += len(batch) - added
+
+        result["total"] += len(codes)
+        result["invalid"] += invalid
+        result["errors"].extend(errors[:MAX_REPORTED_ERRORS - len(result["errors"])])
+        result["processed"] = chunk_start + len(chunk)
+
+        if on_progress:
+            try:
+                await on_progress(result)
+            except Exception as e:
+                logger.warning(f"Не удалось обновить прогресс импорта: {e}")
+
+    logger.info(
+        f"Импорт кодов: добавлено {result['added']}, дубликатов {result['skipped']}, "
+        f"ошибок {result['invalid']}"
+    )
+    return result
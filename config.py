@@ -23,10 +23,74 @@ if "username:password@localhost" in _db_url:
 else:
     DATABASE_URL = _db_url
 
+# SQLite production-профиль: WAL, прагмы, блокировка записи (BEGIN IMMEDIATE) и очередь писателя
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "true").lower() in ("1", "true", "yes")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))  # 256MB
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536))  # 64MB
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", 4))
+SQLITE_WRITE_BATCH = int(os.getenv("SQLITE_WRITE_BATCH", 50))  # Операций в одном коммите писателя
+
+# Пул соединений серверной базы (PostgreSQL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 5))  # Временные соединения сверх пула
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # Секунд ожидания свободного соединения
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Пересоздавать соединения старше N секунд
+DB_POOL_SLOW_WAIT_MS = int(os.getenv("DB_POOL_SLOW_WAIT_MS", 500))  # Предупреждать о долгом ожидании
+# Кэш подготовленных выражений asyncpg на соединение (0 - выключен, нужно для pgbouncer)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+
+# Чтение с реплики: отдельный движок для списков, статистики и экспорта
+# DATABASE_READ_URL - реплика PostgreSQL (пусто - читать с основной базы)
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")
+# Для файловой SQLite без реплики - соединения только для чтения (mode=ro, query_only)
+SQLITE_READ_ONLY_ENGINE = os.getenv("SQLITE_READ_ONLY_ENGINE", "true").lower() in ("1", "true", "yes")
+# Сколько секунд после своей записи пользователь читает с основной базы (отставание реплики)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 10))
+
+# Журналы аудита (transactions, admin_logs): запись пачками в фоне, вне пути запроса
+# false - синхронная запись в транзакции запроса (для тестов и отладки)
+AUDIT_WRITE_BEHIND = os.getenv("AUDIT_WRITE_BEHIND", "true").lower() in ("1", "true", "yes")
+AUDIT_FLUSH_INTERVAL_MS = int(os.getenv("AUDIT_FLUSH_INTERVAL_MS", 20))  # Не дольше N мс в буфере
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 200))  # Записей в одном INSERT
+
+# Архив закрытых заявок: старше N дней переносятся в архивные таблицы (0 - не архивировать)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 500))  # Заявок в одной транзакции переноса
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", 24))
+
 # Webhook Configuration
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST")
 WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "0.0.0.0")
+# Секрет в заголовке запросов Telegram (пусто - случайный при каждом запуске)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 32))  # Апдейтов обрабатывается одновременно
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))  # Сверх очереди - 503, Telegram повторит
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))  # Соединений от Telegram
+
+# Sharding
+# Больше 1 - фронт-процесс получает апдейты и распределяет их по N процессам-воркерам
+# (по хешу пользователя: апдейты одного пользователя - в одном воркере по порядку)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", 0))
+SHARD_LANES = int(os.getenv("SHARD_LANES", 32))  # Пользователей обрабатывается одновременно в воркере
+SHARD_FAST_LANES = int(os.getenv("SHARD_FAST_LANES", 4))  # Обработчиков платежей вне очереди в воркере
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000))  # Необработанных апдейтов на воркер
+SHARD_REFRESH_INTERVAL = int(os.getenv("SHARD_REFRESH_INTERVAL", 30))  # Секунд между перечитыванием ролей и настроек
+# Задаются фронтом при запуске воркера
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.getenv("SHARD_INDEX") else None
+SHARD_FRONT_PORT = int(os.getenv("SHARD_FRONT_PORT", 0))
+SHARD_TOKEN = os.getenv("SHARD_TOKEN", "")
+
+# Outbound sending (очередь исходящих сообщений с учетом лимитов Telegram)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))  # Сообщений в секунду на бота
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # В секунду в один личный чат
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 0.33))  # В секунду в одну группу (20 в минуту)
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))  # Сообщений подряд в чат без паузы
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", 5))  # Попыток при ошибках сети и 5xx
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", 10000))  # Сверх - сообщение отбрасывается
 
 # File Storage
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
@@ -35,6 +99,42 @@ MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 10485760))  # 10MB
 # Rate Limiting
 RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", 1))
 MAX_APPLICATIONS_PER_DAY = int(os.getenv("MAX_APPLICATIONS_PER_DAY", 3))
+# Частота сообщений и нажатий кнопок: минимальный интервал (с) и лимит в минуту (0 - без лимита)
+RATE_LIMIT_MESSAGE_INTERVAL = float(os.getenv("RATE_LIMIT_MESSAGE_INTERVAL", 0.5))
+RATE_LIMIT_MESSAGES_PER_MINUTE = int(os.getenv("RATE_LIMIT_MESSAGES_PER_MINUTE", 0))
+RATE_LIMIT_CALLBACK_INTERVAL = float(os.getenv("RATE_LIMIT_CALLBACK_INTERVAL", 0.3))
+RATE_LIMIT_CALLBACKS_PER_MINUTE = int(os.getenv("RATE_LIMIT_CALLBACKS_PER_MINUTE", 0))
+# Пользователи без запросов дольше N секунд забываются; не больше N пользователей в памяти
+RATE_LIMIT_IDLE_TTL = int(os.getenv("RATE_LIMIT_IDLE_TTL", 120))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", 200000))
+
+# Caching
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 50000))  # Профилей пользователей в памяти
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 600))  # Секунд
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()  # text или json (одна запись - одна строка)
+# Доля INFO-записей модуля в логе: построчные логи запросов middleware - каждая десятая
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "middleware=0.1")
+
+# FSM storage (состояния диалогов и черновики заявок в базе)
+FSM_FLUSH_INTERVAL_MS = int(os.getenv("FSM_FLUSH_INTERVAL_MS", 50))  # Изменения копятся не дольше N мс
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 86400))  # Секунд без изменений - состояние сбрасывается
+FSM_PURGE_INTERVAL = int(os.getenv("FSM_PURGE_INTERVAL", 600))  # Секунд между удалениями устаревших
+
+# Idempotency
+# Недавние апдейты и действия в памяти (повторная доставка, двойное нажатие)
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 100000))
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 3600))  # Секунд
+# Сколько дней хранить ключи выполненных действий в базе (processed_events)
+IDEMPOTENCY_KEEP_DAYS = int(os.getenv("IDEMPOTENCY_KEEP_DAYS", 30))
+
+# Metrics
+# Порт HTTP-сервера с метриками Prometheus (/metrics), 0 - выключен (по умолчанию).
+# Сервер без авторизации: по умолчанию слушает только localhost
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
 
 # Proxy Configuration (опционально)
 PROXY_URL = os.getenv("PROXY_URL")  # Например: http://proxy:port или socks5://proxy:port
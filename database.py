@@ -2,18 +2,43 @@
 Настройка базы данных и модели
 """
 import asyncio
+import json
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 from typing import Optional, List
 from sqlalchemy import (
     create_engine, Column, Integer, BigInteger, String, 
-    Numeric, Boolean, DateTime, ForeignKey, Text
+    Numeric, Boolean, DateTime, Date, Float, ForeignKey, Text, UniqueConstraint
 )
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import select, func
+from sqlalchemy.orm import relationship, Session, joinedload
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import select, update, delete, insert, func, event, exc, and_, or_, case, union_all, literal
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.util import await_only
+from collections import namedtuple
 from loguru import logger
-from config import DATABASE_URL
+from config import (
+    DATABASE_URL, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL,
+    DEPOSIT_AMOUNTS, PAYMENT_CURRENCY, PAYMENT_COMMISSION_PERCENT,
+    MAX_APPLICATIONS_PER_DAY, RATE_LIMIT_PER_MINUTE,
+    SQLITE_PROFILE, SQLITE_BUSY_TIMEOUT_MS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE_KB,
+    SQLITE_READ_POOL_SIZE, SQLITE_WRITE_BATCH,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_PRE_PING, DB_POOL_RECYCLE,
+    DB_POOL_SLOW_WAIT_MS, DB_STATEMENT_CACHE_SIZE,
+    DATABASE_READ_URL, SQLITE_READ_ONLY_ENGINE, READ_YOUR_WRITES_SECONDS,
+    ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, ARCHIVE_INTERVAL_HOURS,
+    AUDIT_WRITE_BEHIND, AUDIT_FLUSH_INTERVAL_MS, AUDIT_BATCH_SIZE,
+    IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL, IDEMPOTENCY_KEEP_DAYS, SHARD_REFRESH_INTERVAL
+)
+from cache import TTLCache, RecentKeys, MISSING
+from pagination import Page, fetch_page, NEXT
 
 Base = declarative_base()
 
@@ -45,7 +70,8 @@ class ActivationCode(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     code_value = Column(String(50), unique=True, nullable=False)
     amount = Column(Numeric(10, 2), nullable=False, index=True)
-    is_used = Column(Boolean, default=False, index=True)
+    # Свободные коды ищутся по частичному индексу ix_codes_free_amount_id (migrations.py)
+    is_used = Column(Boolean, default=False)
     issued_at = Column(DateTime, nullable=True)
     
     # Связь с заявкой
@@ -118,10 +144,820 @@ class BotSettings(Base):
     updated_by = Column(BigInteger, nullable=True)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# Настройка подключения к базе данных
-engine = create_async_engine(DATABASE_URL, echo=False)
+class DailyStats(Base):
+    """Дневная сводка по заявкам (день создания заявки, статус, сумма)"""
+    __tablename__ = "daily_stats"
+    __table_args__ = (
+        UniqueConstraint("day", "status", "amount", name="uq_daily_stats_day_status_amount"),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    day = Column(Date, nullable=False, index=True)
+    status = Column(String(20), nullable=False)
+    amount = Column(Numeric(10, 2), nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    processing_minutes = Column(Float, nullable=False, default=0)  # Сумма времени обработки (approved/rejected)
+
+class ArchivedApplication(Base):
+    """Архив закрытых заявок (перенесены из applications, см. archive_closed_applications)"""
+    __tablename__ = "applications_archive"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(BigInteger, nullable=False, index=True)
+    user_name = Column(String(255), nullable=True)
+    login = Column(String(50), nullable=False)
+    amount = Column(Numeric(10, 2), nullable=False)
+    currency = Column(String(10), default="USD")
+    file_id = Column(String(255), nullable=False)
+    status = Column(String(20), nullable=False)
+    admin_id = Column(BigInteger, nullable=True)
+    admin_comment = Column(Text, nullable=True)
+    activation_code_id = Column(Integer, ForeignKey("codes.id"), nullable=True)
+    created_at = Column(DateTime, index=True)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+    
+    activation_code = relationship("ActivationCode", viewonly=True)
+
+class ArchivedTransaction(Base):
+    """Архив истории операций по архивным заявкам"""
+    __tablename__ = "transactions_archive"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    application_id = Column(Integer, nullable=False, index=True)
+    action = Column(String(50), nullable=False)
+    admin_id = Column(BigInteger, nullable=True)
+    comment = Column(Text, nullable=True)
+    timestamp = Column(DateTime)
+
+class ProcessedEvent(Base):
+    """
+    Ключи выполненных действий (одобрение заявки, зачисление платежа).
+    Уникальный индекс не дает выполнить действие дважды, даже если
+    повтор пришел в другой процесс бота
+    """
+    __tablename__ = "processed_events"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    event_key = Column(String(128), unique=True, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class FSMStateRecord(Base):
+    """Состояние FSM и данные черновика пользователя (см. fsm_storage.SQLStorage)"""
+    __tablename__ = "fsm_states"
+    
+    storage_key = Column(String(255), primary_key=True)
+    state = Column(String(255), nullable=True)
+    data = Column(Text, nullable=False, default="{}")  # JSON
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class SchemaMigration(Base):
+    """Примененные миграции схемы (см. migrations.py)"""
+    __tablename__ = "schema_migrations"
+    
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(255), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+# Закрытые статусы: такие заявки больше не меняются и переносятся в архив
+CLOSED_STATUSES = ["approved", "rejected", "cancelled"]
+
+# Периоды статистики по умолчанию (в днях) и учитываемые статусы заявок
+STATS_WINDOWS = {"today": 1, "week": 7, "month": 30}
+STATS_STATUSES = ["pending", "approved", "rejected", "cancelled", "needs_info"]
+# Статусы, для которых учитывается время обработки
+PROCESSED_STATUSES = ["approved", "rejected"]
+
+# Поля заявки для списков и экспорта и код активации (LEFT JOIN codes)
+APPLICATION_ROW_FIELDS = [
+    "id", "user_id", "user_name", "login", "amount", "currency", "file_id", "status",
+    "admin_id", "admin_comment", "created_at", "updated_at", "code_value"
+]
+# Строка заявки без ORM-объекта: кортеж без __dict__ и состояния сессии,
+# связи не подгружаются (код активации уже в строке)
+ApplicationRow = namedtuple("ApplicationRow", APPLICATION_ROW_FIELDS)
+
+def _application_rows_query(model=Application):
+    """SELECT полей ApplicationRow с кодом активации одним запросом"""
+    return select(
+        *(getattr(model, field) for field in APPLICATION_ROW_FIELDS[:-1]),
+        ActivationCode.code_value
+    ).outerjoin(ActivationCode, ActivationCode.id == model.activation_code_id)
+
+# Решение лимитера заявок: allowed, retry_after (секунд до снятия лимита), message
+RateLimitDecision = namedtuple("RateLimitDecision", ["allowed", "retry_after", "message"])
+# Интервал между заявками пользователя (RATE_LIMIT_PER_MINUTE - минут между заявками)
+RATE_LIMIT_INTERVAL = timedelta(minutes=RATE_LIMIT_PER_MINUTE)
+
+def format_retry_after(seconds: int) -> str:
+    """Время до снятия лимита для сообщения пользователю"""
+    if seconds < 60:
+        return f"{seconds} сек."
+    if seconds < 3600:
+        return f"{(seconds + 59) // 60} мин."
+    return f"{seconds // 3600} ч. {seconds % 3600 // 60} мин."
+
+# Кэш профилей пользователей: user_id -> CachedProfile
+CachedProfile = namedtuple("CachedProfile", ["language", "first_time"])
+profile_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+# Ключ в session.info: профили, закэшированные внутри незакоммиченной транзакции
+PROFILE_CACHE_KEYS = "profile_cache_keys"
+
+class AdminRoleMap:
+    """
+    Роли администраторов в памяти: user_id -> role.
+    Проверка прав - чтение словаря без блокировок и без обращения к базе.
+    Изменения применяются копированием словаря после коммита add_admin/remove_admin,
+    каждое изменение увеличивает version.
+    """
+    
+    def __init__(self):
+        self.roles: dict = {}
+        self.version = 0
+        self.loaded = False
+    
+    def get(self, user_id: int) -> Optional[str]:
+        return self.roles.get(user_id)
+    
+    def replace(self, roles: dict) -> None:
+        """Заменить карту целиком (загрузка из базы)"""
+        self.roles = roles
+        self.loaded = True
+    
+    def apply(self, changes: list) -> None:
+        """Применить зафиксированные изменения [(user_id, role или None), ...]"""
+        roles = dict(self.roles)
+        for user_id, role in changes:
+            if role is None:
+                roles.pop(user_id, None)
+            else:
+                roles[user_id] = role
+        self.roles = roles
+        self.version += 1
+
+admin_roles = AdminRoleMap()
+# Ключ в session.info: изменения ролей, ожидающие коммита
+ADMIN_ROLE_CHANGES = "admin_role_changes"
+
+def _parse_json_list(value: str) -> list:
+    """Список из JSON строки настройки"""
+    parsed = json.loads(value)
+    if not isinstance(parsed, list):
+        raise ValueError("ожидается JSON список")
+    return parsed
+
+def _default_languages() -> list:
+    from localization import LANGUAGES
+    return list(LANGUAGES.keys())
+
+# Типизированные настройки bot_settings: ключ -> (разбор строки, значение по умолчанию)
+SETTINGS_SCHEMA = {
+    "deposit_amounts": (_parse_json_list, lambda: DEPOSIT_AMOUNTS),
+    "payment_provider_token": (str, lambda: os.getenv("PAYMENT_PROVIDER_TOKEN") or None),
+    "payment_currency": (str, lambda: PAYMENT_CURRENCY),
+    "payment_commission": (float, lambda: PAYMENT_COMMISSION_PERCENT),
+    "enabled_languages": (_parse_json_list, _default_languages),
+}
+
+class SettingsRegistry:
+    """
+    Настройки бота из bot_settings в памяти.
+    Загружаются один раз, set_setting обновляет их после коммита.
+    Для ключей из SETTINGS_SCHEMA хранятся уже разобранные значения.
+    """
+    
+    def __init__(self, schema: dict):
+        self.schema = schema
+        self.raw: dict = {}
+        self.values: dict = {}
+        self.version = 0
+        self.loaded = False
+    
+    def _decode(self, key: str, value: Optional[str]):
+        parser, default = self.schema[key]
+        if value not in (None, ""):
+            try:
+                return parser(value)
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Некорректное значение настройки {key}: {e}")
+        return default()
+    
+    def get(self, key: str, default=None):
+        """Разобранное значение типизированной настройки или строка прочих настроек"""
+        if key in self.schema:
+            return self.values[key] if self.loaded else self._decode(key, None)
+        return self.raw.get(key, default)
+    
+    def get_raw(self, key: str, default: str = None) -> Optional[str]:
+        """Значение настройки как оно хранится в базе"""
+        return self.raw.get(key, default)
+    
+    def replace(self, raw: dict) -> None:
+        """Заменить все настройки (загрузка из базы)"""
+        self.values = {key: self._decode(key, raw.get(key)) for key in self.schema}
+        self.raw = raw
+        self.loaded = True
+    
+    def apply(self, changes: list) -> None:
+        """Применить зафиксированные изменения [(key, value), ...]"""
+        raw = dict(self.raw)
+        raw.update(changes)
+        self.replace(raw)
+        self.version += 1
+
+bot_settings = SettingsRegistry(SETTINGS_SCHEMA)
+# Ключ в session.info: изменения настроек, ожидающие коммита
+SETTINGS_CHANGES = "settings_changes"
+
+# Ключ в session.info: заявки для синхронизации с Google Sheets после коммита
+PENDING_SHEETS_SYNC = "pending_sheets_sync"
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+# Ключ в session.info: пользователи, чьи записи фиксируются этой транзакцией
+RECENT_WRITERS = "recent_writers"
+# Ключ в session.info: записи аудита, которые уйдут в буфер после коммита
+PENDING_AUDIT = "pending_audit"
+# Недавние апдейты и действия: повтор отсекается до обращения к базе
+recent_keys = RecentKeys(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL)
+# Ключ в session.info: ключи действий, занятые транзакцией (освобождаются при откате)
+CLAIMED_KEYS = "claimed_keys"
+# Все отложенные до коммита изменения в session.info
+DEFERRED_INFO_KEYS = (
+    PROFILE_CACHE_KEYS, ADMIN_ROLE_CHANGES, SETTINGS_CHANGES, PENDING_SHEETS_SYNC, RECENT_WRITERS, PENDING_AUDIT,
+    CLAIMED_KEYS
+)
+
+# ==================== ПОДКЛЮЧЕНИЕ ====================
+
+def is_file_sqlite(url: str) -> bool:
+    """SQLite база в файле (не в памяти)"""
+    return url.startswith("sqlite") and ":memory:" not in url
+
+def _set_sqlite_pragmas(dbapi_connection, read_only: bool = False) -> None:
+    """
+    Прагмы production-профиля SQLite (на каждое новое соединение).
+    Соединению только для чтения режим журнала не меняем (его задает писатель),
+    а query_only запрещает запись на уровне SQLite.
+    """
+    cursor = dbapi_connection.cursor()
+    if read_only:
+        cursor.execute("PRAGMA query_only=1")
+    else:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.close()
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """
+    Пул соединений со счетчиками ожидания свободного соединения.
+    Время ожидания - от запроса соединения до его выдачи (включая
+    открытие нового соединения и pre-ping).
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            logger.warning(
+                f"Нет свободного соединения с БД за {self._timeout} с "
+                f"(занято {self.checkedout()}, пул {self.size()}+{self._max_overflow})"
+            )
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            if waited * 1000 >= DB_POOL_SLOW_WAIT_MS:
+                logger.warning(f"Ожидание соединения с БД {waited * 1000:.0f} мс (занято {self.checkedout()})")
+    
+    def stats(self) -> dict:
+        """Текущее состояние пула и счетчики ожидания"""
+        return {
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "checked_out": self.checkedout(),
+            "checked_in": self.checkedin(),
+            # overflow() отрицателен, пока пул не заполнен до pool_size
+            "overflow": max(self.overflow(), 0),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait_ms": self.total_wait / self.checkouts * 1000 if self.checkouts else 0.0,
+            "max_wait_ms": self.max_wait * 1000
+        }
+
+def create_database_engine(url: str, sqlite_profile: bool = SQLITE_PROFILE) -> AsyncEngine:
+    """
+    Движок базы данных.
+    Для серверных баз (PostgreSQL): пул соединений из конфигурации
+    (размер, переполнение, таймаут, pre-ping, recycle) и кэш подготовленных
+    выражений asyncpg.
+    Для файловой SQLite с профилем: WAL, synchronous=NORMAL, busy_timeout,
+    mmap и кэш страниц, небольшой пул соединений. Через этот пул идут сессии
+    апдейтов - и чтение, и запись; запись сериализуется SQLiteWriteLock.
+    """
+    if not url.startswith("sqlite"):
+        connect_args = {}
+        if "+asyncpg" in url:
+            connect_args["prepared_statement_cache_size"] = DB_STATEMENT_CACHE_SIZE
+        
+        return create_async_engine(
+            url,
+            echo=False,
+            poolclass=InstrumentedPool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            pool_recycle=DB_POOL_RECYCLE,
+            connect_args=connect_args
+        )
+    
+    if not (sqlite_profile and is_file_sqlite(url)):
+        sqlite_engine = create_async_engine(url, echo=False)
+        event.listen(sqlite_engine.sync_engine, "before_cursor_execute", _begin_before_savepoint)
+        return sqlite_engine
+    
+    sqlite_engine = create_async_engine(
+        url,
+        echo=False,
+        poolclass=InstrumentedPool,
+        pool_size=SQLITE_READ_POOL_SIZE,
+        max_overflow=0,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    )
+    
+    @event.listens_for(sqlite_engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        _set_sqlite_pragmas(dbapi_connection)
+    
+    event.listen(sqlite_engine.sync_engine, "before_cursor_execute", _begin_before_savepoint)
+    return sqlite_engine
+
+def _begin_before_savepoint(conn, cursor, statement, parameters, context, executemany):
+    """
+    Драйвер SQLite открывает транзакцию только перед INSERT/UPDATE/DELETE.
+    SAVEPOINT вне транзакции открывает ее сам, и RELEASE такой точки фиксирует
+    все сразу - внешний откат (begin_nested в начале сессии) уже ничего не отменит
+    """
+    if statement.startswith("SAVEPOINT") and not conn.connection.driver_connection.in_transaction:
+        cursor.execute("BEGIN")
+
+def sqlite_read_only_url(url: str) -> str:
+    """URL файловой SQLite, открываемой только для чтения (URI с mode=ro)"""
+    parsed = make_url(url)
+    return parsed.set(database=f"file:{parsed.database}?mode=ro&uri=true").render_as_string(hide_password=False)
+
+def create_sqlite_read_only_engine(url: str) -> AsyncEngine:
+    """
+    Движок чтения файловой SQLite: пул соединений mode=ro + query_only.
+    В WAL читатели не ждут писателя и видят последний зафиксированный снимок.
+    """
+    read_only_engine = create_async_engine(
+        sqlite_read_only_url(url),
+        echo=False,
+        poolclass=InstrumentedPool,
+        pool_size=SQLITE_READ_POOL_SIZE,
+        max_overflow=0,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    )
+    
+    @event.listens_for(read_only_engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        _set_sqlite_pragmas(dbapi_connection, read_only=True)
+    
+    return read_only_engine
+
+def create_sqlite_writer_engine(url: str) -> AsyncEngine:
+    """
+    Движок единственного писателя SQLite: одно соединение, транзакции
+    BEGIN IMMEDIATE (блокировка записи берется сразу) и рабочие SAVEPOINT.
+    """
+    writer_engine = create_async_engine(
+        url,
+        echo=False,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    )
+    
+    @event.listens_for(writer_engine.sync_engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        _set_sqlite_pragmas(dbapi_connection)
+        # Драйвер не открывает транзакции сам - это делает do_begin
+        dbapi_connection.isolation_level = None
+    
+    @event.listens_for(writer_engine.sync_engine, "begin")
+    def _do_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+    
+    return writer_engine
+
+# Операторы, с которых начинается запись (SAVEPOINT вне транзакции открывает ее в SQLite)
+_WRITE_STATEMENT = re.compile(r"^\s*(INSERT|UPDATE|DELETE|REPLACE|SAVEPOINT)\b", re.IGNORECASE)
+# Ключ в info соединения: соединение держит блокировку записи
+WRITE_LOCK_HELD = "sqlite_write_lock_held"
+
+class SQLiteWriteLock:
+    """
+    Блокировка записи файловой SQLite внутри процесса.
+    SQLite допускает одну пишущую транзакцию; без этой блокировки соединения
+    основного пула и очереди писателя соревнуются за нее, и транзакция, которая
+    сначала читала, а потом пишет, получает SQLITE_BUSY (busy_timeout в WAL
+    ее не спасает). С блокировкой соединение перед первой записью ждет своей
+    очереди в event loop и открывает транзакцию BEGIN IMMEDIATE; блокировка
+    освобождается при коммите или откате транзакции. Очередь писателя берет
+    ту же блокировку на время пачки.
+    Транзакция записи должна быть короткой: перед запросом к Telegram API и
+    перед ожиданием очереди писателя сессия апдейта фиксируется
+    (commit_pending_writes), чтобы другие записи не ждали сеть.
+    Другие процессы (шардирование) ждут блокировку файла через busy_timeout -
+    для BEGIN IMMEDIATE это работает.
+    """
+    
+    def __init__(self, timeout: float = SQLITE_BUSY_TIMEOUT_MS / 1000):
+        self.timeout = timeout
+        self._lock = asyncio.Lock()
+        self.owner: Optional[asyncio.Task] = None
+        self.acquired = 0
+        self.max_wait = 0.0
+    
+    async def acquire(self) -> None:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._lock.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Блокировка записи SQLite не получена за {self.timeout:.0f} с") from None
+        self.owner = asyncio.current_task()
+        self.acquired += 1
+        self.max_wait = max(self.max_wait, time.perf_counter() - started)
+    
+    def release(self) -> None:
+        self.owner = None
+        self._lock.release()
+    
+    def held_by_current_task(self) -> bool:
+        """Блокировку держит текущая задача (апдейт, который уже пишет)"""
+        return self._lock.locked() and self.owner is asyncio.current_task()
+    
+    def install(self, db_engine: AsyncEngine) -> None:
+        """Брать блокировку перед первой записью каждого соединения движка"""
+        
+        # Блокировка сама открывает транзакцию (BEGIN IMMEDIATE) до SAVEPOINT
+        if event.contains(db_engine.sync_engine, "before_cursor_execute", _begin_before_savepoint):
+            event.remove(db_engine.sync_engine, "before_cursor_execute", _begin_before_savepoint)
+        
+        @event.listens_for(db_engine.sync_engine, "before_cursor_execute")
+        def _lock_before_write(conn, cursor, statement, parameters, context, executemany):
+            if conn.info.get(WRITE_LOCK_HELD) or not _WRITE_STATEMENT.match(statement):
+                return
+            await_only(self.acquire())
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+            except Exception:
+                self.release()
+                raise
+            conn.info[WRITE_LOCK_HELD] = True
+        
+        @event.listens_for(db_engine.sync_engine, "commit")
+        @event.listens_for(db_engine.sync_engine, "rollback")
+        def _unlock_on_transaction_end(conn):
+            # Следующий писатель подождет окончания коммита через busy_timeout - миллисекунды
+            if conn.info.pop(WRITE_LOCK_HELD, False):
+                self.release()
+        
+        @event.listens_for(db_engine.sync_engine.pool, "checkin")
+        def _unlock_on_checkin(dbapi_connection, connection_record):
+            # Транзакцию без коммита пул откатывает сам, до checkin и без события rollback
+            if connection_record is not None and connection_record.info.pop(WRITE_LOCK_HELD, False):
+                self.release()
+    
+    def stats(self) -> dict:
+        """Счетчики блокировки записи"""
+        return {"acquired": self.acquired, "max_wait_ms": self.max_wait * 1000, "locked": self._lock.locked()}
+
+class SQLiteWriter:
+    """
+    Очередь единственного писателя SQLite.
+    Операции (async def job(session)) выполняются по очереди одним фоновым
+    обработчиком; все операции, накопившиеся в очереди, выполняются в одной
+    транзакции (каждая в своем SAVEPOINT) и фиксируются одним коммитом.
+    Результат операции возвращается только после коммита.
+    """
+    
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        max_batch: int = SQLITE_WRITE_BATCH,
+        write_lock: Optional[SQLiteWriteLock] = None
+    ):
+        self.session_maker = session_maker
+        self.max_batch = max_batch
+        self.write_lock = write_lock
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.jobs = 0
+    
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self.queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+    
+    async def submit(self, job):
+        """Выполнить операцию записи и дождаться коммита"""
+        if self.write_lock is not None and self.write_lock.held_by_current_task():
+            # Пачка ждала бы блокировку, которую держит сессия этого же апдейта
+            await commit_pending_writes(self.write_lock)
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future))
+        return await future
+    
+    async def stop(self) -> None:
+        """Дописать очередь и остановить обработчик"""
+        if self._task is None or self._task.done():
+            return
+        await self.queue.put(None)
+        await self._task
+    
+    async def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            await self._execute(batch)
+    
+    async def _execute(self, batch: list) -> None:
+        if self.write_lock is None:
+            await self._execute_batch(batch)
+            return
+        try:
+            await self.write_lock.acquire()
+        except TimeoutError as e:
+            logger.error(f"Очередь записи: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        try:
+            await self._execute_batch(batch)
+        finally:
+            self.write_lock.release()
+    
+    async def _execute_batch(self, batch: list) -> None:
+        results = []
+        try:
+            async with self.session_maker() as session:
+                session.info[UNIT_OF_WORK_KEY] = True
+                for job, future in batch:
+                    saved = self._save_deferred(session)
+                    try:
+                        async with session.begin_nested():
+                            results.append((future, await job(session), None))
+                    except Exception as e:
+                        self._restore_deferred(session, saved)
+                        results.append((future, None, e))
+                # Отложенные изменения операций (аудит, Sheets, роли, кэши) применяются
+                # только после коммита пачки; при ошибке коммита откат их отбрасывает
+                try:
+                    await session.commit()
+                except Exception:
+                    await session.rollback()
+                    raise
+        except Exception as e:
+            logger.error(f"Ошибка коммита очереди записи ({len(batch)} операций): {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        self.batches += 1
+        self.jobs += len(batch)
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    @staticmethod
+    def _save_deferred(session: AsyncSession) -> dict:
+        """Снимок отложенных до коммита изменений кэшей перед операцией"""
+        return {key: list(session.info.get(key, ())) for key in DEFERRED_INFO_KEYS}
+    
+    @staticmethod
+    def _restore_deferred(session: AsyncSession, saved: dict) -> None:
+        """SAVEPOINT операции откатился - забываем ее отложенные изменения"""
+        for user_id in set(session.info.get(PROFILE_CACHE_KEYS, ())) - set(saved[PROFILE_CACHE_KEYS]):
+            profile_cache.invalidate(user_id)
+        for key in set(session.info.get(CLAIMED_KEYS, ())) - set(saved[CLAIMED_KEYS]):
+            recent_keys.release(key)
+        
+        for key, value in saved.items():
+            if key == PROFILE_CACHE_KEYS:
+                session.info[key] = set(value)
+            else:
+                session.info[key] = value
+    
+    def stats(self) -> dict:
+        """Счетчики очереди записи"""
+        return {
+            "jobs": self.jobs,
+            "batches": self.batches,
+            "avg_batch": self.jobs / self.batches if self.batches else 0.0,
+            "queued": self.queue.qsize() if self.queue else 0
+        }
+
+class AuditWriter:
+    """
+    Буфер журналов аудита (transactions, admin_logs) с записью в фоне.
+    Записи копятся в памяти и раз в flush_interval_ms (или при max_batch
+    записях) вставляются одним многострочным INSERT на таблицу.
+    На файловой SQLite пачка идет через очередь единственного писателя.
+    """
+    
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        writer: Optional[SQLiteWriter] = None,
+        flush_interval_ms: int = AUDIT_FLUSH_INTERVAL_MS,
+        max_batch: int = AUDIT_BATCH_SIZE
+    ):
+        self.session_maker = session_maker
+        self.writer = writer
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.buffer: list = []
+        self._has_records: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.records = 0
+        self.flushes = 0
+        self.errors = 0
+    
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._has_records = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+    
+    def add(self, table, row: dict) -> None:
+        """Поставить запись в буфер (без ожидания записи в базу)"""
+        self._ensure_started()
+        self.buffer.append((table, row))
+        self._has_records.set()
+        if len(self.buffer) >= self.max_batch:
+            self._full.set()
+    
+    async def _run(self) -> None:
+        while not self._stopping:
+            await self._has_records.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            
+            errors = self.errors
+            await self.flush()
+            if self.errors > errors and not self._stopping:
+                # База недоступна - повторяем не чаще раза в секунду
+                await asyncio.sleep(1)
+    
+    async def flush(self) -> None:
+        """Записать все накопленные записи"""
+        while self.buffer:
+            batch, self.buffer = self.buffer[:self.max_batch], self.buffer[self.max_batch:]
+            if not self.buffer:
+                self._has_records.clear()
+                self._full.clear()
+            
+            rows_by_table = {}
+            for table, row in batch:
+                rows_by_table.setdefault(table, []).append(row)
+            
+            async def job(session: AsyncSession):
+                for table, rows in rows_by_table.items():
+                    await session.execute(insert(table).values(rows))
+            
+            try:
+                if self.writer is not None:
+                    await self.writer.submit(job)
+                else:
+                    async with self.session_maker() as session:
+                        await job(session)
+                        await session.commit()
+            except Exception as e:
+                # Записи возвращаются в буфер и уйдут следующей пачкой
+                self.errors += 1
+                self.buffer[:0] = batch
+                self._has_records.set()
+                self._full.clear()
+                logger.error(f"Ошибка записи журнала аудита ({len(batch)} записей): {e}")
+                return
+            
+            self.records += len(batch)
+            self.flushes += 1
+    
+    async def stop(self) -> None:
+        """Дописать буфер и остановить фоновую запись"""
+        if self._task is None or self._task.done():
+            return
+        self._stopping = True
+        self._has_records.set()
+        self._full.set()
+        await self._task
+        if self.buffer:
+            await self.flush()
+    
+    def stats(self) -> dict:
+        """Счетчики буфера аудита"""
+        return {
+            "records": self.records,
+            "flushes": self.flushes,
+            "avg_batch": self.records / self.flushes if self.flushes else 0.0,
+            "buffered": len(self.buffer),
+            "errors": self.errors
+        }
+
+engine = create_database_engine(DATABASE_URL)
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Файловая SQLite: блокировка записи (сессии апдейтов и очередь писателя пишут по одной)
+# и очередь писателя для групповых коммитов (для остальных баз - None)
+sqlite_write_lock = None
+writer_engine = None
+sqlite_writer = None
+if SQLITE_PROFILE and is_file_sqlite(DATABASE_URL):
+    sqlite_write_lock = SQLiteWriteLock()
+    sqlite_write_lock.install(engine)
+    writer_engine = create_sqlite_writer_engine(DATABASE_URL)
+    sqlite_writer = SQLiteWriter(
+        async_sessionmaker(writer_engine, class_=AsyncSession, expire_on_commit=False),
+        write_lock=sqlite_write_lock
+    )
+
+# Буфер журналов аудита (None - синхронная запись, AUDIT_WRITE_BEHIND=false)
+audit_writer = AuditWriter(async_session_maker, sqlite_writer) if AUDIT_WRITE_BEHIND else None
+
+# Движок чтения: реплика PostgreSQL, SQLite только для чтения или основной движок.
+# Через него идут списки, статистика и экспорт (read_session), запись - всегда в основной
+if DATABASE_READ_URL:
+    read_engine = create_database_engine(DATABASE_READ_URL)
+elif SQLITE_PROFILE and SQLITE_READ_ONLY_ENGINE and is_file_sqlite(DATABASE_URL):
+    read_engine = create_sqlite_read_only_engine(DATABASE_URL)
+else:
+    read_engine = engine
+read_session_maker = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+# Пользователи с недавними записями: их чтения идут в основную базу,
+# пока реплика может отставать (read your own writes)
+_recent_writers = TTLCache(maxsize=100000, ttl=READ_YOUR_WRITES_SECONDS)
+
+def mark_user_write(user_id: int) -> None:
+    """Пользователь только что записал данные - ближайшие чтения с основной базы"""
+    _recent_writers.set(user_id, True)
+
+@asynccontextmanager
+async def read_session(user_id: Optional[int] = None, primary: bool = False):
+    """
+    Сессия только для чтения.
+    Основная база вместо реплики: primary=True или если user_id недавно
+    что-то записал (заявка, решение по заявке) и должен увидеть результат сразу.
+    """
+    use_primary = primary or read_engine is engine or (
+        user_id is not None and _recent_writers.get(user_id, False)
+    )
+    maker = async_session_maker if use_primary else read_session_maker
+    async with maker() as session:
+        yield session
+
 async def create_tables():
     """Создание таблиц в базе данных"""
     async with engine.begin() as conn:
@@ -135,8 +971,199 @@ async def get_session() -> AsyncSession:
         finally:
             await session.close()
 
+# Ключ в session.info: коммиты DatabaseManager откладываются до конца апдейта
+UNIT_OF_WORK_KEY = "unit_of_work"
+# Сессия unit of work текущего апдейта (для commit_pending_writes)
+current_unit_of_work: ContextVar[Optional[AsyncSession]] = ContextVar("current_unit_of_work", default=None)
+
+@asynccontextmanager
+async def unit_of_work():
+    """
+    Одна сессия и один коммит на весь апдейт.
+    Методы DatabaseManager внутри делают только flush, коммит - при выходе.
+    """
+    async with async_session_maker() as session:
+        session.info[UNIT_OF_WORK_KEY] = True
+        token = current_unit_of_work.set(session)
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            # После промежуточного коммита (commit_pending_writes) транзакции может
+            # не быть, и after_rollback не сработает - ключи освобождаем сами
+            _invalidate_session_caches(session.sync_session)
+            raise
+        finally:
+            current_unit_of_work.reset(token)
+
+        try:
+            await session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка коммита unit of work: {e}")
+            await session.rollback()
+            _invalidate_session_caches(session.sync_session)
+            raise
+
+async def commit_pending_writes(write_lock: Optional["SQLiteWriteLock"] = None) -> None:
+    """
+    Файловая SQLite: если апдейт уже пишет (держит блокировку записи),
+    зафиксировать его сессию. Вызывается перед ожиданием вне базы - запросом
+    к Telegram API или очередью писателя, - чтобы блокировка не держалась
+    на время сети. Изменения до этого момента уже не откатятся ошибкой после него.
+    Занятые ключи действий остаются за апдейтом до его собственного коммита или отката:
+    промежуточный коммит еще не фиксирует само действие.
+    """
+    write_lock = write_lock or sqlite_write_lock
+    if write_lock is None or not write_lock.held_by_current_task():
+        return
+    session = current_unit_of_work.get()
+    if session is not None:
+        claimed = session.info.pop(CLAIMED_KEYS, [])
+        try:
+            await session.commit()
+        finally:
+            session.info[CLAIMED_KEYS] = claimed + session.info.get(CLAIMED_KEYS, [])
+    if write_lock.held_by_current_task():
+        logger.warning("Блокировку записи SQLite держит сессия вне unit of work на время ожидания")
+
+@event.listens_for(Session, "after_commit")
+def _apply_committed_caches(session: Session) -> None:
+    """Транзакция зафиксирована: кэшированные профили актуальны, роли и настройки применяем"""
+    # RELEASE SAVEPOINT (begin_nested) тоже вызывает after_commit, но ничего не фиксирует:
+    # изменения применяются только при коммите внешней транзакции
+    if session.in_nested_transaction():
+        return
+    session.info.pop(PROFILE_CACHE_KEYS, None)
+    # Действия зафиксированы - ключи остаются занятыми
+    session.info.pop(CLAIMED_KEYS, None)
+    
+    changes = session.info.pop(ADMIN_ROLE_CHANGES, None)
+    if changes:
+        admin_roles.apply(changes)
+    
+    changes = session.info.pop(SETTINGS_CHANGES, None)
+    if changes:
+        bot_settings.apply(changes)
+    
+    for user_id in session.info.pop(RECENT_WRITERS, ()):
+        mark_user_write(user_id)
+    
+    for table, row in session.info.pop(PENDING_AUDIT, ()):
+        audit_writer.add(table, row)
+    
+    for application, is_new in session.info.pop(PENDING_SHEETS_SYNC, ()):
+        task = asyncio.get_running_loop().create_task(_sync_to_sheets(application, is_new))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+@event.listens_for(Session, "after_rollback")
+def _invalidate_session_caches(session: Session) -> None:
+    """Сбросить профили, записанные в кэш откатившейся транзакцией"""
+    # Откат SAVEPOINT отменяет только свою часть: внешняя транзакция продолжается
+    # (SQLiteWriter сам забывает отложенные изменения откатившейся операции)
+    if session.in_nested_transaction():
+        return
+    for user_id in session.info.pop(PROFILE_CACHE_KEYS, ()):
+        profile_cache.invalidate(user_id)
+    # Действия откатились - их можно повторить
+    for key in session.info.pop(CLAIMED_KEYS, ()):
+        recent_keys.release(key)
+    
+    session.info.pop(ADMIN_ROLE_CHANGES, None)
+    session.info.pop(SETTINGS_CHANGES, None)
+    session.info.pop(PENDING_SHEETS_SYNC, None)
+    session.info.pop(RECENT_WRITERS, None)
+    session.info.pop(PENDING_AUDIT, None)
+
+async def _sync_to_sheets(application: "Application", is_new: bool) -> None:
+    """Автосинхронизация заявки с Google Sheets (после коммита, в фоне)"""
+    try:
+        from google_sheets_integration import auto_sync_application, GOOGLE_SHEETS_AVAILABLE
+        if not GOOGLE_SHEETS_AVAILABLE:
+            return
+        # Заявка из закрытой сессии не подгружает код активации - читаем строку заново
+        async with async_session_maker() as session:
+            row = await DatabaseManager.get_application_row(session, application.id)
+        if row is not None:
+            await auto_sync_application(row, is_new=is_new)
+    except Exception as e:
+        logger.warning(f"Не удалось синхронизировать с Google Sheets: {e}")
+
 class DatabaseManager:
     """Менеджер для работы с базой данных"""
+
+    @staticmethod
+    async def _commit(session: AsyncSession) -> None:
+        """Коммит, либо flush если сессия работает в режиме unit of work"""
+        if session.info.get(UNIT_OF_WORK_KEY):
+            await session.flush()
+        else:
+            await session.commit()
+    
+    @staticmethod
+    async def run_write(session: AsyncSession, job):
+        """
+        Выполнить пишущую операцию job(session) и зафиксировать ее.
+        На файловой SQLite - через очередь единственного писателя (групповой коммит),
+        на остальных базах - в текущей сессии с коммитом.
+        Если сессия уже пишет (держит блокировку записи SQLite), операция выполняется
+        в ней же: очередь ждала бы эту блокировку до коммита сессии.
+        """
+        if sqlite_writer is not None:
+            connection = await session.connection()
+            if not connection.info.get(WRITE_LOCK_HELD):
+                return await sqlite_writer.submit(job)
+        
+        result = await job(session)
+        await session.commit()
+        return result
+
+    @staticmethod
+    def claim_recent_key(session: AsyncSession, key: str) -> bool:
+        """
+        Занять ключ действия в памяти процесса, без запросов к базе.
+        False - такое действие уже выполняется или недавно выполнено.
+        При откате транзакции session ключ освобождается.
+        """
+        if not recent_keys.claim(key):
+            return False
+        session.info.setdefault(CLAIMED_KEYS, []).append(key)
+        return True
+    
+    @staticmethod
+    def release_recent_key(session: AsyncSession, key: str) -> None:
+        """Освободить ключ действия, которое не было выполнено"""
+        claimed = session.info.get(CLAIMED_KEYS, [])
+        if key in claimed:
+            claimed.remove(key)
+            recent_keys.release(key)
+    
+    @staticmethod
+    async def record_processed_event(session: AsyncSession, key: str) -> bool:
+        """
+        Записать ключ действия в той же транзакции, что и само действие.
+        False - ключ уже записан (действие выполнил другой апдейт или процесс).
+        Откатывается только вставка ключа (SAVEPOINT); сделанное до нее
+        откатывает вызывающий код, если нужно.
+        """
+        try:
+            async with session.begin_nested():
+                await session.execute(
+                    insert(ProcessedEvent).values(event_key=key, created_at=datetime.utcnow())
+                )
+        except exc.IntegrityError:
+            logger.warning(f"Повтор уже выполненного действия {key}")
+            return False
+        return True
+    
+    @staticmethod
+    async def purge_processed_events(session: AsyncSession, keep_days: int = IDEMPOTENCY_KEEP_DAYS) -> int:
+        """Удалить ключи действий старше keep_days дней"""
+        result = await session.execute(
+            delete(ProcessedEvent).where(ProcessedEvent.created_at < datetime.utcnow() - timedelta(days=keep_days))
+        )
+        await session.commit()
+        return result.rowcount
     
     @staticmethod
     async def create_application(
@@ -154,24 +1181,24 @@ class DatabaseManager:
             login=login,
             amount=amount,
             file_id=file_id,
-            status="pending"
+            status="pending",
+            created_at=datetime.utcnow()
         )
         session.add(application)
-        await session.commit()
-        await session.refresh(application)
+        await DatabaseManager._bump_daily_stats(session, application.created_at, "pending", amount, 1)
+        session.info.setdefault(RECENT_WRITERS, []).append(user_id)
         
-        # Автосинхронизация с Google Sheets
-        try:
-            from google_sheets_integration import auto_sync_application
-            await auto_sync_application(application, is_new=True)
-        except Exception as e:
-            logger.warning(f"Не удалось синхронизировать с Google Sheets: {e}")
+        # Автосинхронизация с Google Sheets - после коммита, вне транзакции
+        session.info.setdefault(PENDING_SHEETS_SYNC, []).append((application, True))
+        
+        await DatabaseManager._commit(session)
+        await session.refresh(application)
         
         return application
     
     @staticmethod
     async def get_activation_code(session: AsyncSession, amount: float) -> Optional[ActivationCode]:
-        """Получение первого неиспользованного кода для указанной суммы"""
+        """Получение первого неиспользованного кода для указанной суммы (без резервирования, для выдачи - claim_activation_code)"""
         query = select(ActivationCode).where(
             ActivationCode.amount == amount,
             ActivationCode.is_used == False
@@ -180,6 +1207,56 @@ class DatabaseManager:
         result = await session.execute(query)
         return result.scalar_one_or_none()
     
+    @staticmethod
+    async def claim_activation_code(
+        session: AsyncSession,
+        amount: float,
+        attempts: int = 5
+    ) -> Optional[ActivationCode]:
+        """
+        Атомарно забрать первый свободный код для суммы.
+        Один UPDATE ... RETURNING: код помечается использованным в том же
+        выражении, в котором выбирается, поэтому два параллельных одобрения
+        никогда не получат один и тот же код.
+        """
+        candidate = select(ActivationCode.id).where(
+            ActivationCode.amount == amount,
+            ActivationCode.is_used == False
+        ).order_by(ActivationCode.id).limit(1)
+
+        # На PostgreSQL не ждем строки, которые уже забирает другая транзакция
+        if session.bind.dialect.name == "postgresql":
+            candidate = candidate.with_for_update(skip_locked=True)
+
+        query = update(ActivationCode).where(
+            ActivationCode.id == candidate.scalar_subquery(),
+            ActivationCode.is_used == False
+        ).values(
+            is_used=True,
+            issued_at=datetime.utcnow()
+        ).returning(ActivationCode).execution_options(synchronize_session=False)
+
+        for _ in range(attempts):
+            result = await session.execute(query)
+            code = result.scalar_one_or_none()
+
+            if code:
+                await DatabaseManager._commit(session)
+                return code
+
+            # Кандидата забрали между выборкой и обновлением - пробуем снова,
+            # только если свободные коды еще остались
+            remaining = await session.execute(
+                select(func.count(ActivationCode.id)).where(
+                    ActivationCode.amount == amount,
+                    ActivationCode.is_used == False
+                )
+            )
+            if not remaining.scalar():
+                return None
+
+        return None
+
     @staticmethod
     async def get_code_by_value(session: AsyncSession, code_value: str) -> Optional[ActivationCode]:
         """Получение кода по значению"""
@@ -197,7 +1274,7 @@ class DatabaseManager:
         if code:
             code.is_used = True
             code.issued_at = datetime.utcnow()
-            await session.commit()
+            await DatabaseManager._commit(session)
     
     @staticmethod
     async def update_application_status(
@@ -214,8 +1291,14 @@ class DatabaseManager:
         application = result.scalar_one_or_none()
         
         if application:
+            now = datetime.utcnow()
+            
+            # Переносим заявку между строками дневной сводки в той же транзакции
+            if application.status != status:
+                await DatabaseManager._move_daily_stats(session, application, status, now)
+            
             application.status = status
-            application.updated_at = datetime.utcnow()
+            application.updated_at = now
             
             if admin_id:
                 application.admin_id = admin_id
@@ -224,15 +1307,15 @@ class DatabaseManager:
             if activation_code_id:
                 application.activation_code_id = activation_code_id
             
-            await session.commit()
-            await session.refresh(application)
+            # Автосинхронизация с Google Sheets - после коммита, вне транзакции
+            session.info.setdefault(PENDING_SHEETS_SYNC, []).append((application, False))
+            # Заявитель и администратор увидят новый статус без задержки реплики
+            session.info.setdefault(RECENT_WRITERS, []).extend(
+                user_id for user_id in (application.user_id, admin_id) if user_id
+            )
             
-            # Автосинхронизация с Google Sheets
-            try:
-                from google_sheets_integration import auto_sync_application
-                await auto_sync_application(application, is_new=False)
-            except Exception as e:
-                logger.warning(f"Не удалось синхронизировать с Google Sheets: {e}")
+            await DatabaseManager._commit(session)
+            await session.refresh(application)
         
         return application
     
@@ -256,119 +1339,249 @@ class DatabaseManager:
         result = await session.execute(query)
         return result.scalars().all()
     
+    @staticmethod
+    async def get_user_applications_page(
+        session: AsyncSession,
+        user_id: int,
+        cursor: str = None,
+        direction: str = NEXT,
+        limit: int = 10
+    ) -> Page:
+        """Страница заявок пользователя (ApplicationRow с кодами активации), новые сверху"""
+        query = _application_rows_query().where(Application.user_id == user_id)
+        return await fetch_page(
+            session, query, Application.created_at, Application.id,
+            cursor=cursor, direction=direction, limit=limit, row_factory=ApplicationRow
+        )
+    
+    @staticmethod
+    async def get_pending_applications_page(
+        session: AsyncSession,
+        cursor: str = None,
+        direction: str = NEXT,
+        limit: int = 10
+    ) -> Page:
+        """Страница очереди ожидающих заявок (ApplicationRow), старые сверху"""
+        query = _application_rows_query().where(Application.status == "pending")
+        return await fetch_page(
+            session, query, Application.created_at, Application.id,
+            cursor=cursor, direction=direction, limit=limit, descending=False,
+            row_factory=ApplicationRow
+        )
+    
+    @staticmethod
+    async def count_pending_applications(session: AsyncSession) -> int:
+        """Количество ожидающих заявок"""
+        result = await session.execute(
+            select(func.count()).select_from(Application).where(Application.status == "pending")
+        )
+        return result.scalar() or 0
+    
+    @staticmethod
+    async def get_applications_page(
+        session: AsyncSession,
+        since: datetime,
+        cursor: str = None,
+        direction: str = NEXT,
+        limit: int = 15
+    ) -> Page:
+        """Страница всех заявок (ApplicationRow) начиная с since, новые сверху"""
+        query = _application_rows_query().where(Application.created_at >= since)
+        return await fetch_page(
+            session, query, Application.created_at, Application.id,
+            cursor=cursor, direction=direction, limit=limit, row_factory=ApplicationRow
+        )
+    
+    @staticmethod
+    async def get_recent_applications_by_status(
+        session: AsyncSession,
+        status: str,
+        limit: int = 10
+    ) -> List[ApplicationRow]:
+        """Последние обработанные заявки со статусом status (по дате обновления)"""
+        query = _application_rows_query().where(Application.status == status).order_by(
+            Application.updated_at.desc()
+        ).limit(limit)
+        result = await session.execute(query)
+        return [ApplicationRow(*row) for row in result]
+    
+    @staticmethod
+    async def get_application_rows(session: AsyncSession) -> List[ApplicationRow]:
+        """
+        Все заявки для экспорта, новые сверху: одним запросом вместе с кодами
+        активации, без ORM-объектов (на 100k заявок в разы меньше памяти)
+        """
+        query = _application_rows_query().order_by(Application.created_at.desc(), Application.id.desc())
+        result = await session.execute(query)
+        return [ApplicationRow(*row) for row in result]
+    
+    @staticmethod
+    async def get_application_row(session: AsyncSession, application_id: int) -> Optional[ApplicationRow]:
+        """Одна заявка с кодом активации (для синхронизации с Google Sheets)"""
+        result = await session.execute(_application_rows_query().where(Application.id == application_id))
+        row = result.first()
+        return ApplicationRow(*row) if row is not None else None
+    
     @staticmethod
     async def get_application_by_id(session: AsyncSession, application_id: int) -> Optional[Application]:
-        """Получение заявки по ID"""
-        query = select(Application).where(Application.id == application_id)
+        """
+        Получение заявки по ID.
+        Если заявки нет в рабочей таблице - ищется в архиве (ArchivedApplication
+        с теми же полями, только для чтения).
+        Код активации загружается сразу: заявку читают и после закрытия сессии чтения
+        """
+        query = select(Application).options(joinedload(Application.activation_code)).where(
+            Application.id == application_id
+        )
         result = await session.execute(query)
+        application = result.scalar_one_or_none()
+        if application is not None:
+            return application
+        
+        result = await session.execute(
+            select(ArchivedApplication)
+            .options(joinedload(ArchivedApplication.activation_code))
+            .where(ArchivedApplication.id == application_id)
+        )
         return result.scalar_one_or_none()
     
     @staticmethod
-    async def get_stats(session: AsyncSession) -> dict:
-        """Получение статистики"""
-        # Общее количество заявок
-        total_apps_query = select(func.count(Application.id))
-        total_apps_result = await session.execute(total_apps_query)
-        total_apps = total_apps_result.scalar()
-        
-        # Подтвержденные заявки
-        approved_query = select(func.count(Application.id)).where(Application.status == "approved")
-        approved_result = await session.execute(approved_query)
-        approved = approved_result.scalar()
+    def _rate_limit_decision(user_limit: Optional[UserRateLimit], now: datetime) -> RateLimitDecision:
+        """Решение по текущей записи лимитов (без изменения базы)"""
+        if MAX_APPLICATIONS_PER_DAY <= 0:
+            return RateLimitDecision(False, 0, "Прием заявок отключен")
+        if user_limit is None:
+            return RateLimitDecision(True, 0, "")
         
-        # Ожидающие заявки
-        pending_query = select(func.count(Application.id)).where(Application.status == "pending")
-        pending_result = await session.execute(pending_query)
-        pending = pending_result.scalar()
+        day_start = datetime.combine(now.date(), datetime.min.time())
+        reset_date = user_limit.last_reset_date
+        if reset_date is not None and not isinstance(reset_date, datetime):
+            reset_date = datetime.combine(reset_date, datetime.min.time())
         
-        # Коды по суммам
-        codes_query = select(
-            ActivationCode.amount,
-            func.count(ActivationCode.id).label('total'),
-            func.count(ActivationCode.id).filter(ActivationCode.is_used == False).label('available')
-        ).group_by(ActivationCode.amount)
+        # Проверка лимита заявок в день (счетчик сбрасывается в полночь UTC)
+        if reset_date is not None and reset_date >= day_start and (
+            (user_limit.daily_applications or 0) >= MAX_APPLICATIONS_PER_DAY
+        ):
+            retry_after = int((day_start + timedelta(days=1) - now).total_seconds()) + 1
+            return RateLimitDecision(
+                False, retry_after,
+                f"Вы превысили лимит заявок в день ({MAX_APPLICATIONS_PER_DAY}). "
+                f"Попробуйте через {format_retry_after(retry_after)}"
+            )
         
-        codes_result = await session.execute(codes_query)
-        codes_stats = codes_result.all()
+        # Проверка интервала между заявками
+        if user_limit.last_request_time and now - user_limit.last_request_time < RATE_LIMIT_INTERVAL:
+            retry_after = int((user_limit.last_request_time + RATE_LIMIT_INTERVAL - now).total_seconds()) + 1
+            return RateLimitDecision(
+                False, retry_after,
+                f"Слишком частые запросы. Попробуйте через {format_retry_after(retry_after)}"
+            )
         
-        return {
-            'total_applications': total_apps,
-            'approved_applications': approved,
-            'pending_applications': pending,
-            'codes_by_amount': [
-                {
-                    'amount': float(row.amount),
-                    'total': row.total,
-                    'available': row.available
-                }
-                for row in codes_stats
-            ]
-        }
+        return RateLimitDecision(True, 0, "")
     
     @staticmethod
-    async def check_user_rate_limit(session: AsyncSession, user_id: int) -> tuple[bool, str]:
-        """Проверка лимитов пользователя"""
+    async def check_user_rate_limit(session: AsyncSession, user_id: int) -> RateLimitDecision:
+        """
+        Проверка лимитов пользователя без списания (экраны до отправки заявки).
+        Окончательное решение принимает acquire_rate_limit при отправке.
+        """
+        query = select(UserRateLimit).where(UserRateLimit.user_id == user_id)
+        user_limit = (await session.execute(query)).scalar_one_or_none()
+        return DatabaseManager._rate_limit_decision(user_limit, datetime.utcnow())
+    
+    @staticmethod
+    async def acquire_rate_limit(session: AsyncSession, user_id: int) -> RateLimitDecision:
+        """
+        Атомарная проверка и списание лимитов пользователя (в день и интервал).
+        Один условный upsert: счетчик увеличивается, только если оба лимита
+        позволяют, поэтому из двух одновременных заявок пройдет одна.
+        При отказе возвращает время до снятия лимита (retry_after, секунды).
+        """
         now = datetime.utcnow()
-        today = now.date()
+        if MAX_APPLICATIONS_PER_DAY <= 0:
+            return DatabaseManager._rate_limit_decision(None, now)
         
-        # Получаем или создаем запись о лимитах пользователя
-        query = select(UserRateLimit).where(UserRateLimit.user_id == user_id)
-        result = await session.execute(query)
-        user_limit = result.scalar_one_or_none()
-        
-        if not user_limit:
-            user_limit = UserRateLimit(
-                user_id=user_id,
-                last_request_time=None,
-                daily_applications=0,
-                last_reset_date=today
+        day_start = datetime.combine(now.date(), datetime.min.time())
+        new_day = or_(UserRateLimit.last_reset_date.is_(None), UserRateLimit.last_reset_date < day_start)
+        allowed = and_(
+            or_(new_day, UserRateLimit.daily_applications < MAX_APPLICATIONS_PER_DAY),
+            or_(
+                UserRateLimit.last_request_time.is_(None),
+                UserRateLimit.last_request_time <= now - RATE_LIMIT_INTERVAL
             )
-            session.add(user_limit)
-            await session.commit()
-        
-        # Сброс дневного счетчика если новый день
-        # Приводим last_reset_date к типу date для безопасного сравнения
-        reset_date = user_limit.last_reset_date
-        if isinstance(reset_date, datetime):
-            reset_date = reset_date.date()
-        
-        if reset_date < today:
-            user_limit.daily_applications = 0
-            user_limit.last_reset_date = today
-            await session.commit()
+        )
+        values = {
+            "daily_applications": case((new_day, 1), else_=UserRateLimit.daily_applications + 1),
+            "last_request_time": now,
+            "last_reset_date": day_start
+        }
+        dialect = session.bind.dialect.name
         
-        # Проверка лимита заявок в день
-        from config import MAX_APPLICATIONS_PER_DAY
-        if user_limit.daily_applications >= MAX_APPLICATIONS_PER_DAY:
-            return False, f"Вы превысили лимит заявок в день ({MAX_APPLICATIONS_PER_DAY})"
+        if dialect in ("postgresql", "sqlite"):
+            dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            query = dialect_insert(UserRateLimit).values(
+                user_id=user_id, last_request_time=now, daily_applications=1, last_reset_date=day_start
+            )
+            query = query.on_conflict_do_update(
+                index_elements=["user_id"], set_=values, where=allowed
+            ).returning(UserRateLimit.id)
+            acquired = (await session.execute(query)).first() is not None
+        else:
+            # Прочие СУБД: условный UPDATE, а если записи нет - вставка
+            result = await session.execute(
+                update(UserRateLimit).where(UserRateLimit.user_id == user_id, allowed)
+                .values(**values).execution_options(synchronize_session=False)
+            )
+            acquired = result.rowcount > 0
+            if not acquired:
+                exists = await session.execute(select(UserRateLimit.id).where(UserRateLimit.user_id == user_id))
+                if exists.first() is None:
+                    session.add(UserRateLimit(
+                        user_id=user_id, last_request_time=now, daily_applications=1, last_reset_date=day_start
+                    ))
+                    acquired = True
         
-        # Проверка rate limit (1 заявка в минуту)
-        from config import RATE_LIMIT_PER_MINUTE
-        if user_limit.last_request_time:
-            time_diff = now - user_limit.last_request_time
-            if time_diff < timedelta(minutes=1):
-                return False, "Слишком частые запросы. Попробуйте через минуту"
+        if acquired:
+            await DatabaseManager._commit(session)
+            return RateLimitDecision(True, 0, "")
         
-        return True, ""
+        # Отказ: причина и время ожидания по текущей записи
+        query = select(UserRateLimit).where(UserRateLimit.user_id == user_id).execution_options(populate_existing=True)
+        user_limit = (await session.execute(query)).scalar_one_or_none()
+        decision = DatabaseManager._rate_limit_decision(user_limit, now)
+        if decision.allowed:
+            # Запись изменилась между upsert и чтением - считаем запрос слишком частым
+            return RateLimitDecision(False, 1, f"Слишком частые запросы. Попробуйте через {format_retry_after(1)}")
+        return decision
     
     @staticmethod
-    async def update_user_rate_limit(session: AsyncSession, user_id: int) -> None:
-        """Обновление лимитов пользователя"""
-        query = select(UserRateLimit).where(UserRateLimit.user_id == user_id)
-        result = await session.execute(query)
-        user_limit = result.scalar_one_or_none()
+    def _cache_profile(session: AsyncSession, user_id: int, language: str, first_time: bool) -> None:
+        """Записать профиль в кэш (write-through)"""
+        profile_cache.set(user_id, CachedProfile(language, first_time))
+        # Внутри unit of work запись еще может откатиться
+        if session.info.get(UNIT_OF_WORK_KEY):
+            session.info.setdefault(PROFILE_CACHE_KEYS, set()).add(user_id)
+    
+    @staticmethod
+    async def _get_profile(session: AsyncSession, user_id: int) -> Optional[CachedProfile]:
+        """Профиль из кэша, при промахе - из базы. None если профиля нет"""
+        cached = profile_cache.get(user_id)
+        if cached is not MISSING:
+            return cached
         
-        if user_limit:
-            user_limit.last_request_time = datetime.utcnow()
-            user_limit.daily_applications += 1
-            await session.commit()
+        query = select(UserProfile.language, UserProfile.first_time).where(UserProfile.user_id == user_id)
+        row = (await session.execute(query)).first()
+        if not row:
+            return None
+        
+        profile = CachedProfile(row.language, row.first_time)
+        profile_cache.set(user_id, profile)
+        return profile
     
     @staticmethod
     async def get_user_language(session: AsyncSession, user_id: int) -> str:
         """Получение языка пользователя"""
-        query = select(UserProfile).where(UserProfile.user_id == user_id)
-        result = await session.execute(query)
-        profile = result.scalar_one_or_none()
+        profile = await DatabaseManager._get_profile(session, user_id)
         
         if profile:
             return profile.language
@@ -376,15 +1589,14 @@ class DatabaseManager:
         # Создаем профиль по умолчанию
         profile = UserProfile(user_id=user_id, language="ru", first_time=True)
         session.add(profile)
-        await session.commit()
+        await DatabaseManager._commit(session)
+        DatabaseManager._cache_profile(session, user_id, "ru", True)
         return "ru"
     
     @staticmethod
     async def is_first_time(session: AsyncSession, user_id: int) -> bool:
         """Проверка первого запуска пользователя"""
-        query = select(UserProfile).where(UserProfile.user_id == user_id)
-        result = await session.execute(query)
-        profile = result.scalar_one_or_none()
+        profile = await DatabaseManager._get_profile(session, user_id)
         
         if not profile:
             return True  # Новый пользователь
@@ -394,30 +1606,70 @@ class DatabaseManager:
     @staticmethod
     async def mark_not_first_time(session: AsyncSession, user_id: int) -> None:
         """Отметить что пользователь уже не первый раз"""
-        query = select(UserProfile).where(UserProfile.user_id == user_id)
-        result = await session.execute(query)
-        profile = result.scalar_one_or_none()
+        query = update(UserProfile).where(UserProfile.user_id == user_id).values(
+            first_time=False,
+            updated_at=datetime.utcnow()
+        ).returning(UserProfile.language).execution_options(synchronize_session=False)
+        language = (await session.execute(query)).scalar_one_or_none()
         
-        if profile:
-            profile.first_time = False
-            profile.updated_at = datetime.utcnow()
-            await session.commit()
+        if language is not None:
+            await DatabaseManager._commit(session)
+            DatabaseManager._cache_profile(session, user_id, language, False)
     
     @staticmethod
     async def set_user_language(session: AsyncSession, user_id: int, language: str) -> None:
         """Установка языка пользователя"""
-        query = select(UserProfile).where(UserProfile.user_id == user_id)
-        result = await session.execute(query)
-        profile = result.scalar_one_or_none()
+        query = update(UserProfile).where(UserProfile.user_id == user_id).values(
+            language=language,
+            updated_at=datetime.utcnow()
+        ).returning(UserProfile.first_time).execution_options(synchronize_session=False)
+        first_time = (await session.execute(query)).scalar_one_or_none()
         
-        if profile:
-            profile.language = language
-            profile.updated_at = datetime.utcnow()
-        else:
-            profile = UserProfile(user_id=user_id, language=language)
-            session.add(profile)
+        if first_time is None:
+            first_time = True
+            session.add(UserProfile(user_id=user_id, language=language, first_time=first_time))
         
-        await session.commit()
+        await DatabaseManager._commit(session)
+        DatabaseManager._cache_profile(session, user_id, language, first_time)
+    
+    @staticmethod
+    def get_profile_cache_stats() -> dict:
+        """Счетчики кэша профилей (попадания, промахи, размер)"""
+        return profile_cache.stats()
+    
+    @staticmethod
+    def get_read_pool_stats() -> Optional[dict]:
+        """Счетчики пула движка чтения (None - чтение идет через основной движок)"""
+        if read_engine is engine:
+            return None
+        return DatabaseManager.get_pool_stats(read_engine)
+    
+    @staticmethod
+    def get_pool_stats(db_engine: AsyncEngine = None) -> Optional[dict]:
+        """
+        Состояние пула соединений: занято/свободно, переполнение, ожидание.
+        None, если движок работает без пула (SQLite без профиля)
+        """
+        pool = (db_engine or engine).pool
+        if not isinstance(pool, InstrumentedPool):
+            return None
+        return pool.stats()
+    
+    @staticmethod
+    async def _write_audit(session: AsyncSession, model, **values) -> None:
+        """
+        Запись журнала аудита.
+        С буфером: в unit of work запись уходит в буфер после коммита транзакции
+        (откат - записи нет), вне него - сразу. Без буфера - INSERT и коммит, как раньше.
+        """
+        values["timestamp"] = datetime.utcnow()
+        if audit_writer is None:
+            session.add(model(**values))
+            await DatabaseManager._commit(session)
+        elif session.info.get(UNIT_OF_WORK_KEY):
+            session.info.setdefault(PENDING_AUDIT, []).append((model.__table__, values))
+        else:
+            audit_writer.add(model.__table__, values)
     
     @staticmethod
     async def log_transaction(
@@ -428,31 +1680,134 @@ class DatabaseManager:
         comment: str = None
     ) -> None:
         """Логирование транзакции"""
-        transaction = Transaction(
+        await DatabaseManager._write_audit(
+            session, Transaction,
             application_id=application_id,
             action=action,
             admin_id=admin_id,
             comment=comment
         )
-        session.add(transaction)
-        await session.commit()
     
     @staticmethod
     async def get_transaction_history(session: AsyncSession, application_id: int) -> List:
-        """Получение истории транзакций для заявки"""
+        """Получение истории транзакций для заявки (с откатом на архив)"""
         query = select(Transaction).where(
             Transaction.application_id == application_id
         ).order_by(Transaction.timestamp)
         
+        result = await session.execute(query)
+        history = result.scalars().all()
+        if history:
+            return history
+        
+        # Заявка перенесена в архив вместе с историей
+        query = select(ArchivedTransaction).where(
+            ArchivedTransaction.application_id == application_id
+        ).order_by(ArchivedTransaction.timestamp)
         result = await session.execute(query)
         return result.scalars().all()
     
+    @staticmethod
+    async def _archive_batch(session: AsyncSession, cutoff: datetime, batch_size: int) -> int:
+        """Перенести в архив одну порцию закрытых заявок старше cutoff вместе с историей"""
+        result = await session.execute(
+            select(Application.id).where(
+                Application.status.in_(CLOSED_STATUSES),
+                Application.created_at < cutoff
+            ).order_by(Application.id).limit(batch_size)
+        )
+        ids = [row[0] for row in result.all()]
+        if not ids:
+            return 0
+        
+        now = datetime.utcnow()
+        application_columns = [column.name for column in Application.__table__.columns]
+        transaction_columns = [column.name for column in Transaction.__table__.columns]
+        
+        await session.execute(
+            insert(ArchivedApplication).from_select(
+                application_columns + ["archived_at"],
+                select(*Application.__table__.columns, literal(now, DateTime())).where(Application.id.in_(ids))
+            )
+        )
+        await session.execute(
+            insert(ArchivedTransaction).from_select(
+                transaction_columns,
+                select(*Transaction.__table__.columns).where(Transaction.application_id.in_(ids))
+            )
+        )
+        await session.execute(
+            delete(Transaction).where(Transaction.application_id.in_(ids)).execution_options(synchronize_session=False)
+        )
+        await session.execute(
+            delete(Application).where(Application.id.in_(ids)).execution_options(synchronize_session=False)
+        )
+        await DatabaseManager._commit(session)
+        return len(ids)
+    
+    @staticmethod
+    async def archive_closed_applications(
+        session: AsyncSession,
+        older_than_days: int = ARCHIVE_AFTER_DAYS,
+        batch_size: int = ARCHIVE_BATCH_SIZE
+    ) -> int:
+        """
+        Перенести закрытые заявки (approved/rejected/cancelled), созданные
+        раньше older_than_days дней назад, и их историю в архивные таблицы.
+        Каждая порция - отдельная короткая транзакция (на SQLite - через очередь
+        писателя), поэтому перенос не блокирует работу бота.
+        Дневная сводка не меняется: статистика учитывает архив.
+        Возвращает количество перенесенных заявок.
+        """
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        total = 0
+        
+        while True:
+            moved = await DatabaseManager.run_write(
+                session, lambda write_session: DatabaseManager._archive_batch(write_session, cutoff, batch_size)
+            )
+            total += moved
+            if moved < batch_size:
+                break
+        
+        if total:
+            logger.info(f"В архив перенесено заявок: {total} (старше {older_than_days} дн.)")
+        return total
+    
+    @staticmethod
+    async def get_archive_stats(session: AsyncSession) -> dict:
+        """Количество строк в рабочих и архивных таблицах"""
+        counts = {}
+        for name, model in (
+            ("applications", Application),
+            ("transactions", Transaction),
+            ("applications_archive", ArchivedApplication),
+            ("transactions_archive", ArchivedTransaction)
+        ):
+            result = await session.execute(select(func.count()).select_from(model))
+            counts[name] = result.scalar() or 0
+        return counts
+    
+    @staticmethod
+    async def load_admin_roles(session: AsyncSession) -> dict:
+        """Загрузить карту ролей из базы (при старте и при первом обращении)"""
+        while True:
+            version = admin_roles.version
+            result = await session.execute(select(AdminRole.user_id, AdminRole.role))
+            roles = {user_id: role for user_id, role in result.all()}
+            
+            # Пока читали, роли изменились - перечитываем
+            if admin_roles.version == version:
+                admin_roles.replace(roles)
+                return roles
+    
     @staticmethod
     async def add_admin(session: AsyncSession, user_id: int, role: str, added_by: int) -> None:
         """Добавление администратора"""
         admin = AdminRole(user_id=user_id, role=role, added_by=added_by)
         session.add(admin)
-        await session.commit()
+        session.info.setdefault(ADMIN_ROLE_CHANGES, []).append((user_id, role))
+        await DatabaseManager._commit(session)
     
     @staticmethod
     async def remove_admin(session: AsyncSession, user_id: int) -> bool:
@@ -463,18 +1818,18 @@ class DatabaseManager:
         
         if admin:
             await session.delete(admin)
-            await session.commit()
+            session.info.setdefault(ADMIN_ROLE_CHANGES, []).append((user_id, None))
+            await DatabaseManager._commit(session)
             return True
         return False
     
     @staticmethod
     async def get_admin_role(session: AsyncSession, user_id: int) -> Optional[str]:
-        """Получение роли администратора"""
-        query = select(AdminRole).where(AdminRole.user_id == user_id)
-        result = await session.execute(query)
-        admin = result.scalar_one_or_none()
+        """Получение роли администратора (из карты ролей в памяти)"""
+        if not admin_roles.loaded:
+            await DatabaseManager.load_admin_roles(session)
         
-        return admin.role if admin else None
+        return admin_roles.get(user_id)
     
     @staticmethod
     async def is_admin(session: AsyncSession, user_id: int) -> bool:
@@ -495,58 +1850,198 @@ class DatabaseManager:
         result = await session.execute(query)
         return result.scalars().all()
     
+    # ==================== ДНЕВНАЯ СВОДКА ====================
+    
     @staticmethod
-    async def get_stats(session: AsyncSession, days: int = 1) -> dict:
-        """Получение статистики по заявкам"""
-        from_date = datetime.utcnow() - timedelta(days=days)
+    def _processing_minutes(created_at: datetime, updated_at: datetime) -> float:
+        """Время обработки заявки в минутах"""
+        if not created_at or not updated_at:
+            return 0.0
+        return (updated_at - created_at).total_seconds() / 60
+    
+    @staticmethod
+    async def _bump_daily_stats(
+        session: AsyncSession,
+        created_at: datetime,
+        status: str,
+        amount: float,
+        delta: int,
+        minutes: float = 0.0
+    ) -> None:
+        """Атомарно изменить счетчик строки дневной сводки (upsert)"""
+        values = dict(
+            day=created_at.date(),
+            status=status,
+            amount=amount,
+            count=delta,
+            processing_minutes=minutes
+        )
+        dialect = session.bind.dialect.name
+        
+        if dialect in ("postgresql", "sqlite"):
+            dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            query = dialect_insert(DailyStats).values(**values)
+            query = query.on_conflict_do_update(
+                index_elements=["day", "status", "amount"],
+                set_={
+                    "count": DailyStats.count + query.excluded.count,
+                    "processing_minutes": DailyStats.processing_minutes + query.excluded.processing_minutes
+                }
+            )
+            await session.execute(query)
+            return
         
-        # Общее количество заявок
-        total_query = select(func.count(Application.id)).where(
-            Application.created_at >= from_date
+        # Прочие СУБД: обновляем строку, а если ее нет - вставляем
+        result = await session.execute(
+            update(DailyStats).where(
+                DailyStats.day == values["day"],
+                DailyStats.status == status,
+                DailyStats.amount == amount
+            ).values(
+                count=DailyStats.count + delta,
+                processing_minutes=DailyStats.processing_minutes + minutes
+            ).execution_options(synchronize_session=False)
         )
-        total_result = await session.execute(total_query)
-        total = total_result.scalar() or 0
+        if result.rowcount == 0:
+            await session.execute(insert(DailyStats).values(**values))
+    
+    @staticmethod
+    async def _move_daily_stats(
+        session: AsyncSession,
+        application: Application,
+        new_status: str,
+        updated_at: datetime
+    ) -> None:
+        """Перенести заявку из строки старого статуса в строку нового"""
+        old_minutes = 0.0
+        if application.status in PROCESSED_STATUSES:
+            old_minutes = DatabaseManager._processing_minutes(application.created_at, application.updated_at)
+        
+        new_minutes = 0.0
+        if new_status in PROCESSED_STATUSES:
+            new_minutes = DatabaseManager._processing_minutes(application.created_at, updated_at)
         
-        # Подтвержденные
-        confirmed_query = select(func.count(Application.id)).where(
-            Application.created_at >= from_date,
-            Application.status == "confirmed"
+        created_at = application.created_at or updated_at
+        await DatabaseManager._bump_daily_stats(
+            session, created_at, application.status, application.amount, -1, -old_minutes
+        )
+        await DatabaseManager._bump_daily_stats(
+            session, created_at, new_status, application.amount, 1, new_minutes
         )
-        confirmed_result = await session.execute(confirmed_query)
-        confirmed = confirmed_result.scalar() or 0
+    
+    @staticmethod
+    async def rebuild_daily_stats(session: AsyncSession) -> int:
+        """
+        Пересобрать дневную сводку из таблиц applications и applications_archive.
+        Возвращает количество строк сводки.
+        """
+        source = union_all(*(
+            select(model.id, model.created_at, model.updated_at, model.status, model.amount)
+            for model in (Application, ArchivedApplication)
+        )).subquery()
+        
+        if session.bind.dialect.name == "postgresql":
+            duration = func.extract("epoch", source.c.updated_at - source.c.created_at) / 60
+        else:
+            duration = (func.julianday(source.c.updated_at) - func.julianday(source.c.created_at)) * 24 * 60
         
-        # Отклоненные
-        rejected_query = select(func.count(Application.id)).where(
-            Application.created_at >= from_date,
-            Application.status == "rejected"
+        day = func.date(source.c.created_at)
+        query = select(
+            day,
+            source.c.status,
+            source.c.amount,
+            func.count(source.c.id),
+            func.coalesce(func.sum(duration).filter(
+                source.c.status.in_(PROCESSED_STATUSES),
+                source.c.updated_at.isnot(None)
+            ), 0)
+        ).where(
+            source.c.created_at.isnot(None),
+            source.c.status.isnot(None)
+        ).group_by(day, source.c.status, source.c.amount)
+        
+        await session.execute(delete(DailyStats))
+        await session.execute(
+            insert(DailyStats).from_select(
+                ["day", "status", "amount", "count", "processing_minutes"],
+                query
+            )
         )
-        rejected_result = await session.execute(rejected_query)
-        rejected = rejected_result.scalar() or 0
+        await DatabaseManager._commit(session)
         
-        # Ожидают
-        pending_query = select(func.count(Application.id)).where(
-            Application.created_at >= from_date,
-            Application.status == "pending"
+        result = await session.execute(select(func.count(DailyStats.id)))
+        return result.scalar()
+    
+    @staticmethod
+    async def get_stats_windows(session: AsyncSession, windows: dict = None) -> dict:
+        """
+        Статистика по заявкам сразу за несколько периодов.
+        Читается из дневной сводки daily_stats одним запросом: O(дней) строк
+        вместо прохода по applications. Периоды считаются в календарных днях
+        (UTC), 1 - с начала текущих суток.
+        windows: {"имя": дней}, по умолчанию STATS_WINDOWS
+        """
+        windows = windows or STATS_WINDOWS
+        today = datetime.utcnow().date()
+        starts = {name: today - timedelta(days=max(days, 1) - 1) for name, days in windows.items()}
+        week_start = today - timedelta(days=6)
+        
+        columns = []
+        for name, start in starts.items():
+            in_window = DailyStats.day >= start
+            columns.append(func.sum(DailyStats.count).filter(in_window).label(f"{name}__total"))
+            for status in STATS_STATUSES:
+                columns.append(
+                    func.sum(DailyStats.count).filter(in_window, DailyStats.status == status).label(f"{name}__{status}")
+                )
+        
+        # Среднее время обработки за неделю (в минутах)
+        processed = [DailyStats.day >= week_start, DailyStats.status.in_(PROCESSED_STATUSES)]
+        columns.append(func.sum(DailyStats.processing_minutes).filter(*processed).label("processed_minutes"))
+        columns.append(func.sum(DailyStats.count).filter(*processed).label("processed_count"))
+        
+        earliest = min(list(starts.values()) + [week_start])
+        query = select(*columns).where(DailyStats.day >= earliest)
+        row = (await session.execute(query)).one()._mapping
+        
+        stats = {}
+        for name in starts:
+            window = {"total": row[f"{name}__total"] or 0}
+            for status in STATS_STATUSES:
+                window[status] = row[f"{name}__{status}"] or 0
+            # Историческое имя ключа на экранах статистики
+            window["confirmed"] = window["approved"]
+            stats[name] = window
+        
+        processed_count = row["processed_count"] or 0
+        stats["avg_processing_minutes"] = (
+            (row["processed_minutes"] or 0) / processed_count if processed_count > 0 else None
         )
-        pending_result = await session.execute(pending_query)
-        pending = pending_result.scalar() or 0
-        
-        # Коды по суммам
-        codes_by_amount = {}
-        for amount in [10, 25, 50, 100]:
-            codes_query = select(func.count(ActivationCode.id)).where(
-                ActivationCode.amount == amount,
-                ActivationCode.is_used == False
-            )
-            codes_result = await session.execute(codes_query)
-            codes_by_amount[amount] = codes_result.scalar() or 0
+        stats["codes_remaining"] = await DatabaseManager.get_codes_remaining(session)
+        return stats
+    
+    @staticmethod
+    async def get_codes_remaining(session: AsyncSession) -> dict:
+        """Остаток свободных кодов по номиналам из настроек депозита"""
+        amounts = await DatabaseManager.get_deposit_amounts(session)
+        
+        query = select(
+            ActivationCode.amount,
+            func.count(ActivationCode.id)
+        ).where(ActivationCode.is_used == False).group_by(ActivationCode.amount)
+        result = await session.execute(query)
+        available = {float(amount): count for amount, count in result.all()}
+        
+        return {amount: available.get(float(amount), 0) for amount in amounts}
+    
+    @staticmethod
+    async def get_stats(session: AsyncSession, days: int = 1) -> dict:
+        """Получение статистики по заявкам за период"""
+        stats = await DatabaseManager.get_stats_windows(session, {"period": days})
         
         return {
-            "total": total,
-            "confirmed": confirmed,
-            "rejected": rejected,
-            "pending": pending,
-            "codes_remaining": codes_by_amount
+            **stats["period"],
+            "codes_remaining": stats["codes_remaining"]
         }
     
     # ==================== УПРАВЛЕНИЕ КОДАМИ ====================
@@ -556,7 +2051,7 @@ class DatabaseManager:
         """Добавление кода активации"""
         code = ActivationCode(code_value=code_value, amount=amount, is_used=False)
         session.add(code)
-        await session.commit()
+        await DatabaseManager._commit(session)
         await session.refresh(code)
         return code
     
@@ -569,7 +2064,7 @@ class DatabaseManager:
         
         if code:
             await session.delete(code)
-            await session.commit()
+            await DatabaseManager._commit(session)
             return True
         return False
     
@@ -584,30 +2079,70 @@ class DatabaseManager:
         result = await session.execute(query)
         return result.scalars().all()
     
+    @staticmethod
+    async def get_unused_codes_page(
+        session: AsyncSession,
+        cursor: str = None,
+        direction: str = NEXT,
+        limit: int = 20
+    ) -> Page:
+        """Страница свободных кодов по возрастанию номинала"""
+        query = select(ActivationCode).where(ActivationCode.is_used == False)
+        return await fetch_page(
+            session, query, ActivationCode.amount, ActivationCode.id,
+            cursor=cursor, direction=direction, limit=limit, descending=False
+        )
+    
+    @staticmethod
+    async def bulk_insert_codes(session: AsyncSession, codes_data: List[tuple]) -> int:
+        """
+        Пакетная вставка кодов [(code_value, amount), ...] одним
+        INSERT ... ON CONFLICT DO NOTHING. Существующие коды пропускаются.
+        Возвращает количество добавленных кодов.
+        """
+        if not codes_data:
+            return 0
+        
+        rows = [{"code_value": code_value, "amount": amount} for code_value, amount in codes_data]
+        dialect = session.bind.dialect.name
+        
+        if dialect in ("postgresql", "sqlite"):
+            dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+            query = dialect_insert(ActivationCode).values(rows).on_conflict_do_nothing(
+                index_elements=["code_value"]
+            )
+            result = await session.execute(query)
+            await DatabaseManager._commit(session)
+            return result.rowcount
+        
+        # Прочие СУБД: отсеиваем существующие коды одним запросом
+        existing = await session.execute(
+            select(ActivationCode.code_value).where(
+                ActivationCode.code_value.in_([row["code_value"] for row in rows])
+            )
+        )
+        existing_values = set(existing.scalars().all())
+        new_rows = list({
+            row["code_value"]: row for row in rows if row["code_value"] not in existing_values
+        }.values())
+        
+        if new_rows:
+            await session.execute(insert(ActivationCode).values(new_rows))
+            await DatabaseManager._commit(session)
+        return len(new_rows)
+    
     @staticmethod
     async def import_codes_from_list(session: AsyncSession, codes_data: List[tuple]) -> dict:
         """Импорт кодов из списка [(code_value, amount), ...]"""
-        added = 0
-        skipped = 0
-        errors = []
-        
-        for code_value, amount in codes_data:
-            try:
-                # Проверяем, существует ли уже такой код
-                existing = await DatabaseManager.get_code_by_value(session, code_value)
-                if existing:
-                    skipped += 1
-                    continue
-                
-                await DatabaseManager.add_activation_code(session, code_value, float(amount))
-                added += 1
-            except Exception as e:
-                errors.append(f"Ошибка для кода {code_value}: {str(e)}")
+        added = await DatabaseManager.bulk_insert_codes(
+            session,
+            [(code_value, float(amount)) for code_value, amount in codes_data]
+        )
         
         return {
             "added": added,
-            "skipped": skipped,
-            "errors": errors
+            "skipped": len(codes_data) - added,
+            "errors": []
         }
     
     # ==================== ЛОГИРОВАНИЕ ДЕЙСТВИЙ АДМИНИСТРАТОРОВ ====================
@@ -621,14 +2156,13 @@ class DatabaseManager:
         details: str = None
     ) -> None:
         """Логирование действия администратора"""
-        log_entry = AdminLog(
+        await DatabaseManager._write_audit(
+            session, AdminLog,
             admin_id=admin_id,
             action=action,
             target_id=target_id,
             details=details
         )
-        session.add(log_entry)
-        await session.commit()
     
     @staticmethod
     async def get_admin_logs(
@@ -650,16 +2184,44 @@ class DatabaseManager:
         result = await session.execute(query)
         return result.scalars().all()
     
+    @staticmethod
+    async def get_admin_logs_page(
+        session: AsyncSession,
+        days: int = 7,
+        cursor: str = None,
+        direction: str = NEXT,
+        limit: int = 10
+    ) -> Page:
+        """Страница логов действий администраторов за days дней, новые сверху"""
+        from_date = datetime.utcnow() - timedelta(days=days)
+        query = select(AdminLog).where(AdminLog.timestamp >= from_date)
+        return await fetch_page(
+            session, query, AdminLog.timestamp, AdminLog.id,
+            cursor=cursor, direction=direction, limit=limit
+        )
+    
     # ==================== НАСТРОЙКИ БОТА ====================
     
+    @staticmethod
+    async def load_settings(session: AsyncSession) -> dict:
+        """Загрузить настройки из базы (при старте и при первом обращении)"""
+        while True:
+            version = bot_settings.version
+            result = await session.execute(select(BotSettings.setting_key, BotSettings.setting_value))
+            raw = {key: value for key, value in result.all()}
+            
+            # Пока читали, настройки изменились - перечитываем
+            if bot_settings.version == version:
+                bot_settings.replace(raw)
+                return raw
+    
     @staticmethod
     async def get_setting(session: AsyncSession, key: str, default: str = None) -> str:
-        """Получение настройки бота"""
-        query = select(BotSettings).where(BotSettings.setting_key == key)
-        result = await session.execute(query)
-        setting = result.scalar_one_or_none()
+        """Получение настройки бота (из реестра в памяти)"""
+        if not bot_settings.loaded:
+            await DatabaseManager.load_settings(session)
         
-        return setting.setting_value if setting else default
+        return bot_settings.get_raw(key, default)
     
     @staticmethod
     async def set_setting(
@@ -689,7 +2251,8 @@ class DatabaseManager:
             )
             session.add(setting)
         
-        await session.commit()
+        session.info.setdefault(SETTINGS_CHANGES, []).append((key, value))
+        await DatabaseManager._commit(session)
     
     @staticmethod
     async def get_all_settings(session: AsyncSession) -> List:
@@ -701,23 +2264,14 @@ class DatabaseManager:
     @staticmethod
     async def get_deposit_amounts(session: AsyncSession) -> List[int]:
         """Получение номиналов депозита из настроек"""
-        import json
-        amounts_json = await DatabaseManager.get_setting(session, "deposit_amounts")
-        
-        if amounts_json:
-            try:
-                return json.loads(amounts_json)
-            except:
-                pass
+        if not bot_settings.loaded:
+            await DatabaseManager.load_settings(session)
         
-        # По умолчанию
-        from config import DEPOSIT_AMOUNTS
-        return DEPOSIT_AMOUNTS
+        return bot_settings.get("deposit_amounts")
     
     @staticmethod
     async def set_deposit_amounts(session: AsyncSession, amounts: List[int], admin_id: int) -> None:
         """Установка номиналов депозита"""
-        import json
         amounts_json = json.dumps(amounts)
         await DatabaseManager.set_setting(
             session,
@@ -727,12 +2281,87 @@ class DatabaseManager:
             admin_id
         )
 
+async def close_database():
+    """Дописать буфер аудита и очередь записи, закрыть соединения"""
+    if audit_writer is not None:
+        await audit_writer.stop()
+    if sqlite_writer is not None:
+        await sqlite_writer.stop()
+        await writer_engine.dispose()
+    
+    pool_stats = DatabaseManager.get_pool_stats()
+    if pool_stats:
+        logger.info(
+            f"Пул БД: выдано соединений {pool_stats['checkouts']}, "
+            f"ожидание среднее {pool_stats['avg_wait_ms']:.1f} мс, макс. {pool_stats['max_wait_ms']:.1f} мс, "
+            f"таймаутов {pool_stats['timeouts']}"
+        )
+    if read_engine is not engine:
+        await read_engine.dispose()
+    await engine.dispose()
+
+async def archive_loop(interval_hours: float = ARCHIVE_INTERVAL_HOURS):
+    """Фоновая задача: периодический перенос закрытых заявок в архив"""
+    while True:
+        try:
+            async with async_session_maker() as session:
+                await DatabaseManager.archive_closed_applications(session)
+                await DatabaseManager.purge_processed_events(session)
+        except Exception as e:
+            logger.error(f"Ошибка переноса заявок в архив: {e}")
+        
+        await asyncio.sleep(interval_hours * 3600)
+
+async def load_shared_state():
+    """Перечитать из базы роли администраторов и настройки бота"""
+    async with async_session_maker() as session:
+        await DatabaseManager.load_admin_roles(session)
+        await DatabaseManager.load_settings(session)
+
+async def shared_state_loop(interval: float = SHARD_REFRESH_INTERVAL):
+    """
+    Фоновая задача процесса-воркера: роли и настройки, измененные в другом
+    процессе, становятся видны не позже чем через interval секунд
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load_shared_state()
+        except Exception as e:
+            logger.error(f"Ошибка обновления ролей и настроек: {e}")
+
 # Функция для инициализации базы данных
 async def init_database():
     """Инициализация базы данных"""
+    pool_stats = DatabaseManager.get_pool_stats()
+    if pool_stats:
+        logger.info(f"Пул соединений БД: {pool_stats['size']} + до {pool_stats['max_overflow']} временных")
+    if read_engine is not engine:
+        logger.info(f"Чтение списков и статистики: {read_engine.url.render_as_string(hide_password=True)}")
+    
     await create_tables()
     
+    # Миграции схемы (индексы для существующих баз)
+    from migrations import run_migrations
+    await run_migrations(engine)
+    
+    async with async_session_maker() as session:
+        # Карта ролей администраторов для проверки прав без запросов к базе
+        roles = await DatabaseManager.load_admin_roles(session)
+        logger.info(f"Загружено ролей администраторов: {len(roles)}")
+        
+        # Настройки бота в памяти
+        settings = await DatabaseManager.load_settings(session)
+        logger.info(f"Загружено настроек: {len(settings)}")
+        
+        # Первый запуск после обновления: заполняем дневную сводку из истории заявок
+        has_stats = (await session.execute(select(DailyStats.id).limit(1))).first()
+        has_applications = (await session.execute(select(Application.id).limit(1))).first()
+        
+        if has_applications and not has_stats:
+            rows = await DatabaseManager.rebuild_daily_stats(session)
+            logger.info(f"Дневная сводка заполнена из истории заявок: {rows} строк")
+    
     # Создаем директорию для загрузок
-    import os
     from config import UPLOAD_DIR
     os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -0,0 +1,240 @@
+"""
+Хранилище FSM aiogram в базе данных (таблица fsm_states)
+Состояния диалогов и черновики заявок переживают перезапуск и доступны
+любому процессу бота. Изменения копятся в памяти не дольше flush_interval_ms
+и записываются пачкой: несколько set_state/set_data одного апдейта (например,
+state.clear()) превращаются в одну запись. Состояния без изменений дольше
+state_ttl считаются сброшенными и удаляются в фоне.
+"""
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey, DEFAULT_DESTINY
+from loguru import logger
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from config import FSM_FLUSH_INTERVAL_MS, FSM_STATE_TTL, FSM_PURGE_INTERVAL
+from database import FSMStateRecord, SQLiteWriter
+
+# Пустые данные черновика (строка без состояния и с такими данными удаляется при очистке)
+EMPTY_DATA = "{}"
+
+
+def make_key(key: StorageKey) -> str:
+    """Строковый ключ записи: bot:chat:user[:thread][:destiny]"""
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id:
+        parts.append(str(key.thread_id))
+    if key.destiny != DEFAULT_DESTINY:
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+class SQLStorage(BaseStorage):
+    """
+    BaseStorage на SQLAlchemy. Чтения видят еще не записанные изменения
+    (буфер проверяется первым), запись - в фоне пачками; на файловой SQLite
+    пачка идет через очередь единственного писателя.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        writer: Optional[SQLiteWriter] = None,
+        flush_interval_ms: int = FSM_FLUSH_INTERVAL_MS,
+        state_ttl: int = FSM_STATE_TTL,
+        purge_interval: int = FSM_PURGE_INTERVAL
+    ):
+        self.session_maker = session_maker
+        self.writer = writer
+        self.flush_interval = flush_interval_ms / 1000
+        self.state_ttl = state_ttl
+        self.purge_interval = purge_interval
+        # Ключ -> несохраненные поля записи (state и/или data)
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        # Пачка, которая сейчас записывается (видна чтениям до коммита)
+        self.in_flight: Dict[str, Dict[str, Any]] = {}
+        self._has_changes: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._next_purge = 0.0
+        self.changes = 0
+        self.writes = 0
+        self.flushes = 0
+        self.errors = 0
+        self.expired = 0
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._has_changes = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def _change(self, key: StorageKey, field: str, value: Any) -> None:
+        self._ensure_started()
+        self.pending.setdefault(make_key(key), {})[field] = value
+        self.changes += 1
+        self._has_changes.set()
+
+    def _unsaved(self, storage_key: str, field: str) -> tuple:
+        """(True, значение) для несохраненного поля, иначе (False, None)"""
+        for changes in (self.pending, self.in_flight):
+            fields = changes.get(storage_key)
+            if fields is not None and field in fields:
+                return True, fields[field]
+        return False, None
+
+    async def _load(self, storage_key: str) -> Optional[FSMStateRecord]:
+        """Запись из базы или None (нет записи или она устарела)"""
+        async with self.session_maker() as session:
+            result = await session.execute(
+                select(FSMStateRecord).where(FSMStateRecord.storage_key == storage_key)
+            )
+            record = result.scalar_one_or_none()
+        if record is not None and record.updated_at < datetime.utcnow() - timedelta(seconds=self.state_ttl):
+            return None
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._change(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        storage_key = make_key(key)
+        found, state = self._unsaved(storage_key, "state")
+        if found:
+            return state
+        record = await self._load(storage_key)
+        return record.state if record is not None else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self._change(key, "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        storage_key = make_key(key)
+        found, data = self._unsaved(storage_key, "data")
+        if found:
+            return json.loads(data)
+        record = await self._load(storage_key)
+        return json.loads(record.data) if record is not None else {}
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            await self._has_changes.wait()
+            await asyncio.sleep(self.flush_interval)
+
+            errors = self.errors
+            await self.flush()
+            if self.errors > errors and not self._stopping:
+                # База недоступна - повторяем не чаще раза в секунду
+                await asyncio.sleep(1)
+
+            if time.monotonic() >= self._next_purge and not self._stopping:
+                self._next_purge = time.monotonic() + self.purge_interval
+                await self.purge()
+
+    @staticmethod
+    async def _write(session: AsyncSession, batch: Dict[str, Dict[str, Any]]) -> None:
+        """Записать пачку изменений: один многострочный upsert на набор изменяемых полей"""
+        now = datetime.utcnow()
+        groups: Dict[tuple, list] = {}
+        for storage_key, fields in batch.items():
+            row = dict(fields, storage_key=storage_key, updated_at=now)
+            groups.setdefault(tuple(sorted(fields)), []).append(row)
+
+        dialect = session.bind.dialect.name
+        for fields, rows in groups.items():
+            if dialect in ("postgresql", "sqlite"):
+                dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+                query = dialect_insert(FSMStateRecord).values(rows)
+                await session.execute(query.on_conflict_do_update(
+                    index_elements=["storage_key"],
+                    set_={field: query.excluded[field] for field in fields + ("updated_at",)}
+                ))
+                continue
+
+            # Прочие СУБД: обновляем запись, а если ее нет - вставляем
+            for row in rows:
+                values = {field: row[field] for field in fields + ("updated_at",)}
+                result = await session.execute(
+                    update(FSMStateRecord).where(FSMStateRecord.storage_key == row["storage_key"])
+                    .values(**values).execution_options(synchronize_session=False)
+                )
+                if not result.rowcount:
+                    await session.execute(insert(FSMStateRecord).values(**row))
+
+    async def flush(self) -> None:
+        """Записать все накопленные изменения"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        self.in_flight = batch
+        self._has_changes.clear()
+
+        async def job(session: AsyncSession):
+            await self._write(session, batch)
+
+        try:
+            if self.writer is not None:
+                await self.writer.submit(job)
+            else:
+                async with self.session_maker() as session:
+                    await job(session)
+                    await session.commit()
+        except Exception as e:
+            # Более новые изменения тех же ключей остаются поверх возвращенных
+            self.errors += 1
+            for storage_key, fields in batch.items():
+                self.pending[storage_key] = {**fields, **self.pending.get(storage_key, {})}
+            self._has_changes.set()
+            logger.error(f"Ошибка записи состояний FSM ({len(batch)} ключей): {e}")
+            return
+        finally:
+            self.in_flight = {}
+
+        self.writes += len(batch)
+        self.flushes += 1
+
+    async def purge(self) -> int:
+        """Удалить устаревшие и очищенные (без состояния и данных) записи"""
+        deadline = datetime.utcnow() - timedelta(seconds=self.state_ttl)
+        query = delete(FSMStateRecord).where(or_(
+            FSMStateRecord.updated_at < deadline,
+            FSMStateRecord.state.is_(None) & (FSMStateRecord.data == EMPTY_DATA)
+        ))
+        try:
+            if self.writer is not None:
+                result = await self.writer.submit(lambda session: session.execute(query))
+            else:
+                async with self.session_maker() as session:
+                    result = await session.execute(query)
+                    await session.commit()
+        except Exception as e:
+            logger.error(f"Ошибка удаления устаревших состояний FSM: {e}")
+            return 0
+        self.expired += result.rowcount
+        return result.rowcount
+
+    async def close(self) -> None:
+        """Записать буфер и остановить фоновую запись (повторный вызов безопасен)"""
+        if self._task is not None and not self._task.done():
+            self._stopping = True
+            self._has_changes.set()
+            await self._task
+        await self.flush()
+
+    def stats(self) -> dict:
+        """Счетчики хранилища"""
+        return {
+            "pending": len(self.pending),
+            "changes": self.changes,
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "expired": self.expired
+        }
@@ -14,7 +14,7 @@ except ImportError:
     GOOGLE_SHEETS_AVAILABLE = False
     logger.warning("Google Sheets библиотеки не установлены. Установите: pip install gspread google-auth")
 
-from database import Application
+from database import ApplicationRow
 
 # Настройки Google Sheets
 SPREADSHEET_NAME = "Bot Deposits Data"
@@ -127,7 +127,7 @@ class GoogleSheetsExporter:
         
         logger.info("✅ Заголовки настроены")
     
-    def export_applications(self, applications: List[Application]) -> int:
+    def export_applications(self, applications: List[ApplicationRow]) -> int:
         """Экспортировать заявки в Google Sheets"""
         if not applications:
             logger.warning("Нет заявок для экспорта")
@@ -160,9 +160,7 @@ class GoogleSheetsExporter:
             }.get(app.status, app.status)
             
             # Код активации
-            code_value = ""
-            if app.activation_code:
-                code_value = app.activation_code.code_value
+            code_value = app.code_value or ""
             
             # Ссылка на файл в Telegram
             file_url = f"https://api.telegram.org/file/bot<TOKEN>/{app.file_id}" if app.file_id else ""
@@ -236,7 +234,7 @@ class GoogleSheetsExporter:
             }
         })
     
-    def add_application(self, application: Application):
+    def add_application(self, application: ApplicationRow):
         """Добавить одну заявку (для real-time синхронизации)"""
         # Находим последнюю строку
         values = self.worksheet.get_all_values()
@@ -255,9 +253,7 @@ class GoogleSheetsExporter:
             "cancelled": "🚫 Отменена"
         }.get(application.status, application.status)
         
-        code_value = ""
-        if application.activation_code:
-            code_value = application.activation_code.code_value
+        code_value = application.code_value or ""
         
         # Определяем метод оплаты
         payment_method = ""
@@ -301,7 +297,7 @@ class GoogleSheetsExporter:
         self.worksheet.append_row(row)
         logger.info(f"✅ Добавлена заявка #{application.id} в Google Sheets")
     
-    def update_application(self, application: Application):
+    def update_application(self, application: ApplicationRow):
         """Обновить существующую заявку"""
         # Находим строку с этой заявкой
         cell = self.worksheet.find(str(application.id))
@@ -326,9 +322,7 @@ class GoogleSheetsExporter:
             "cancelled": "🚫 Отменена"
         }.get(application.status, application.status)
         
-        code_value = ""
-        if application.activation_code:
-            code_value = application.activation_code.code_value
+        code_value = application.code_value or ""
         
         # Обновляем нужные ячейки
         updates = [
@@ -378,7 +372,7 @@ def get_exporter() -> GoogleSheetsExporter:
 
 
 # Асинхронные обертки
-async def export_applications_to_sheets(applications: List[Application]) -> str:
+async def export_applications_to_sheets(applications: List[ApplicationRow]) -> str:
     """Асинхронный экспорт заявок"""
     loop = asyncio.get_event_loop()
     
@@ -389,7 +383,7 @@ async def export_applications_to_sheets(applications: List[Application]) -> str:
     
     return await loop.run_in_executor(None, _export)
 
-async def sync_application_to_sheets(application: Application, is_new: bool = False):
+async def sync_application_to_sheets(application: ApplicationRow, is_new: bool = False):
     """Синхронизировать одну заявку"""
     if not GOOGLE_SHEETS_AVAILABLE:
         return
@@ -427,7 +421,7 @@ async def get_spreadsheet_url() -> Optional[str]:
 
 
 # Хук для автоматической синхронизации
-async def auto_sync_application(application: Application, is_new: bool = False):
+async def auto_sync_application(application: ApplicationRow, is_new: bool = False):
     """
     Автоматическая синхронизация при создании/обновлении заявки
     Добавьте этот вызов в database.py после создания/обновления заявки
@@ -3,18 +3,21 @@
 детальным просмотром заявок, FAQ и исправлением загрузки файлов
 """
 import os
-import asyncio
+import time
 from datetime import datetime
-from typing import Dict, Any, List
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, PhotoSize, FSInputFile
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.methods import SendDocument, SendMessage, SendPhoto
+from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 
 from config import ADMIN_IDS, UPLOAD_DIR, MAX_FILE_SIZE
-from database import DatabaseManager, async_session_maker
+from database import DatabaseManager, ArchivedApplication, read_session, CLOSED_STATUSES
+from pagination import parse_page_callback
+from sender import send_queue
 
 # Google Sheets интеграция (опционально)
 try:
@@ -49,34 +52,29 @@ class AdminStates(StatesGroup):
 # Роутер
 router = Router()
 
-# Хранилище временных данных и истории навигации
-user_data: Dict[int, Dict[str, Any]] = {}
-user_navigation_history: Dict[int, List[str]] = {}
-user_timeouts: Dict[int, asyncio.Task] = {}
+# Черновик заявки (amount, login), история навигации (history) и срок загрузки
+# файла (upload_deadline) хранятся в данных FSM: процесс не держит состояние пользователей
+# Время на загрузку файла после подтверждения данных (с)
+UPLOAD_TIMEOUT = 900
 
 # Создаем директорию uploads при импорте модуля
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs("logs", exist_ok=True)
 
-def add_to_history(user_id: int, state_name: str):
-    """Добавить состояние в историю навигации"""
-    if user_id not in user_navigation_history:
-        user_navigation_history[user_id] = []
-    user_navigation_history[user_id].append(state_name)
+async def add_to_history(state: FSMContext, *state_names: str):
+    """Добавить состояния в историю навигации"""
+    data = await state.get_data()
+    await state.update_data(history=data.get("history", []) + list(state_names))
 
-def get_previous_state(user_id: int) -> str:
+async def get_previous_state(state: FSMContext) -> str:
     """Получить предыдущее состояние"""
-    if user_id not in user_navigation_history or len(user_navigation_history[user_id]) < 2:
+    history = (await state.get_data()).get("history", [])
+    if len(history) < 2:
         return "menu"
-    # Удаляем текущее состояние
-    user_navigation_history[user_id].pop()
-    # Возвращаем предыдущее
-    return user_navigation_history[user_id].pop() if user_navigation_history[user_id] else "menu"
-
-def clear_history(user_id: int):
-    """Очистить историю навигации"""
-    if user_id in user_navigation_history:
-        user_navigation_history[user_id] = []
+    # Удаляем текущее состояние и возвращаем предыдущее
+    previous = history[-2]
+    await state.update_data(history=history[:-2])
+    return previous
 
 def get_progress_indicator(step: int, total: int = 4) -> str:
     """Индикатор прогресса"""
@@ -85,75 +83,41 @@ def get_progress_indicator(step: int, total: int = 4) -> str:
         indicators[i] = "●"
     return " ".join(indicators) + f" ({step}/{total})"
 
-async def cancel_timeout(user_id: int):
-    """Отменить таймаут для пользователя"""
-    if user_id in user_timeouts:
-        user_timeouts[user_id].cancel()
-        del user_timeouts[user_id]
-
-async def timeout_handler(user_id: int, state: FSMContext, bot, lang: str):
-    """Обработчик таймаута (15 минут)"""
-    await asyncio.sleep(900)  # 15 минут
-    
-    try:
-        await state.clear()
-        if user_id in user_data:
-            del user_data[user_id]
-        clear_history(user_id)
-        
-        await bot.send_message(
-            user_id,
-            get_text("timeout_expired", lang),
-            reply_markup=get_main_menu_keyboard(lang)
-        )
-        
-        logger.info(f"Таймаут для пользователя {user_id}")
-    except Exception as e:
-        logger.error(f"Ошибка в timeout_handler: {e}")
-    finally:
-        if user_id in user_timeouts:
-            del user_timeouts[user_id]
-
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, session: AsyncSession):
     """Команда /start с приветствием и выбором языка для новых пользователей"""
     user_id = message.from_user.id
     user_name = message.from_user.full_name or message.from_user.username or f"User{user_id}"
     
+    # Сбрасывает и состояние, и черновик с историей
     await state.clear()
-    await cancel_timeout(user_id)
-    clear_history(user_id)
     
-    async with async_session_maker() as session:
-        is_first = await DatabaseManager.is_first_time(session, user_id)
+    is_first = await DatabaseManager.is_first_time(session, user_id)
         
-        if is_first:
-            # Первый запуск - показываем приветствие и выбор языка (без кнопки "Назад")
-            welcome_text = TRANSLATIONS["first_welcome"]["multi"]
-            await message.answer(
-                welcome_text,
-                reply_markup=get_language_keyboard(show_back=False),
-                parse_mode="HTML"
-            )
-        else:
-            # Повторный запуск - показываем главное меню
-            lang = await DatabaseManager.get_user_language(session, user_id)
-            await message.answer(
-                get_text("welcome_message", lang, name=user_name),
-                reply_markup=get_main_menu_keyboard(lang)
-            )
+    if is_first:
+        # Первый запуск - показываем приветствие и выбор языка (без кнопки "Назад")
+        welcome_text = TRANSLATIONS["first_welcome"]["multi"]
+        await message.answer(
+            welcome_text,
+            reply_markup=get_language_keyboard(show_back=False),
+            parse_mode="HTML"
+        )
+    else:
+        # Повторный запуск - показываем главное меню
+        lang = await DatabaseManager.get_user_language(session, user_id)
+        await message.answer(
+            get_text("welcome_message", lang, name=user_name),
+            reply_markup=get_main_menu_keyboard(lang)
+        )
 
 @router.message(Command("menu"))
-async def cmd_menu(message: Message, state: FSMContext):
+async def cmd_menu(message: Message, state: FSMContext, session: AsyncSession):
     """Команда /menu"""
     user_id = message.from_user.id
     
     await state.clear()
-    await cancel_timeout(user_id)
-    clear_history(user_id)
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     await message.answer(
         get_text("menu_welcome", lang),
@@ -161,20 +125,15 @@ async def cmd_menu(message: Message, state: FSMContext):
     )
 
 @router.callback_query(F.data == "back_to_menu")
-async def back_to_menu(callback: CallbackQuery, state: FSMContext):
+async def back_to_menu(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Возврат в главное меню"""
     user_id = callback.from_user.id
     
     await callback.answer()  # Отвечаем сразу
     
     await state.clear()
-    await cancel_timeout(user_id)
-    clear_history(user_id)
-    if user_id in user_data:
-        del user_data[user_id]
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     await callback.message.edit_text(
         get_text("menu_welcome", lang),
@@ -182,18 +141,17 @@ async def back_to_menu(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.callback_query(F.data == "go_back")
-async def go_back(callback: CallbackQuery, state: FSMContext):
+async def go_back(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Возврат на предыдущий шаг"""
     user_id = callback.from_user.id
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
-    previous = get_previous_state(user_id)
+    previous = await get_previous_state(state)
     
     if previous == "menu":
         # back_to_menu сам вызовет callback.answer()
-        await back_to_menu(callback, state)
+        await back_to_menu(callback, state, session)
     elif previous == "amount_choice":
         await callback.answer()
         await state.set_state(DepositStates.waiting_for_deposit_choice)
@@ -203,35 +161,32 @@ async def go_back(callback: CallbackQuery, state: FSMContext):
         )
     elif previous == "login":
         await callback.answer()
-        add_to_history(user_id, "amount_choice")
+        await add_to_history(state, "amount_choice")
         await state.set_state(DepositStates.waiting_for_login)
-        amount = user_data.get(user_id, {}).get("amount", 0)
+        amount = (await state.get_data()).get("amount", 0)
         await callback.message.edit_text(
             f"📍 {get_progress_indicator(2)}\n\n" + get_text("enter_login", lang, amount=amount)
         )
 
 @router.callback_query(F.data == "menu_deposit")
-async def menu_deposit(callback: CallbackQuery, state: FSMContext):
+async def menu_deposit(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Начало процесса депозита - выбор метода оплаты"""
     user_id = callback.from_user.id
     
-    async with async_session_maker() as session:
-        can_proceed, error_message = await DatabaseManager.check_user_rate_limit(session, user_id)
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    decision = await DatabaseManager.check_user_rate_limit(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
         
-        if not can_proceed:
-            await callback.answer("❌ Лимит достигнут", show_alert=True)
-            await callback.message.edit_text(
-                f"❌ {error_message}",
-                reply_markup=get_back_button(lang)
-            )
-            return
+    if not decision.allowed:
+        await callback.answer("❌ Лимит достигнут", show_alert=True)
+        await callback.message.edit_text(
+            f"❌ {decision.message}",
+            reply_markup=get_back_button(lang)
+        )
+        return
     
     await callback.answer()
     
-    clear_history(user_id)
-    add_to_history(user_id, "menu")
-    add_to_history(user_id, "payment_method_choice")
+    await state.update_data(history=["menu", "payment_method_choice"])
     
     # Показываем выбор метода оплаты
     text = get_text("payment_method_selection", lang)
@@ -243,15 +198,14 @@ async def menu_deposit(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.callback_query(F.data == "payment_method_manual")
-async def payment_method_manual(callback: CallbackQuery, state: FSMContext):
+async def payment_method_manual(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Ручной способ оплаты - загрузка чека"""
     user_id = callback.from_user.id
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     await callback.answer()
-    add_to_history(user_id, "amount_choice")
+    await add_to_history(state, "amount_choice")
     
     await state.set_state(DepositStates.waiting_for_deposit_choice)
     
@@ -261,132 +215,136 @@ async def payment_method_manual(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.callback_query(F.data == "payment_method_online")
-async def payment_method_online(callback: CallbackQuery):
+async def payment_method_online(callback: CallbackQuery, session: AsyncSession):
     """Онлайн-оплата через SmartGlocal"""
     # Перенаправляем на обработчик онлайн-оплаты из payments_integration
     from payments_integration import start_payment_deposit
-    await start_payment_deposit(callback)
+    await start_payment_deposit(callback, session)
 
 @router.callback_query(F.data == "menu_applications")
-async def menu_applications(callback: CallbackQuery):
-    """Показать заявки пользователя (с возможностью клика)"""
+@router.callback_query(F.data.startswith("myapps:"))
+async def menu_applications(callback: CallbackQuery, session: AsyncSession):
+    """Показать заявки пользователя (с возможностью клика), по 10 на странице"""
     user_id = callback.from_user.id
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
-        applications = await DatabaseManager.get_user_applications(session, user_id)
-        
-        if not applications:
-            await callback.message.edit_text(
-                "📋 У вас пока нет заявок на депозит.",
-                reply_markup=get_back_button(lang)
-            )
-            return
+    direction, cursor = parse_page_callback(callback.data)
+    lang = await DatabaseManager.get_user_language(session, user_id)
+    async with read_session(user_id) as read_db:
+        page = await DatabaseManager.get_user_applications_page(
+            read_db, user_id, cursor=cursor, direction=direction
+        )
         
+    if not page.items:
         await callback.message.edit_text(
-            "📋 Ваши заявки:\n\nНажмите на заявку для просмотра деталей:",
-            reply_markup=get_applications_list_keyboard(applications[:10], lang)
+            "📋 У вас пока нет заявок на депозит.",
+            reply_markup=get_back_button(lang)
         )
+        return
+        
+    await callback.message.edit_text(
+        "📋 Ваши заявки:\n\nНажмите на заявку для просмотра деталей:",
+        reply_markup=get_applications_list_keyboard(page.items, lang, page)
+    )
 
 @router.callback_query(F.data.startswith("view_app_"))
-async def view_application_details(callback: CallbackQuery):
+async def view_application_details(callback: CallbackQuery, session: AsyncSession):
     """Просмотр деталей заявки"""
     user_id = callback.from_user.id
     app_id = int(callback.data.split("_")[2])
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
-        application = await DatabaseManager.get_application_by_id(session, app_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
+    # Только что поданная заявка читается с основной базы (read your own writes)
+    async with read_session(user_id) as read_db:
+        application = await DatabaseManager.get_application_by_id(read_db, app_id)
         
-        if not application or application.user_id != user_id:
-            await callback.answer("❌ Заявка не найдена", show_alert=True)
-            return
+    if not application or application.user_id != user_id:
+        await callback.answer("❌ Заявка не найдена", show_alert=True)
+        return
         
-        await callback.answer()  # Отвечаем после проверки
-        
-        status_emoji = {
-            "pending": "⏳",
-            "approved": "✅",
-            "rejected": "❌",
-            "needs_info": "💬"
-        }.get(application.status, "❓")
-        
-        status_name = {
-            "pending": "Ожидает проверки",
-            "approved": "Подтверждена",
-            "rejected": "Отклонена",
-            "needs_info": "Требует доп. информации"
-        }.get(application.status, "Неизвестно")
-        
-        details_text = (
-            f"{status_emoji} <b>Заявка #{application.id}</b>\n\n"
-            f"💰 <b>Сумма:</b> {application.amount} {application.currency}\n"
-            f"👤 <b>Логин:</b> {application.login}\n"
-            f"📊 <b>Статус:</b> {status_name}\n"
-            f"🕒 <b>Создана:</b> {application.created_at.strftime('%d.%m.%Y %H:%M')}\n"
-        )
+    await callback.answer()  # Отвечаем после проверки
         
-        if application.updated_at and application.updated_at != application.created_at:
-            details_text += f"🔄 <b>Обновлена:</b> {application.updated_at.strftime('%d.%m.%Y %H:%M')}\n"
+    status_emoji = {
+        "pending": "⏳",
+        "approved": "✅",
+        "rejected": "❌",
+        "needs_info": "💬"
+    }.get(application.status, "❓")
         
-        if application.admin_comment:
-            details_text += f"\n💬 <b>Комментарий админа:</b>\n{application.admin_comment}\n"
+    status_name = {
+        "pending": "Ожидает проверки",
+        "approved": "Подтверждена",
+        "rejected": "Отклонена",
+        "needs_info": "Требует доп. информации"
+    }.get(application.status, "Неизвестно")
         
-        if application.activation_code and application.activation_code.code_value:
-            details_text += f"\n🎟️ <b>Код активации:</b> <code>{application.activation_code.code_value}</code>\n"
+    details_text = (
+        f"{status_emoji} <b>Заявка #{application.id}</b>\n\n"
+        f"💰 <b>Сумма:</b> {application.amount} {application.currency}\n"
+        f"👤 <b>Логин:</b> {application.login}\n"
+        f"📊 <b>Статус:</b> {status_name}\n"
+        f"🕒 <b>Создана:</b> {application.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+    )
         
-        # Отправляем файл, если есть
-        try:
-            await callback.bot.send_document(
-                user_id,
-                application.file_id,
-                caption="📎 Ваш загруженный документ"
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось отправить файл: {e}")
+    if application.updated_at and application.updated_at != application.created_at:
+        details_text += f"🔄 <b>Обновлена:</b> {application.updated_at.strftime('%d.%m.%Y %H:%M')}\n"
         
-        await callback.message.edit_text(
-            details_text,
-            reply_markup=get_application_details_keyboard(application, lang),
-            parse_mode="HTML"
+    if application.admin_comment:
+        details_text += f"\n💬 <b>Комментарий админа:</b>\n{application.admin_comment}\n"
+        
+    if application.activation_code and application.activation_code.code_value:
+        details_text += f"\n🎟️ <b>Код активации:</b> <code>{application.activation_code.code_value}</code>\n"
+        
+    # Отправляем файл, если есть
+    try:
+        await callback.bot.send_document(
+            user_id,
+            application.file_id,
+            caption="📎 Ваш загруженный документ"
         )
+    except Exception as e:
+        logger.warning(f"Не удалось отправить файл: {e}")
+        
+    await callback.message.edit_text(
+        details_text,
+        reply_markup=get_application_details_keyboard(application, lang),
+        parse_mode="HTML"
+    )
 
 @router.callback_query(F.data.startswith("cancel_app_"))
-async def cancel_application(callback: CallbackQuery):
+async def cancel_application(callback: CallbackQuery, session: AsyncSession):
     """Отмена заявки пользователем"""
     user_id = callback.from_user.id
     app_id = int(callback.data.split("_")[2])
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
-        application = await DatabaseManager.get_application_by_id(session, app_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
+    application = await DatabaseManager.get_application_by_id(session, app_id)
         
-        if not application or application.user_id != user_id:
-            await callback.answer("❌ Заявка не найдена", show_alert=True)
-            return
+    if not application or application.user_id != user_id:
+        await callback.answer("❌ Заявка не найдена", show_alert=True)
+        return
         
-        if application.status != "pending":
-            await callback.answer("❌ Можно отменить только заявки в статусе 'Ожидает'", show_alert=True)
-            return
+    if application.status != "pending":
+        await callback.answer("❌ Можно отменить только заявки в статусе 'Ожидает'", show_alert=True)
+        return
         
-        # Успешная проверка - отвечаем
+    # Успешная проверка - отвечаем
         
-        # Обновляем статус на "cancelled"
-        await DatabaseManager.update_application_status(
-            session=session,
-            application_id=app_id,
-            status="cancelled",
-            admin_comment="Отменена пользователем"
-        )
+    # Обновляем статус на "cancelled"
+    await DatabaseManager.update_application_status(
+        session=session,
+        application_id=app_id,
+        status="cancelled",
+        admin_comment="Отменена пользователем"
+    )
         
-        await DatabaseManager.log_transaction(
-            session=session,
-            application_id=app_id,
-            action="cancelled",
-            comment=f"Отменена пользователем {user_id}"
-        )
+    await DatabaseManager.log_transaction(
+        session=session,
+        application_id=app_id,
+        action="cancelled",
+        comment=f"Отменена пользователем {user_id}"
+    )
     
     await callback.answer("✅ Заявка отменена", show_alert=True)
     await callback.message.edit_text(
@@ -396,14 +354,13 @@ async def cancel_application(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data == "menu_faq")
-async def menu_faq(callback: CallbackQuery):
+async def menu_faq(callback: CallbackQuery, session: AsyncSession):
     """FAQ раздел"""
     user_id = callback.from_user.id
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     faq_text = (
         "❓ <b>Часто задаваемые вопросы</b>\n\n"
@@ -445,14 +402,13 @@ async def menu_faq(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data == "menu_support")
-async def menu_support(callback: CallbackQuery):
+async def menu_support(callback: CallbackQuery, session: AsyncSession):
     """Меню поддержки"""
     user_id = callback.from_user.id
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     support_text = (
         "💬 <b>Служба поддержки</b>\n\n"
@@ -489,7 +445,7 @@ async def menu_language(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data.startswith("lang_"))
-async def set_language(callback: CallbackQuery):
+async def set_language(callback: CallbackQuery, session: AsyncSession):
     """Установка языка"""
     user_id = callback.from_user.id
     user_name = callback.from_user.full_name or callback.from_user.username or f"User{user_id}"
@@ -497,41 +453,39 @@ async def set_language(callback: CallbackQuery):
     
     # Отвечаем будет в конце с сообщением
     
-    async with async_session_maker() as session:
-        is_first = await DatabaseManager.is_first_time(session, user_id)
-        await DatabaseManager.set_user_language(session, user_id, lang)
+    is_first = await DatabaseManager.is_first_time(session, user_id)
+    await DatabaseManager.set_user_language(session, user_id, lang)
         
-        if is_first:
-            # Первый раз - отмечаем и показываем приветствие с именем
-            await DatabaseManager.mark_not_first_time(session, user_id)
-            
-            welcome_text = get_text("welcome_message", lang, name=user_name)
-            await callback.message.edit_text(
-                welcome_text,
-                reply_markup=get_main_menu_keyboard(lang)
-            )
-            await callback.answer(f"✅ {LANGUAGES[lang]}")
-        else:
-            # Смена языка - просто обновляем меню
-            await callback.message.edit_text(
-                get_text("menu_welcome", lang),
-                reply_markup=get_main_menu_keyboard(lang)
-            )
-            await callback.answer(f"✅ {get_text('menu_change_language', lang)}")
+    if is_first:
+        # Первый раз - отмечаем и показываем приветствие с именем
+        await DatabaseManager.mark_not_first_time(session, user_id)
+        
+        welcome_text = get_text("welcome_message", lang, name=user_name)
+        await callback.message.edit_text(
+            welcome_text,
+            reply_markup=get_main_menu_keyboard(lang)
+        )
+        await callback.answer(f"✅ {LANGUAGES[lang]}")
+    else:
+        # Смена языка - просто обновляем меню
+        await callback.message.edit_text(
+            get_text("menu_welcome", lang),
+            reply_markup=get_main_menu_keyboard(lang)
+        )
+        await callback.answer(f"✅ {get_text('menu_change_language', lang)}")
 
 @router.callback_query(F.data.startswith("amount_"))
-async def process_amount_selection(callback: CallbackQuery, state: FSMContext):
+async def process_amount_selection(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Выбор суммы депозита"""
     user_id = callback.from_user.id
     amount_str = callback.data.split("_")[1]
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     if amount_str == "custom":
-        add_to_history(user_id, "custom_amount")
+        await add_to_history(state, "custom_amount")
         await state.set_state(DepositStates.waiting_for_custom_amount)
         await callback.message.edit_text(
             f"📍 {get_progress_indicator(1)}\n\n" + get_text("enter_custom_amount", lang),
@@ -540,8 +494,8 @@ async def process_amount_selection(callback: CallbackQuery, state: FSMContext):
     else:
         try:
             amount = float(amount_str)
-            user_data[user_id] = {"amount": amount}
-            add_to_history(user_id, "login")
+            await state.update_data(amount=amount)
+            await add_to_history(state, "login")
             await state.set_state(DepositStates.waiting_for_login)
             
             await callback.message.edit_text(
@@ -551,12 +505,11 @@ async def process_amount_selection(callback: CallbackQuery, state: FSMContext):
             await callback.answer(get_text("error_invalid_amount", lang), show_alert=True)
 
 @router.message(StateFilter(DepositStates.waiting_for_custom_amount))
-async def process_custom_amount(message: Message, state: FSMContext):
+async def process_custom_amount(message: Message, state: FSMContext, session: AsyncSession):
     """Обработка пользовательской суммы"""
     user_id = message.from_user.id
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     try:
         amount = float(message.text.strip().replace(",", "."))
@@ -569,8 +522,8 @@ async def process_custom_amount(message: Message, state: FSMContext):
             await message.answer("❌ Максимальная сумма: 10,000 USD")
             return
         
-        user_data[user_id] = {"amount": amount}
-        add_to_history(user_id, "login")
+        await state.update_data(amount=amount)
+        await add_to_history(state, "login")
         await state.set_state(DepositStates.waiting_for_login)
         
         await message.answer(
@@ -581,13 +534,12 @@ async def process_custom_amount(message: Message, state: FSMContext):
         await message.answer(get_text("error_invalid_amount", lang))
 
 @router.message(StateFilter(DepositStates.waiting_for_login))
-async def process_login_input(message: Message, state: FSMContext):
+async def process_login_input(message: Message, state: FSMContext, session: AsyncSession):
     """Обработка ввода логина"""
     user_id = message.from_user.id
     login = message.text.strip()
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     if len(login) < 3:
         await message.answer("❌ Логин должен содержать минимум 3 символа")
@@ -597,59 +549,49 @@ async def process_login_input(message: Message, state: FSMContext):
         await message.answer("❌ Логин слишком длинный (максимум 50 символов)")
         return
     
-    user_data[user_id]["login"] = login
-    add_to_history(user_id, "confirmation")
+    await state.update_data(login=login)
+    await add_to_history(state, "confirmation")
     await state.set_state(DepositStates.waiting_for_confirmation)
     
     # Показываем подтверждение данных
     await message.answer(
         f"📍 {get_progress_indicator(3)}\n\n" + 
         get_text("confirm_data", lang,
-                amount=user_data[user_id]["amount"],
+                amount=(await state.get_data()).get("amount", 0),
                 login=login),
         reply_markup=get_confirm_data_keyboard(lang)
     )
 
 @router.callback_query(F.data == "confirm_yes")
-async def confirm_data_yes(callback: CallbackQuery, state: FSMContext):
+async def confirm_data_yes(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Подтверждение данных - переход к загрузке файла"""
     user_id = callback.from_user.id
     
     await callback.answer()  # Отвечаем сразу
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
-    add_to_history(user_id, "upload")
+    await add_to_history(state, "upload")
     await state.set_state(DepositStates.waiting_for_payment_file)
     
-    # Запускаем таймаут 15 минут
-    timeout_task = asyncio.create_task(
-        timeout_handler(user_id, state, callback.bot, lang)
-    )
-    user_timeouts[user_id] = timeout_task
+    # Файл нужно загрузить за 15 минут (проверяется при загрузке)
+    await state.update_data(upload_deadline=time.time() + UPLOAD_TIMEOUT)
     
     await callback.message.edit_text(
         f"📍 {get_progress_indicator(4)}\n\n" + get_text("upload_file", lang)
     )
 
 @router.callback_query(F.data == "confirm_change")
-async def confirm_data_change(callback: CallbackQuery, state: FSMContext):
+async def confirm_data_change(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Изменение данных - возврат к выбору суммы"""
     user_id = callback.from_user.id
     
     await callback.answer()  # Отвечаем сразу
     
-    if user_id in user_data:
-        del user_data[user_id]
-    
-    # Очищаем историю до выбора суммы
-    clear_history(user_id)
-    add_to_history(user_id, "menu")
-    add_to_history(user_id, "amount_choice")
+    # Сбрасываем черновик и историю до выбора суммы
+    await state.set_data({"history": ["menu", "amount_choice"]})
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     await state.set_state(DepositStates.waiting_for_deposit_choice)
     
@@ -659,16 +601,23 @@ async def confirm_data_change(callback: CallbackQuery, state: FSMContext):
     )
 
 @router.message(StateFilter(DepositStates.waiting_for_payment_file))
-async def process_payment_file(message: Message, state: FSMContext):
+async def process_payment_file(message: Message, state: FSMContext, session: AsyncSession):
     """Обработка загрузки файла подтверждения"""
     user_id = message.from_user.id
     
     logger.info(f"Пользователь {user_id} отправил файл для заявки")
     
-    await cancel_timeout(user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
+    draft = await state.get_data()
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    if time.time() > draft.get("upload_deadline", float("inf")):
+        logger.info(f"Таймаут для пользователя {user_id}")
+        await state.clear()
+        await message.answer(
+            get_text("timeout_expired", lang),
+            reply_markup=get_main_menu_keyboard(lang)
+        )
+        return
     
     # Получаем файл
     file_to_download = None
@@ -716,9 +665,9 @@ async def process_payment_file(message: Message, state: FSMContext):
         
         logger.info(f"✅ Файл успешно загружен: {file_path}")
         
-        # Проверяем данные пользователя
-        if user_id not in user_data:
-            logger.error(f"Данные пользователя {user_id} не найдены в user_data")
+        # Проверяем черновик заявки
+        if "amount" not in draft or "login" not in draft:
+            logger.error(f"Черновик заявки пользователя {user_id} не найден в данных FSM")
             await message.answer(
                 "❌ Ошибка: данные заявки не найдены. Пожалуйста, начните заново.",
                 reply_markup=get_main_menu_keyboard(lang)
@@ -728,36 +677,52 @@ async def process_payment_file(message: Message, state: FSMContext):
         
         logger.info(f"Создаем заявку для пользователя {user_id}")
         
-        # Создаем заявку
-        async with async_session_maker() as session:
+        user_name = message.from_user.full_name or message.from_user.username or f"User{user_id}"
+        login = draft["login"]
+        amount = draft["amount"]
+        
+        async def submit_application(write_session: AsyncSession):
+            # Списываем лимит атомарно вместе с созданием заявки
+            decision = await DatabaseManager.acquire_rate_limit(write_session, user_id)
+            if not decision.allowed:
+                return decision, None
+            
+            # Создаем заявку
             application = await DatabaseManager.create_application(
-                session=session,
+                session=write_session,
                 user_id=user_id,
-                user_name=message.from_user.full_name or message.from_user.username or f"User{user_id}",
-                login=user_data[user_id]["login"],
-                amount=user_data[user_id]["amount"],
+                user_name=user_name,
+                login=login,
+                amount=amount,
                 file_id=file_to_download.file_id
             )
             
-            logger.info(f"✅ Заявка #{application.id} создана в базе данных")
-            
             # Логируем создание
             await DatabaseManager.log_transaction(
-                session=session,
+                session=write_session,
                 application_id=application.id,
                 action="created",
                 comment=f"Создана пользователем {user_id}"
             )
             
-            # Обновляем лимиты
-            await DatabaseManager.update_user_rate_limit(session, user_id)
-            
-            lang = await DatabaseManager.get_user_language(session, user_id)
+            return decision, application
+        
+        # Фиксируем заявку одним коммитом до уведомлений
+        decision, application = await DatabaseManager.run_write(session, submit_application)
+        
+        if not decision.allowed:
+            logger.info(f"Заявка пользователя {user_id} отклонена лимитером: {decision.message}")
+            await message.answer(f"❌ {decision.message}", reply_markup=get_main_menu_keyboard(lang))
+            await state.clear()
+            return
+        
+        logger.info(f"✅ Заявка #{application.id} создана в базе данных")
         
         # Синхронизируем с Google Sheets (если включено)
         if GOOGLE_SHEETS_ENABLED:
             try:
-                await sync_application_to_sheets(application, is_new=True)
+                row = await DatabaseManager.get_application_row(session, application.id)
+                await sync_application_to_sheets(row, is_new=True)
                 logger.info(f"✅ Заявка #{application.id} синхронизирована с Google Sheets")
             except Exception as e:
                 logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
@@ -765,13 +730,9 @@ async def process_payment_file(message: Message, state: FSMContext):
         logger.info(f"Отправляем уведомления админам о заявке #{application.id}")
         
         # Уведомляем админов
-        await notify_admins(message.bot, application, file_to_download.file_id)
-        
-        # Очищаем данные
-        if user_id in user_data:
-            del user_data[user_id]
-        clear_history(user_id)
+        notify_admins(message.bot, application, file_to_download.file_id, lang)
         
+        # Очищаем черновик и историю
         await state.clear()
         
         logger.info(f"Отправляем подтверждение пользователю {user_id}")
@@ -788,16 +749,14 @@ async def process_payment_file(message: Message, state: FSMContext):
         
     except Exception as e:
         logger.error(f"Ошибка при обработке файла: {e}", exc_info=True)
+        await session.rollback()
         await message.answer(
             f"❌ Произошла ошибка при загрузке файла.\n\nОшибка: {str(e)}\n\nПопробуйте:\n• Отправить файл как документ\n• Использовать другой формат\n• Уменьшить размер файла",
             reply_markup=get_main_menu_keyboard(lang)
         )
 
-async def notify_admins(bot, application, file_id):
-    """Уведомление админов о новой заявке"""
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, application.user_id)
-    
+def notify_admins(bot, application, file_id, lang: str = "ru"):
+    """Уведомление админов о новой заявке (ставится в очередь отправки)"""
     notification_text = get_text("admin_new_application", lang,
                                 app_id=application.id,
                                 user_name=application.user_name,
@@ -807,39 +766,32 @@ async def notify_admins(bot, application, file_id):
                                 time=application.created_at.strftime('%d.%m.%Y %H:%M'))
     
     for admin_id in ADMIN_IDS:
-        try:
-            # Отправляем уведомление с клавиатурой
-            msg = await bot.send_message(
-                admin_id,
-                notification_text,
+        # Уведомление с клавиатурой
+        send_queue.submit(
+            bot,
+            SendMessage(
+                chat_id=admin_id,
+                text=notification_text,
                 reply_markup=get_admin_keyboard(application.id, lang),
                 parse_mode="HTML"
+            ),
+            description=f"уведомление о заявке #{application.id} админу {admin_id}"
+        )
+        
+        # Файл отдельным сообщением; если не отправился как документ - как фото
+        if file_id:
+            send_queue.submit(
+                bot,
+                SendDocument(chat_id=admin_id, document=file_id),
+                fallback=SendPhoto(chat_id=admin_id, photo=file_id),
+                description=f"файл заявки #{application.id} админу {admin_id}"
             )
-            
-            # Отправляем файл админу отдельным сообщением
-            if file_id:
-                try:
-                    await bot.send_document(admin_id, file_id)
-                    logger.info(f"Файл отправлен админу {admin_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка отправки файла админу {admin_id}: {e}")
-                    try:
-                        # Попробуем отправить как фото, если это изображение
-                        await bot.send_photo(admin_id, file_id)
-                        logger.info(f"Фото отправлено админу {admin_id}")
-                    except Exception as e2:
-                        logger.error(f"Ошибка отправки фото админу {admin_id}: {e2}")
-            
-            logger.info(f"Уведомление отправлено админу {admin_id}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
 
 @router.callback_query(F.data.startswith("admin_"))
-async def process_admin_action(callback: CallbackQuery):
+async def process_admin_action(callback: CallbackQuery, session: AsyncSession):
     """Обработка админских действий"""
     # Проверяем права администратора через базу данных
-    async with async_session_maker() as session:
-        is_admin = await DatabaseManager.is_admin(session, callback.from_user.id)
+    is_admin = await DatabaseManager.is_admin(session, callback.from_user.id)
     
     # Также проверяем в config.ADMIN_IDS (обратная совместимость)
     if not is_admin and callback.from_user.id not in ADMIN_IDS:
@@ -862,189 +814,226 @@ async def process_admin_action(callback: CallbackQuery):
         await callback.answer("❌ Неверный формат callback", show_alert=True)
         return
     
-    async with async_session_maker() as session:
-        application = await DatabaseManager.get_application_by_id(session, application_id)
+    # Одно решение на заявку: одобрение и отклонение делят ключ, поэтому из двух
+    # одновременных решений разных админов (или двойного нажатия) пройдет одно
+    action_key = f"application:{application_id}:decision"
+    if action in ("approve", "reject") and not DatabaseManager.claim_recent_key(session, action_key):
+        await callback.answer("⏳ Заявка уже обрабатывается", show_alert=True)
+        return
+    
+    application = await DatabaseManager.get_application_by_id(session, application_id)
         
-        if not application:
-            await callback.answer("❌ Заявка не найдена", show_alert=True)
-            return
+    if not application:
+        DatabaseManager.release_recent_key(session, action_key)
+        await callback.answer("❌ Заявка не найдена", show_alert=True)
+        return
+    
+    # Архивные заявки закрыты и доступны только для просмотра
+    if action in ("approve", "reject") and isinstance(application, ArchivedApplication):
+        DatabaseManager.release_recent_key(session, action_key)
+        await callback.answer("📦 Заявка в архиве и уже обработана", show_alert=True)
+        return
+    
+    # Решение уже принято (в том числе другим администратором)
+    if action in ("approve", "reject") and application.status in CLOSED_STATUSES:
+        DatabaseManager.release_recent_key(session, action_key)
+        await callback.answer(f"ℹ️ Заявка #{application_id} уже обработана ({application.status})", show_alert=True)
+        return
         
-        user_lang = await DatabaseManager.get_user_language(session, application.user_id)
+    user_lang = await DatabaseManager.get_user_language(session, application.user_id)
         
-        if action == "approve":
-            await callback.answer("✅ Одобряю заявку...")
-            
-            # Подтверждение
-            code = await DatabaseManager.get_activation_code(session, float(application.amount))
-            
-            if not code:
-                await callback.message.edit_text(
-                    f"⚠️ Коды для {application.amount} USD закончились!"
-                )
-                return
-            
-            await DatabaseManager.update_application_status(
-                session=session,
-                application_id=application_id,
-                status="approved",
-                admin_id=callback.from_user.id,
-                activation_code_id=code.id
-            )
-            
-            await DatabaseManager.mark_code_as_used(session, code.id)
-            
-            # Логируем
-            await DatabaseManager.log_transaction(
-                session=session,
-                application_id=application_id,
-                action="approved",
-                admin_id=callback.from_user.id,
-                comment=f"Выдан код {code.code_value}"
+    if action == "approve":
+        await callback.answer("✅ Одобряю заявку...")
+        
+        # Подтверждение: код забирается атомарно, без гонки между админами
+        code = await DatabaseManager.claim_activation_code(session, float(application.amount))
+        
+        if not code:
+            # Одобрение не состоялось - после пополнения кодов его можно повторить
+            DatabaseManager.release_recent_key(session, action_key)
+            await callback.message.edit_text(
+                f"⚠️ Коды для {application.amount} USD закончились!"
             )
-            
-            # Синхронизируем с Google Sheets
-            if GOOGLE_SHEETS_ENABLED:
-                try:
-                    # Получаем обновленную заявку
-                    updated_app = await DatabaseManager.get_application_by_id(session, application_id)
-                    await sync_application_to_sheets(updated_app, is_new=False)
-                    logger.info(f"✅ Заявка #{application_id} (одобрена) синхронизирована с Google Sheets")
-                except Exception as e:
-                    logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
-            
-            # Уведомляем пользователя
+            return
+        
+        # Страховка на случай повтора в другом процессе: уникальный ключ в той же транзакции
+        if not await DatabaseManager.record_processed_event(session, action_key):
+            # Решение уже принято - возвращаем забранный код (откат освобождает и ключ)
+            await session.rollback()
+            await callback.message.edit_text(f"ℹ️ Заявка #{application_id} уже обработана")
+            return
+        
+        await DatabaseManager.update_application_status(
+            session=session,
+            application_id=application_id,
+            status="approved",
+            admin_id=callback.from_user.id,
+            activation_code_id=code.id
+        )
+        
+        # Логируем
+        await DatabaseManager.log_transaction(
+            session=session,
+            application_id=application_id,
+            action="approved",
+            admin_id=callback.from_user.id,
+            comment=f"Выдан код {code.code_value}"
+        )
+        
+        # Фиксируем выдачу кода до уведомления пользователя
+        await session.commit()
+        
+        # Синхронизируем с Google Sheets
+        if GOOGLE_SHEETS_ENABLED:
             try:
-                await callback.bot.send_message(
-                    application.user_id,
-                    get_text("status_approved", user_lang,
-                            app_id=application_id,
-                            code=code.code_value),
-                    reply_markup=get_main_menu_keyboard(user_lang)
-                )
+                # Получаем обновленную заявку вместе с кодом
+                updated_app = await DatabaseManager.get_application_row(session, application_id)
+                await sync_application_to_sheets(updated_app, is_new=False)
+                logger.info(f"✅ Заявка #{application_id} (одобрена) синхронизирована с Google Sheets")
             except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-            
-            await callback.message.edit_text(
-                f"✅ Заявка #{application_id} подтверждена!\n"
-                f"🎟️ Код: {code.code_value}"
-            )
-            
-        elif action == "reject":
-            await callback.answer("❌ Отклоняю заявку...")
-            
-            # Отклонение
-            await DatabaseManager.update_application_status(
-                session=session,
-                application_id=application_id,
-                status="rejected",
-                admin_id=callback.from_user.id,
-                admin_comment="Отклонено администратором"
-            )
-            
-            await DatabaseManager.log_transaction(
-                session=session,
-                application_id=application_id,
-                action="rejected",
-                admin_id=callback.from_user.id
-            )
-            
-            # Синхронизируем с Google Sheets
-            if GOOGLE_SHEETS_ENABLED:
-                try:
-                    # Получаем обновленную заявку
-                    updated_app = await DatabaseManager.get_application_by_id(session, application_id)
-                    await sync_application_to_sheets(updated_app, is_new=False)
-                    logger.info(f"✅ Заявка #{application_id} (отклонена) синхронизирована с Google Sheets")
-                except Exception as e:
-                    logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
-            
-            # Уведомляем пользователя с предложением повторить
+                logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
+        
+        # Уведомляем пользователя (код не теряется при flood control: очередь повторит)
+        send_queue.submit(
+            callback.bot,
+            SendMessage(
+                chat_id=application.user_id,
+                text=get_text("status_approved", user_lang,
+                              app_id=application_id,
+                              code=code.code_value),
+                reply_markup=get_main_menu_keyboard(user_lang)
+            ),
+            description=f"код по заявке #{application_id} пользователю {application.user_id}"
+        )
+        
+        await callback.message.edit_text(
+            f"✅ Заявка #{application_id} подтверждена!\n"
+            f"🎟️ Код: {code.code_value}"
+        )
+        
+    elif action == "reject":
+        await callback.answer("❌ Отклоняю заявку...")
+        
+        if not await DatabaseManager.record_processed_event(session, action_key):
+            await callback.message.edit_text(f"ℹ️ Заявка #{application_id} уже обработана")
+            return
+        
+        # Отклонение
+        await DatabaseManager.update_application_status(
+            session=session,
+            application_id=application_id,
+            status="rejected",
+            admin_id=callback.from_user.id,
+            admin_comment="Отклонено администратором"
+        )
+        
+        await DatabaseManager.log_transaction(
+            session=session,
+            application_id=application_id,
+            action="rejected",
+            admin_id=callback.from_user.id
+        )
+        
+        await session.commit()
+        
+        # Синхронизируем с Google Sheets
+        if GOOGLE_SHEETS_ENABLED:
             try:
-                await callback.bot.send_message(
-                    application.user_id,
-                    get_text("status_rejected", user_lang,
-                            app_id=application_id,
-                            reason="Проверка не пройдена"),
-                    reply_markup=get_retry_keyboard(user_lang)
-                )
+                # Получаем обновленную заявку вместе с кодом
+                updated_app = await DatabaseManager.get_application_row(session, application_id)
+                await sync_application_to_sheets(updated_app, is_new=False)
+                logger.info(f"✅ Заявка #{application_id} (отклонена) синхронизирована с Google Sheets")
             except Exception as e:
-                logger.error(f"Ошибка уведомления пользователя: {e}")
-            
-            await callback.message.edit_text(f"❌ Заявка #{application_id} отклонена")
+                logger.error(f"Ошибка синхронизации с Google Sheets: {e}")
         
-        elif action == "history":
-            # История заявки
-            await callback.answer("📋 Загружаю историю...")
-            
-            history = await DatabaseManager.get_transaction_history(session, application_id)
-            
-            history_text = f"📋 История заявки #{application_id}:\n\n"
-            
-            for transaction in history:
-                history_text += (
-                    f"• {transaction.action.upper()}\n"
-                    f"  Время: {transaction.timestamp.strftime('%d.%m %H:%M')}\n"
-                )
-                if transaction.admin_id:
-                    history_text += f"  Админ: {transaction.admin_id}\n"
-                if transaction.comment:
-                    history_text += f"  Комментарий: {transaction.comment}\n"
-                history_text += "\n"
-            
-            await callback.answer(history_text[:4000], show_alert=True)
-        else:
-            # Неизвестное действие
-            await callback.answer("❓ Неизвестное действие", show_alert=True)
+        # Уведомляем пользователя с предложением повторить
+        send_queue.submit(
+            callback.bot,
+            SendMessage(
+                chat_id=application.user_id,
+                text=get_text("status_rejected", user_lang,
+                              app_id=application_id,
+                              reason="Проверка не пройдена"),
+                reply_markup=get_retry_keyboard(user_lang)
+            ),
+            description=f"отклонение заявки #{application_id} пользователю {application.user_id}"
+        )
+        
+        await callback.message.edit_text(f"❌ Заявка #{application_id} отклонена")
+        
+    elif action == "history":
+        # История заявки
+        await callback.answer("📋 Загружаю историю...")
+        
+        history = await DatabaseManager.get_transaction_history(session, application_id)
+        
+        history_text = f"📋 История заявки #{application_id}:\n\n"
+        
+        for transaction in history:
+            history_text += (
+                f"• {transaction.action.upper()}\n"
+                f"  Время: {transaction.timestamp.strftime('%d.%m %H:%M')}\n"
+            )
+            if transaction.admin_id:
+                history_text += f"  Админ: {transaction.admin_id}\n"
+            if transaction.comment:
+                history_text += f"  Комментарий: {transaction.comment}\n"
+            history_text += "\n"
+        
+        await callback.answer(history_text[:4000], show_alert=True)
+    else:
+        # Неизвестное действие
+        await callback.answer("❓ Неизвестное действие", show_alert=True)
 
 @router.callback_query(F.data == "retry_yes")
-async def retry_application(callback: CallbackQuery, state: FSMContext):
+async def retry_application(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Повторная попытка после отклонения"""
     # callback.answer() будет вызван в menu_deposit
-    await menu_deposit(callback, state)
+    await menu_deposit(callback, state, session)
 
 @router.callback_query(F.data == "retry_no")
-async def retry_no(callback: CallbackQuery, state: FSMContext):
+async def retry_no(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     """Отказ от повторной попытки"""
     # callback.answer() будет вызван в back_to_menu
-    await back_to_menu(callback, state)
+    await back_to_menu(callback, state, session)
 
 @router.message(Command("status"))
-async def cmd_status(message: Message):
+async def cmd_status(message: Message, session: AsyncSession):
     """Команда /status"""
     user_id = message.from_user.id
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
-        applications = await DatabaseManager.get_user_applications(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
+    # Последние 5 заявок; полный список - в меню "Мои заявки"
+    async with read_session(user_id) as read_db:
+        page = await DatabaseManager.get_user_applications_page(read_db, user_id, limit=5)
         
-        if not applications:
-            await message.answer(
-                "📋 У вас нет заявок.",
-                reply_markup=get_main_menu_keyboard(lang)
-            )
-            return
+    if not page.items:
+        await message.answer(
+            "📋 У вас нет заявок.",
+            reply_markup=get_main_menu_keyboard(lang)
+        )
+        return
         
-        for app in applications[:5]:
-            if app.status == "approved" and app.activation_code:
-                text = get_text("status_approved", lang,
-                              app_id=app.id,
-                              code=app.activation_code.code_value)
-            elif app.status == "rejected":
-                text = get_text("status_rejected", lang,
-                              app_id=app.id,
-                              reason=app.admin_comment or "Не указана")
-            else:
-                text = get_text("status_pending", lang, app_id=app.id)
-            
-            await message.answer(text)
+    for app in page.items:
+        if app.status == "approved" and app.code_value:
+            text = get_text("status_approved", lang,
+                          app_id=app.id,
+                          code=app.code_value)
+        elif app.status == "rejected":
+            text = get_text("status_rejected", lang,
+                          app_id=app.id,
+                          reason=app.admin_comment or "Не указана")
+        else:
+            text = get_text("status_pending", lang, app_id=app.id)
+        
+        await message.answer(text)
 
 @router.message(Command("help"))
-async def cmd_help(message: Message):
+async def cmd_help(message: Message, session: AsyncSession):
     """Команда /help"""
     user_id = message.from_user.id
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     help_text = (
         "🤖 <b>Справка по боту</b>\n\n"
@@ -1072,14 +1061,13 @@ async def cmd_help(message: Message):
     await message.answer(help_text, parse_mode="HTML")
 
 @router.message(Command("stats"))
-async def cmd_stats(message: Message):
+async def cmd_stats(message: Message, session: AsyncSession):
     """Статистика для админа"""
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("❌ Нет прав")
         return
     
-    async with async_session_maker() as session:
-        stats = await DatabaseManager.get_stats(session, days=1)
+    stats = await DatabaseManager.get_stats(session, days=1)
     
     stats_text = (
         "📊 <b>Статистика за сегодня:</b>\n\n"
@@ -1097,7 +1085,7 @@ async def cmd_stats(message: Message):
     await message.answer(stats_text, parse_mode="HTML")
 
 @router.message(Command("cancel"))
-async def cmd_cancel(message: Message, state: FSMContext):
+async def cmd_cancel(message: Message, state: FSMContext, session: AsyncSession):
     """Отмена текущей операции"""
     user_id = message.from_user.id
     current_state = await state.get_state()
@@ -1107,13 +1095,8 @@ async def cmd_cancel(message: Message, state: FSMContext):
         return
     
     await state.clear()
-    await cancel_timeout(user_id)
-    clear_history(user_id)
-    if user_id in user_data:
-        del user_data[user_id]
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     await message.answer(
         "❌ Операция отменена.",
@@ -65,6 +65,7 @@ async def main():
         logger.info("   3. Нажмите 'Управление админами'")
         logger.info("")
         logger.info("🚀 Запустите бота: python main.py")
+        logger.info("   (если бот уже запущен - перезапустите: роли загружаются при старте)")
     else:
         logger.info("✅ Все суперадминистраторы уже настроены!")
         logger.info("💡 Используйте /admin для доступа к админ-панели")
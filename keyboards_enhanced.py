@@ -3,8 +3,9 @@
 детального просмотра заявок, FAQ и поддержки
 """
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import DEPOSIT_AMOUNTS
+from database import bot_settings
 from localization import get_text
+from pagination import NEXT, PREV
 
 def get_main_menu_keyboard(lang: str = "ru") -> InlineKeyboardMarkup:
     """Главное меню"""
@@ -33,15 +34,16 @@ def get_main_menu_keyboard(lang: str = "ru") -> InlineKeyboardMarkup:
     return keyboard
 
 def get_deposit_amount_keyboard(lang: str = "ru") -> InlineKeyboardMarkup:
-    """Клавиатура выбора суммы депозита"""
+    """Клавиатура выбора суммы депозита (номиналы из настроек бота)"""
     keyboard_buttons = []
+    amounts = bot_settings.get("deposit_amounts")
     
     # Добавляем стандартные суммы по 2 в ряд
-    for i in range(0, len(DEPOSIT_AMOUNTS), 2):
+    for i in range(0, len(amounts), 2):
         row = []
         for j in range(2):
-            if i + j < len(DEPOSIT_AMOUNTS):
-                amount = DEPOSIT_AMOUNTS[i + j]
+            if i + j < len(amounts):
+                amount = amounts[i + j]
                 row.append(
                     InlineKeyboardButton(
                         text=f"💰 {amount} USD", 
@@ -183,8 +185,26 @@ def get_faq_keyboard(lang: str = "ru") -> InlineKeyboardMarkup:
     ])
     return keyboard
 
-def get_applications_list_keyboard(applications: list, lang: str = "ru") -> InlineKeyboardMarkup:
-    """Клавиатура со списком заявок (кликабельные)"""
+def get_pagination_row(prefix: str, page, lang: str = "ru") -> list:
+    """
+    Ряд кнопок листания страницы (Пред./След.) с курсором в callback data
+    '<prefix>:<n|p>:<курсор>'. Пустой список, если страница единственная
+    """
+    row = []
+    if page.prev_cursor:
+        row.append(InlineKeyboardButton(
+            text=get_text("btn_page_prev", lang),
+            callback_data=f"{prefix}:{PREV}:{page.prev_cursor}"
+        ))
+    if page.next_cursor:
+        row.append(InlineKeyboardButton(
+            text=get_text("btn_page_next", lang),
+            callback_data=f"{prefix}:{NEXT}:{page.next_cursor}"
+        ))
+    return row
+
+def get_applications_list_keyboard(applications: list, lang: str = "ru", page=None) -> InlineKeyboardMarkup:
+    """Клавиатура со списком заявок (кликабельные), с листанием если передана страница"""
     buttons = []
     
     for app in applications:
@@ -203,6 +223,11 @@ def get_applications_list_keyboard(applications: list, lang: str = "ru") -> Inli
             callback_data=f"view_app_{app.id}"
         )])
     
+    if page is not None:
+        pagination_row = get_pagination_row("myapps", page, lang)
+        if pagination_row:
+            buttons.append(pagination_row)
+    
     # Добавляем кнопку возврата
     buttons.append([InlineKeyboardButton(
         text=get_text("btn_menu", lang),
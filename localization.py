@@ -150,6 +150,16 @@ TRANSLATIONS = {
         "en": "🏠 Main Menu",
         "ur": "🏠 مین مینو"
     },
+    "btn_page_prev": {
+        "ru": "⬅️ Пред.",
+        "en": "⬅️ Prev",
+        "ur": "⬅️ پچھلا"
+    },
+    "btn_page_next": {
+        "ru": "След. ➡️",
+        "en": "Next ➡️",
+        "ur": "اگلا ➡️"
+    },
     
     # Выбор метода оплаты
     "payment_method_selection": {
@@ -0,0 +1,150 @@
+"""
+Настройка логирования бота
+Вызов logger.* в event loop только кладет запись в очередь: форматирование
+(текст или JSON) и запись в поток выполняет отдельный поток.
+Построчные логи запросов (middleware) можно прореживать по модулям.
+"""
+import atexit
+import json
+import queue
+import sys
+import threading
+import traceback
+from typing import Dict, Optional, TextIO
+
+from loguru import logger
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_SAMPLING
+
+# Записи уровня WARNING и выше не прореживаются
+_WARNING_NO = logger.level("WARNING").no
+
+
+def parse_sampling(value: str) -> Dict[str, float]:
+    """Доли записей по модулям из строки 'middleware=0.1,handlers_enhanced=0.5'"""
+    rates = {}
+    for part in value.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            try:
+                rates[name.strip()] = min(max(float(rate), 0.0), 1.0)
+            except ValueError:
+                logger.warning(f"Некорректная доля логов для {name.strip()}: {rate}")
+    return rates
+
+
+class LogSampler:
+    """
+    Фильтр loguru: из записей модуля (record["name"]) ниже WARNING пропускает
+    долю rate равномерно (каждую 1/rate-ю), без случайности
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        self.rates = rates
+        self.counters: Dict[str, int] = {}
+        self.dropped = 0
+
+    def __call__(self, record) -> bool:
+        rate = self.rates.get(record["name"])
+        if rate is None or rate >= 1 or record["level"].no >= _WARNING_NO:
+            return True
+
+        count = self.counters.get(record["name"], 0) + 1
+        self.counters[record["name"]] = count
+        if int(count * rate) != int((count - 1) * rate):
+            return True
+
+        self.dropped += 1
+        return False
+
+
+def format_text(record) -> str:
+    """Строка лога в текстовом формате (как прежний формат консоли, без цветов)"""
+    line = (
+        f"{record['time']:%Y-%m-%d %H:%M:%S} | {record['level'].name: <8} | "
+        f"{record['name']}:{record['function']}:{record['line']} - {record['message']}\n"
+    )
+    if record["exception"] is not None:
+        line += "".join(traceback.format_exception(*record["exception"]))
+    return line
+
+
+def format_json(record) -> str:
+    """Строка лога в JSON (одна запись - одна строка)"""
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        "message": record["message"],
+    }
+    if record["extra"]:
+        entry["extra"] = {key: str(value) for key, value in record["extra"].items()}
+    if record["exception"] is not None:
+        entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+class QueuedSink:
+    """
+    Sink loguru с очередью: в вызывающем потоке запись только ставится
+    в очередь, форматирование и запись в stream - в фоновом потоке пачками
+    """
+
+    def __init__(self, stream: TextIO = None, serialize: bool = False):
+        self.stream = stream or sys.stdout
+        self.formatter = format_json if serialize else format_text
+        self.queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self.written = 0
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def __call__(self, message) -> None:
+        self.queue.put(message.record)
+
+    def _run(self) -> None:
+        while True:
+            record = self.queue.get()
+            lines = []
+            while record is not None:
+                try:
+                    lines.append(self.formatter(record))
+                except Exception as e:
+                    lines.append(f"Ошибка форматирования записи лога: {e}\n")
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if lines:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+                self.written += len(lines)
+            if record is None:
+                return
+
+    def stop(self) -> None:
+        """Дописать очередь и остановить поток записи"""
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+
+
+def setup_logging(
+    stream: TextIO = None,
+    level: str = LOG_LEVEL,
+    log_format: str = LOG_FORMAT,
+    sampling: str = LOG_SAMPLING
+) -> Optional[QueuedSink]:
+    """
+    Заменить обработчики loguru очередью с записью в фоне.
+    Возвращает sink (sink.stop() дописывает очередь, вызывается и при выходе)
+    """
+    sink = QueuedSink(stream, serialize=log_format == "json")
+    sampler = LogSampler(parse_sampling(sampling))
+
+    logger.remove()
+    logger.add(sink, level=level, format="{message}", filter=sampler)
+    atexit.register(sink.stop)
+    return sink
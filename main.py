@@ -5,24 +5,32 @@ import asyncio
 import logging
 import sys
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import SendMessage
 from loguru import logger
 
-from config import BOT_TOKEN, ADMIN_IDS, UPLOAD_DIR
-from database import init_database
+from config import (
+    BOT_TOKEN, ADMIN_IDS, UPLOAD_DIR, ARCHIVE_AFTER_DAYS, METRICS_HOST, METRICS_PORT, WEBHOOK_HOST,
+    SHARD_WORKERS, SHARD_INDEX
+)
+from logging_setup import setup_logging
+from database import (
+    init_database, close_database, archive_loop, load_shared_state, shared_state_loop,
+    engine, read_engine, writer_engine, async_session_maker, sqlite_writer
+)
+from fsm_storage import SQLStorage
+from metrics import ApiCallCounter, instrument_engines, metrics, start_metrics_server
+from sender import send_queue
 from handlers_enhanced import router
-from middleware import RateLimitMiddleware, LoggingMiddleware
+from middleware import (
+    RateLimitMiddleware, LoggingMiddleware, DatabaseSessionMiddleware,
+    MetricsMiddleware, HandlerNameMiddleware, IdempotencyMiddleware, CommitBeforeRequestMiddleware
+)
 from admin_enhanced import router as admin_router
 from admin_extended_features import router as admin_extended_router
 from payments_integration import router as payments_router
 
-# Настройка логирования
-logger.remove()
-logger.add(
-    sys.stdout,
-    format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
-    level="INFO"
-)
+# Настройка логирования: запись в stdout из фонового потока, текст или JSON
+setup_logging()
 
 # Создаем директории
 import os
@@ -32,14 +40,35 @@ logger.info(f"Директории созданы: logs, {UPLOAD_DIR}")
 
 # Инициализация бота и диспетчера
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Состояния диалогов и черновики заявок - в базе (переживают перезапуск)
+storage = SQLStorage(async_session_maker, sqlite_writer)
 dp = Dispatcher(storage=storage)
 
+# Метрики: вызовы Telegram API и запросы к БД
+bot.session.middleware(ApiCallCounter())
+# SQLite: транзакция записи апдейта фиксируется до запроса к Telegram (блокировка не ждет сеть)
+bot.session.middleware(CommitBeforeRequestMiddleware())
+instrument_engines(engine, read_engine, writer_engine)
+metrics.add_collector(send_queue.prometheus_lines)
+
 # Регистрация middleware
-dp.message.middleware(RateLimitMiddleware())
-dp.callback_query.middleware(RateLimitMiddleware())
+# Повторно доставленные апдейты отбрасываются до любой работы с базой
+dp.update.middleware(IdempotencyMiddleware())
+# Метрики снаружи сессии БД: время апдейта включает коммит
+dp.update.middleware(MetricsMiddleware())
+# Одна сессия БД и один коммит на апдейт (передается в обработчики как session)
+dp.update.middleware(DatabaseSessionMiddleware())
+# Один лимитер на сообщения и кнопки (общее ограниченное состояние пользователей)
+rate_limit_middleware = RateLimitMiddleware()
+dp.message.middleware(rate_limit_middleware)
+dp.callback_query.middleware(rate_limit_middleware)
 dp.message.middleware(LoggingMiddleware())
 dp.callback_query.middleware(LoggingMiddleware())
+# Имя обработчика для метрик (роутер + команда/префикс кнопки)
+handler_name_middleware = HandlerNameMiddleware()
+dp.message.middleware(handler_name_middleware)
+dp.callback_query.middleware(handler_name_middleware)
+dp.pre_checkout_query.middleware(handler_name_middleware)
 
 # Регистрация роутера с обработчиками
 dp.include_router(router)
@@ -47,31 +76,86 @@ dp.include_router(admin_router)
 dp.include_router(admin_extended_router)
 dp.include_router(payments_router)
 
+# Фоновые задачи бота (отменяются при остановке)
+background_tasks = []
+# HTTP-сервер метрик
+metrics_runner = None
+
 async def on_startup():
     """Действия при запуске"""
+    global metrics_runner
+    if SHARD_INDEX is not None:
+        await on_worker_startup()
+        return
+    
     await init_database()
     logger.info("✅ База данных инициализирована")
     
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
+    # Перенос старых закрытых заявок в архив
+    if ARCHIVE_AFTER_DAYS > 0:
+        background_tasks.append(asyncio.create_task(archive_loop()))
+    
     # Уведомление администраторов о запуске
     for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, "🤖 Бот запущен и готов к работе!")
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        send_queue.submit(
+            bot,
+            SendMessage(chat_id=admin_id, text="🤖 Бот запущен и готов к работе!"),
+            description=f"уведомление о запуске админу {admin_id}"
+        )
     
     logger.info("✅ Бот успешно запущен!")
 
+async def on_worker_startup():
+    """
+    Запуск процесса-воркера шардирования: схему, архив и уведомления
+    берет на себя фронт, воркер загружает роли и настройки и следит за их изменениями
+    """
+    global metrics_runner
+    await load_shared_state()
+    background_tasks.append(asyncio.create_task(shared_state_loop()))
+    
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
+    logger.info(f"✅ Воркер {SHARD_INDEX} запущен")
+
 async def on_shutdown():
     """Действия при остановке"""
     logger.info("🛑 Бот остановлен")
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await storage.close()
+    # Дослать уведомления, пока сессия бота открыта
+    await send_queue.stop()
+    await close_database()
     await bot.session.close()
 
 async def main():
     """Основная функция"""
     try:
-        logger.info("🚀 Запуск бота в режиме polling...")
         await on_startup()
-        await dp.start_polling(bot)
+        if SHARD_INDEX is not None:
+            from sharding import run_worker
+            await run_worker(bot, dp)
+        elif SHARD_WORKERS > 1:
+            from sharding import run_front
+            logger.info(f"🚀 Запуск бота: фронт и {SHARD_WORKERS} процессов-воркеров...")
+            await run_front(bot, dp, [sys.executable, os.path.abspath(__file__)])
+        elif WEBHOOK_HOST:
+            from webhook import run_webhook
+            logger.info("🚀 Запуск бота в режиме webhook...")
+            await run_webhook(bot, dp)
+        else:
+            logger.info("🚀 Запуск бота в режиме polling...")
+            # getUpdates не работает, пока зарегистрирован webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
         raise
@@ -0,0 +1,70 @@
+"""
+Скрипт для обслуживания архива закрытых заявок
+"""
+import asyncio
+from config import ARCHIVE_AFTER_DAYS
+from database import async_session_maker, create_tables, close_database, DatabaseManager
+
+async def run_archive(days: int):
+    """Перенести закрытые заявки старше days дней в архив"""
+    await create_tables()
+
+    async with async_session_maker() as session:
+        moved = await DatabaseManager.archive_closed_applications(session, older_than_days=days)
+
+    print(f"✅ Перенесено в архив заявок: {moved} (старше {days} дн.)")
+
+async def show_archive():
+    """Показать размеры рабочих и архивных таблиц"""
+    async with async_session_maker() as session:
+        counts = await DatabaseManager.get_archive_stats(session)
+
+    print("📦 Рабочие и архивные таблицы:")
+    print("-" * 50)
+    print(f"   Заявки:   {counts['applications']} в работе, {counts['applications_archive']} в архиве")
+    print(f"   Операции: {counts['transactions']} в работе, {counts['transactions_archive']} в архиве")
+
+def print_help():
+    """Показать справку"""
+    print(f"""
+📦 Архив закрытых заявок
+
+Команды:
+  run [дней]              - Перенести закрытые заявки старше N дней (по умолчанию {ARCHIVE_AFTER_DAYS})
+  show                    - Показать размеры рабочих и архивных таблиц
+  help                    - Показать эту справку
+
+Примеры:
+  python manage_archive.py run
+  python manage_archive.py run 30
+  python manage_archive.py show
+""")
+
+async def main():
+    """Основная функция"""
+    import sys
+
+    if len(sys.argv) < 2:
+        print_help()
+        return
+
+    command = sys.argv[1].lower()
+
+    if command == "run":
+        days = int(sys.argv[2]) if len(sys.argv) > 2 else ARCHIVE_AFTER_DAYS
+        await run_archive(days)
+
+    elif command == "show":
+        await show_archive()
+
+    elif command == "help":
+        print_help()
+
+    else:
+        print("❌ Неверная команда")
+        print_help()
+
+    await close_database()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,6 +5,7 @@ import asyncio
 import csv
 from decimal import Decimal
 from database import async_session_maker, ActivationCode
+from codes_import import import_codes_csv
 from sqlalchemy import select, func
 
 async def list_codes():
@@ -54,47 +55,20 @@ async def list_codes():
 async def add_codes_from_csv(filename: str):
     """Добавить коды из CSV файла"""
     try:
-        codes_added = 0
+        with open(filename, 'rb') as file:
+            data = file.read()
+        
+        async def show_progress(progress: dict):
+            print(f"   ⏳ {progress['processed']}/{progress['lines']} строк, добавлено {progress['added']}")
+        
         async with async_session_maker() as session:
-            with open(filename, 'r', encoding='utf-8') as file:
-                reader = csv.DictReader(file)
-                
-                for row in reader:
-                    code_value = row.get('code_value', '').strip()
-                    amount_str = row.get('amount', '').strip()
-                    
-                    if not code_value or not amount_str:
-                        print(f"⚠️ Пропущена строка: {row}")
-                        continue
-                    
-                    try:
-                        amount = Decimal(amount_str)
-                        
-                        # Проверяем, существует ли уже такой код
-                        existing_query = select(ActivationCode).where(
-                            ActivationCode.code_value == code_value
-                        )
-                        existing_result = await session.execute(existing_query)
-                        existing_code = existing_result.scalar_one_or_none()
-                        
-                        if existing_code:
-                            print(f"⚠️ Код {code_value} уже существует")
-                            continue
-                        
-                        # Создаем новый код
-                        code = ActivationCode(
-                            code_value=code_value,
-                            amount=amount
-                        )
-                        session.add(code)
-                        codes_added += 1
-                        
-                    except ValueError as e:
-                        print(f"⚠️ Ошибка в строке {row}: {e}")
-                        continue
-                
-                await session.commit()
-                print(f"✅ Добавлено {codes_added} кодов из файла {filename}")
+            result = await import_codes_csv(session, data, on_progress=show_progress)
+        
+        for error in result['errors']:
+            print(f"⚠️ {error}")
+        
+        print(f"✅ Добавлено {result['added']} кодов из файла {filename}")
+        print(f"   Пропущено дубликатов: {result['skipped']}, некорректных строк: {result['invalid']}")
                 
     except FileNotFoundError:
         print(f"❌ Файл {filename} не найден")
@@ -0,0 +1,75 @@
+"""
+Скрипт для обслуживания дневной сводки статистики (daily_stats)
+"""
+import asyncio
+from database import async_session_maker, create_tables, DatabaseManager, STATS_WINDOWS
+
+async def rebuild_stats():
+    """Пересобрать сводку из таблицы заявок"""
+    await create_tables()
+
+    async with async_session_maker() as session:
+        rows = await DatabaseManager.rebuild_daily_stats(session)
+
+    print(f"✅ Дневная сводка пересобрана: {rows} строк")
+
+async def show_stats():
+    """Показать статистику из сводки"""
+    async with async_session_maker() as session:
+        stats = await DatabaseManager.get_stats_windows(session)
+
+    print("📊 Статистика заявок (из daily_stats):")
+    print("-" * 50)
+
+    for name, days in STATS_WINDOWS.items():
+        window = stats[name]
+        print(f"📅 {name} ({days} дн.):")
+        print(f"   Всего: {window['total']}")
+        print(f"   Одобрено: {window['approved']}")
+        print(f"   Отклонено: {window['rejected']}")
+        print(f"   Ожидают: {window['pending']}")
+        print()
+
+    if stats["avg_processing_minutes"]:
+        print(f"⏱️ Среднее время обработки за неделю: {stats['avg_processing_minutes']:.0f} мин")
+
+def print_help():
+    """Показать справку"""
+    print("""
+📊 Дневная сводка статистики
+
+Команды:
+  rebuild                 - Пересобрать сводку из таблицы заявок
+  show                    - Показать статистику из сводки
+  help                    - Показать эту справку
+
+Примеры:
+  python manage_stats.py rebuild
+  python manage_stats.py show
+""")
+
+async def main():
+    """Основная функция"""
+    import sys
+
+    if len(sys.argv) < 2:
+        print_help()
+        return
+
+    command = sys.argv[1].lower()
+
+    if command == "rebuild":
+        await rebuild_stats()
+
+    elif command == "show":
+        await show_stats()
+
+    elif command == "help":
+        print_help()
+
+    else:
+        print("❌ Неверная команда")
+        print_help()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,291 @@
+"""
+Метрики обработчиков
+Для каждого обработчика (роутер + команда или префикс callback data) -
+гистограмма времени обработки апдейта, число ошибок, запросов к БД
+и вызовов Telegram API. Отдаются в текстовом формате Prometheus
+на /metrics и командой /perf (p50/p95/p99).
+"""
+import re
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import CallbackQuery, Message, PreCheckoutQuery, TelegramObject
+from aiohttp import web
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Границы корзин гистограммы, мс (последняя корзина - все, что дольше)
+HANDLER_BUCKETS_MS = (
+    1, 2.5, 5, 10, 25, 50, 75, 100, 150, 250, 400, 600,
+    1000, 1500, 2500, 5000, 10000, 30000
+)
+
+# Сверх этого числа обработчиков метрики попадают в общий ключ OTHER_HANDLER
+MAX_HANDLERS = 500
+OTHER_HANDLER = "other"
+
+# Команда в имени обработчика (остальной текст после '/' - просто 'command')
+_COMMAND_RE = re.compile(r"^/[A-Za-z0-9_]{1,32}$")
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; перцентили - интерполяцией внутри корзины"""
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets=HANDLER_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        """Оценка перцентиля q (0..1); точность - ширина корзины"""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and cumulative + bucket_count >= target:
+                if index == len(self.buckets):
+                    return self.max
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = min(self.buckets[index], self.max)
+                return lower + (upper - lower) * (target - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.max
+
+
+class HandlerMetrics:
+    """Накопленные метрики одного обработчика"""
+    __slots__ = ("latency", "errors", "db_queries", "api_calls")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.db_queries = 0
+        self.api_calls = 0
+
+
+class UpdateStats:
+    """Счетчики текущего апдейта (в contextvar на время обработки)"""
+    __slots__ = ("handler", "db_queries", "api_calls", "done")
+
+    def __init__(self):
+        self.handler: Optional[str] = None
+        self.db_queries = 0
+        self.api_calls = 0
+        self.done = False
+
+
+_current_update: ContextVar[Optional[UpdateStats]] = ContextVar("current_update", default=None)
+
+
+def _current() -> Optional[UpdateStats]:
+    """
+    Счетчики апдейта, в контексте которого идет запрос.
+    Фоновые задачи, созданные во время апдейта, наследуют contextvar -
+    после завершения апдейта их запросы считаются фоновыми
+    """
+    stats = _current_update.get()
+    if stats is None or stats.done:
+        return None
+    return stats
+
+
+class MetricsRegistry:
+    """Метрики всех обработчиков процесса. Не потокобезопасен: рассчитан на один event loop"""
+
+    def __init__(self, max_handlers: int = MAX_HANDLERS):
+        self.max_handlers = max_handlers
+        self.handlers: Dict[str, HandlerMetrics] = {}
+        self.background_db_queries = 0
+        self.background_api_calls = 0
+        self.started_at = time.time()
+        # Дополнительные метрики процесса: функции, возвращающие строки в формате Prometheus
+        self.collectors: List[Callable[[], List[str]]] = []
+
+    @staticmethod
+    def current_update() -> Optional[UpdateStats]:
+        return _current()
+
+    def start_update(self) -> UpdateStats:
+        """Начать учет апдейта в текущем контексте"""
+        stats = UpdateStats()
+        _current_update.set(stats)
+        return stats
+
+    def finish_update(self, stats: UpdateStats, handler: str, elapsed_ms: float, error: bool) -> None:
+        """Записать апдейт в метрики обработчика"""
+        stats.done = True
+        entry = self.handlers.get(handler)
+        if entry is None:
+            if len(self.handlers) >= self.max_handlers:
+                handler = OTHER_HANDLER
+            entry = self.handlers.setdefault(handler, HandlerMetrics())
+
+        entry.latency.observe(elapsed_ms)
+        entry.db_queries += stats.db_queries
+        entry.api_calls += stats.api_calls
+        if error:
+            entry.errors += 1
+
+    def add_collector(self, collector: Callable[[], List[str]]) -> None:
+        """Добавить в /metrics строки, которые возвращает collector()"""
+        self.collectors.append(collector)
+
+    def count_db_query(self) -> None:
+        stats = _current()
+        if stats is None:
+            self.background_db_queries += 1
+        else:
+            stats.db_queries += 1
+
+    def count_api_call(self) -> None:
+        stats = _current()
+        if stats is None:
+            self.background_api_calls += 1
+        else:
+            stats.api_calls += 1
+
+    def summary(self) -> List[dict]:
+        """Сводка по обработчикам (по убыванию числа апдейтов) для /perf"""
+        rows = []
+        for handler, entry in self.handlers.items():
+            latency = entry.latency
+            rows.append({
+                "handler": handler,
+                "count": latency.count,
+                "errors": entry.errors,
+                "p50_ms": latency.percentile(0.5),
+                "p95_ms": latency.percentile(0.95),
+                "p99_ms": latency.percentile(0.99),
+                "max_ms": latency.max,
+                "db_per_update": entry.db_queries / latency.count if latency.count else 0.0,
+                "api_per_update": entry.api_calls / latency.count if latency.count else 0.0,
+            })
+        rows.sort(key=lambda row: row["count"], reverse=True)
+        return rows
+
+    def render_prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus (exposition format 0.0.4)"""
+        lines = [
+            "# HELP bot_handler_duration_seconds Время обработки апдейта",
+            "# TYPE bot_handler_duration_seconds histogram",
+        ]
+        for handler, entry in sorted(self.handlers.items()):
+            label = _escape_label(handler)
+            latency = entry.latency
+            cumulative = 0
+            for bound, bucket_count in zip(latency.buckets, latency.counts):
+                cumulative += bucket_count
+                lines.append(
+                    f'bot_handler_duration_seconds_bucket{{handler="{label}",le="{bound / 1000:g}"}} {cumulative}'
+                )
+            lines.append(f'bot_handler_duration_seconds_bucket{{handler="{label}",le="+Inf"}} {latency.count}')
+            lines.append(f'bot_handler_duration_seconds_sum{{handler="{label}"}} {latency.sum / 1000:.6f}')
+            lines.append(f'bot_handler_duration_seconds_count{{handler="{label}"}} {latency.count}')
+
+        for name, help_text, attribute in (
+            ("bot_handler_errors_total", "Апдейты, завершившиеся исключением", "errors"),
+            ("bot_handler_db_queries_total", "Запросы к БД при обработке апдейтов", "db_queries"),
+            ("bot_handler_api_calls_total", "Вызовы Telegram API при обработке апдейтов", "api_calls"),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for handler, entry in sorted(self.handlers.items()):
+                lines.append(f'{name}{{handler="{_escape_label(handler)}"}} {getattr(entry, attribute)}')
+
+        lines += [
+            "# HELP bot_background_db_queries_total Запросы к БД вне апдейтов (фоновые задачи)",
+            "# TYPE bot_background_db_queries_total counter",
+            f"bot_background_db_queries_total {self.background_db_queries}",
+            "# HELP bot_background_api_calls_total Вызовы Telegram API вне апдейтов",
+            "# TYPE bot_background_api_calls_total counter",
+            f"bot_background_api_calls_total {self.background_api_calls}",
+            "# HELP bot_start_time_seconds Время запуска процесса (unix)",
+            "# TYPE bot_start_time_seconds gauge",
+            f"bot_start_time_seconds {self.started_at:.0f}",
+        ]
+        for collector in self.collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+# Метрики процесса
+metrics = MetricsRegistry()
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _callback_prefix(data: str) -> str:
+    """
+    Префикс callback data без идентификаторов и курсоров:
+    'admin_approve_12' -> 'admin_approve', 'myapps:n:abc_1' -> 'myapps'
+    """
+    parts = data.split(":", 1)[0].split("_")
+    while len(parts) > 1 and parts[-1].replace(".", "", 1).isdigit():
+        parts.pop()
+    return "_".join(parts)
+
+
+def event_label(event: TelegramObject) -> str:
+    """Команда, префикс callback data или тип содержимого события"""
+    if isinstance(event, CallbackQuery):
+        return _callback_prefix(event.data or "")
+    if isinstance(event, Message):
+        if event.text and event.text.startswith("/"):
+            command = event.text.split(maxsplit=1)[0].split("@", 1)[0]
+            return command if _COMMAND_RE.match(command) else "command"
+        return event.content_type
+    if isinstance(event, PreCheckoutQuery):
+        return "pre_checkout"
+    return type(event).__name__
+
+
+def instrument_engines(*engines: Optional[AsyncEngine]) -> None:
+    """Считать запросы к БД движков (один раз на движок, None пропускается)"""
+    for db_engine in {id(e): e for e in engines if e is not None}.values():
+        event.listen(db_engine.sync_engine, "before_cursor_execute", _on_cursor_execute)
+
+
+def _on_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics.count_db_query()
+
+
+class ApiCallCounter(BaseRequestMiddleware):
+    """Middleware сессии бота: считает вызовы Telegram API"""
+
+    async def __call__(self, make_request, bot, method):
+        metrics.count_api_call()
+        return await make_request(bot, method)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.render_prometheus().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """HTTP-сервер с /metrics; остановка - await runner.cleanup()"""
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики Prometheus: http://{host}:{port}/metrics")
+    return runner
@@ -1,19 +1,148 @@
 """
 Middleware для бота
 """
+import sys
 import time
+from collections import OrderedDict, namedtuple
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
-from aiogram.types import Message, CallbackQuery
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Message, CallbackQuery, TelegramObject, Update
 from loguru import logger
 
+from config import (
+    RATE_LIMIT_MESSAGE_INTERVAL, RATE_LIMIT_MESSAGES_PER_MINUTE,
+    RATE_LIMIT_CALLBACK_INTERVAL, RATE_LIMIT_CALLBACKS_PER_MINUTE,
+    RATE_LIMIT_IDLE_TTL, RATE_LIMIT_MAX_USERS
+)
+from database import unit_of_work, recent_keys, commit_pending_writes
+from metrics import metrics, event_label
+
+# Лимит типа событий: минимальный интервал между запросами (с),
+# запросов в минуту (0 - без лимита) и ответ при превышении
+EventLimit = namedtuple("EventLimit", ["min_interval", "per_minute", "message"])
+
+EVENT_LIMITS = {
+    "message": EventLimit(RATE_LIMIT_MESSAGE_INTERVAL, RATE_LIMIT_MESSAGES_PER_MINUTE, "⏳ Подождите немного"),
+    "callback_query": EventLimit(RATE_LIMIT_CALLBACK_INTERVAL, RATE_LIMIT_CALLBACKS_PER_MINUTE, "⏳ Немного медленнее"),
+}
+
+# Оценка памяти на пользователя: запись со слотами, ключ int и два float в слотах
+# (узлы OrderedDict учитывает sys.getsizeof самого словаря)
+_KEY_SIZE = sys.getsizeof(2 ** 40)
+_FLOAT_SIZE = sys.getsizeof(0.5)
+
+
+class _UserWindow:
+    """Состояние пользователя: время последнего запроса и счетчик текущей минуты"""
+    __slots__ = ("last", "window_start", "count")
+    
+    def __init__(self, now: float):
+        self.last = 0.0
+        self.window_start = now
+        self.count = 0
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов пользователей, отдельно для каждого типа событий.
+    Состояние - LRU (OrderedDict) слотовых записей в порядке последнего запроса:
+    записи без запросов дольше idle_ttl снимаются с начала очереди (не чаще
+    раза в секунду), сверх max_users вытесняются самые давние. idle_ttl не меньше минуты,
+    поэтому забытый пользователь неотличим от нового (его окно все равно истекло).
+    Не потокобезопасен: рассчитан на один event loop.
+    """
+    
+    def __init__(
+        self,
+        limits: Dict[str, EventLimit] = None,
+        idle_ttl: float = RATE_LIMIT_IDLE_TTL,
+        max_users: int = RATE_LIMIT_MAX_USERS
+    ):
+        self.limits = limits or EVENT_LIMITS
+        self.idle_ttl = max(idle_ttl, 60, *(limit.min_interval for limit in self.limits.values()))
+        self.max_users = max_users
+        self.windows: Dict[str, "OrderedDict[int, _UserWindow]"] = {kind: OrderedDict() for kind in self.limits}
+        self._next_expire = 0.0
+        self.allowed = 0
+        self.throttled = 0
+        self.expired = 0
+        self.evicted = 0
+    
+    def _expire(self, now: float) -> None:
+        """Снять с начала очередей пользователей без запросов дольше idle_ttl"""
+        self._next_expire = now + 1
+        deadline = now - self.idle_ttl
+        for windows in self.windows.values():
+            while windows:
+                user_id, window = next(iter(windows.items()))
+                if window.last > deadline:
+                    break
+                del windows[user_id]
+                self.expired += 1
+    
+    def hit(self, kind: str, user_id: int, now: float = None) -> int:
+        """
+        Учесть запрос. Возвращает номер запроса пользователя в текущей минуте
+        или 0, если запрос нужно отклонить (ответ - limits[kind].message)
+        """
+        limit = self.limits.get(kind)
+        if limit is None:
+            return 1
+        
+        now = time.monotonic() if now is None else now
+        if now >= self._next_expire:
+            self._expire(now)
+        
+        windows = self.windows[kind]
+        window = windows.get(user_id)
+        if window is None:
+            window = _UserWindow(now)
+            windows[user_id] = window
+            if len(windows) > self.max_users:
+                windows.popitem(last=False)
+                self.evicted += 1
+        elif now - window.last < limit.min_interval:
+            self.throttled += 1
+            return 0
+        
+        if now - window.window_start > 60:
+            window.window_start = now
+            window.count = 0
+        if limit.per_minute and window.count >= limit.per_minute:
+            self.throttled += 1
+            return 0
+        
+        window.last = now
+        window.count += 1
+        windows.move_to_end(user_id)
+        self.allowed += 1
+        return window.count
+    
+    def stats(self) -> dict:
+        """Счетчики и оценка занимаемой памяти"""
+        users = {kind: len(windows) for kind, windows in self.windows.items()}
+        entry_size = sys.getsizeof(_UserWindow(0.0)) + _KEY_SIZE + 2 * _FLOAT_SIZE
+        memory = sum(sys.getsizeof(windows) for windows in self.windows.values()) + sum(users.values()) * entry_size
+        return {
+            "users": users,
+            "max_users": self.max_users,
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "memory_bytes": memory
+        }
+
+# Общий лимитер для всех типов событий
+rate_limiter = RateLimiter()
+
+
 class RateLimitMiddleware(BaseMiddleware):
-    """Middleware для ограничения частоты запросов"""
+    """Middleware для ограничения частоты запросов (один экземпляр на сообщения и кнопки)"""
     
-    def __init__(self):
-        self.user_last_request: Dict[int, float] = {}
-        self.user_request_count: Dict[int, int] = {}
-        self.user_request_reset: Dict[int, float] = {}
+    def __init__(self, limiter: RateLimiter = rate_limiter):
+        self.limiter = limiter
     
     async def __call__(
         self,
@@ -22,45 +151,20 @@ class RateLimitMiddleware(BaseMiddleware):
         data: Dict[str, Any]
     ) -> Any:
         user_id = event.from_user.id
-        current_time = time.time()
-        
-        # Сброс счетчика каждую минуту
-        if user_id in self.user_request_reset:
-            if current_time - self.user_request_reset[user_id] > 60:
-                self.user_request_count[user_id] = 0
-                self.user_request_reset[user_id] = current_time
-        
-        # Инициализация для нового пользователя
-        if user_id not in self.user_request_count:
-            self.user_request_count[user_id] = 0
-            self.user_request_reset[user_id] = current_time
+        kind = "message" if isinstance(event, Message) else "callback_query"
         
-        # Проверка лимита (более мягкий) - только для сообщений, не для callback
-        if isinstance(event, Message):
-            if user_id in self.user_last_request:
-                time_diff = current_time - self.user_last_request[user_id]
-                if time_diff < 0.5:  # 0.5 секунды для сообщений
-                    await event.answer(
-                        "⏳ Подождите немного"
-                    )
-                    return
-        else:
-            # Для callback - минимальная защита от двойного клика
-            if user_id in self.user_last_request:
-                time_diff = current_time - self.user_last_request[user_id]
-                if time_diff < 0.3:  # 0.3 секунды для кнопок
-                    await event.answer(
-                        "⏳ Немного медленнее",
-                        show_alert=False
-                    )
-                    return
-        
-        # Обновляем время последнего запроса
-        self.user_last_request[user_id] = current_time
-        self.user_request_count[user_id] += 1
+        request_number = self.limiter.hit(kind, user_id)
+        if not request_number:
+            text = self.limiter.limits[kind].message
+            if isinstance(event, Message):
+                await event.answer(text)
+            else:
+                # Для callback - защита от двойного клика
+                await event.answer(text, show_alert=False)
+            return
         
         # Логируем запрос
-        logger.info(f"Пользователь {user_id} сделал запрос #{self.user_request_count[user_id]}")
+        logger.info(f"Пользователь {user_id} сделал запрос #{request_number}")
         
         return await handler(event, data)
 
@@ -106,3 +210,113 @@ class AdminOnlyMiddleware(BaseMiddleware):
             return
         
         return await handler(event, data)
+
+class DatabaseSessionMiddleware(BaseMiddleware):
+    """
+    Middleware unit of work: одна сессия БД на апдейт.
+    Сессия передается в обработчики как аргумент `session`,
+    все изменения коммитятся одним коммитом после обработчика.
+    """
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with unit_of_work() as session:
+            data["session"] = session
+            return await handler(event, data)
+
+class CommitBeforeRequestMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота (файловая SQLite): апдейт, который уже пишет в базу,
+    фиксирует транзакцию перед запросом к Telegram API. Иначе блокировка записи
+    держалась бы на время сети, и остальные записи процесса ждали бы ее.
+    На остальных базах ничего не делает.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        await commit_pending_writes()
+        return await make_request(bot, method)
+
+class IdempotencyMiddleware(BaseMiddleware):
+    """
+    Повторная доставка апдейта (тот же update_id или id callback-запроса)
+    отбрасывается до открытия сессии БД. Если обработка упала с исключением,
+    ключи освобождаются и повтор будет обработан.
+    Двойные нажатия - это разные апдейты, их отсекают ключи действий в обработчиках.
+    """
+    
+    def __init__(self, keys=recent_keys):
+        self.keys = keys
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        keys = [f"update:{event.update_id}"]
+        if event.callback_query is not None:
+            keys.append(f"callback:{event.callback_query.id}")
+        
+        claimed = []
+        for key in keys:
+            if not self.keys.claim(key):
+                for claimed_key in claimed:
+                    self.keys.release(claimed_key)
+                logger.warning(f"Повторная доставка апдейта {event.update_id} ({key}), пропускаем")
+                return None
+            claimed.append(key)
+        
+        try:
+            return await handler(event, data)
+        except Exception:
+            for key in claimed:
+                self.keys.release(key)
+            raise
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Middleware метрик на уровне апдейта: время обработки вместе с коммитом
+    сессии БД, ошибки, запросы к БД и вызовы Telegram API.
+    Регистрируется на dp.update раньше DatabaseSessionMiddleware,
+    имя обработчика подставляет HandlerNameMiddleware
+    """
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        stats = metrics.start_update()
+        started = time.perf_counter()
+        error = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            error = True
+            raise
+        finally:
+            name = stats.handler or f"unhandled:{event.event_type}"
+            metrics.finish_update(stats, name, (time.perf_counter() - started) * 1000, error)
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware событий: имя обработчика для метрик -
+    модуль роутера и команда/префикс callback data ('admin_enhanced:admin_approve')
+    """
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        stats = metrics.current_update()
+        if stats is not None:
+            router = data["handler"].callback.__module__
+            stats.handler = f"{router}:{event_label(event)}"
+        return await handler(event, data)
@@ -0,0 +1,146 @@
+"""
+Версионные миграции схемы базы данных
+Выполняются при старте после create_all: таблицы создает create_all,
+а индексы и прочие изменения для уже существующих баз - миграции.
+Индексы на PostgreSQL строятся без блокировки записи (CREATE INDEX CONCURRENTLY).
+"""
+import time
+from typing import List
+
+from loguru import logger
+from sqlalchemy import Index, MetaData, select, func, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.schema import CreateIndex
+
+from database import Application, ActivationCode, Transaction, SchemaMigration
+
+# Копии таблиц: индексы миграций не попадают в Base.metadata,
+# поэтому create_all не пытается строить их внутри транзакции
+_metadata = MetaData()
+applications = Application.__table__.to_metadata(_metadata)
+codes = ActivationCode.__table__.to_metadata(_metadata)
+transactions = Transaction.__table__.to_metadata(_metadata)
+
+# Ключ advisory lock PostgreSQL: миграции выполняет только один процесс
+MIGRATIONS_LOCK_KEY = 724100901
+
+
+class Migration:
+    """Миграция: номер версии, название, индексы для построения и имена индексов для удаления"""
+
+    def __init__(self, version: int, name: str, indexes: List[Index], drop_indexes: List[str] = ()):
+        self.version = version
+        self.name = name
+        self.indexes = indexes
+        self.drop_indexes = list(drop_indexes)
+
+
+MIGRATIONS = [
+    Migration(1, "Индексы для горячих запросов", [
+        # Окна статистики и фильтры по дате
+        Index("ix_applications_created_at", applications.c.created_at, postgresql_concurrently=True),
+        # Очередь ожидающих заявок
+        Index(
+            "ix_applications_status_created_at",
+            applications.c.status, applications.c.created_at,
+            postgresql_concurrently=True
+        ),
+        # Заявки пользователя
+        Index(
+            "ix_applications_user_id_created_at",
+            applications.c.user_id, applications.c.created_at,
+            postgresql_concurrently=True
+        ),
+        # История операций по заявке
+        Index("ix_transactions_application_id", transactions.c.application_id, postgresql_concurrently=True),
+        # Выдача свободного кода: только неиспользованные коды
+        Index(
+            "ix_codes_free_amount_id",
+            codes.c.amount, codes.c.id,
+            postgresql_where=codes.c.is_used == False,
+            sqlite_where=codes.c.is_used == False,
+            postgresql_concurrently=True
+        ),
+    ]),
+    # Индекс по булевому is_used бесполезен рядом с частичным ix_codes_free_amount_id,
+    # а без статистики SQLite выбирает его и сортирует все свободные коды
+    Migration(2, "Удаление индекса codes.is_used", [], drop_indexes=["ix_codes_is_used"]),
+]
+
+LATEST_VERSION = max(migration.version for migration in MIGRATIONS)
+
+
+async def get_current_version(conn: AsyncConnection) -> int:
+    """Последняя примененная версия (0 - миграций не было)"""
+    result = await conn.execute(select(func.max(SchemaMigration.version)))
+    return result.scalar() or 0
+
+
+async def _build_index(conn: AsyncConnection, index: Index) -> None:
+    """Построить индекс, если его еще нет"""
+    if conn.dialect.name == "postgresql":
+        # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс - пересоздаем
+        result = await conn.execute(text(
+            "SELECT NOT i.indisvalid FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+        ), {"name": index.name})
+        if result.scalar():
+            logger.warning(f"Индекс {index.name} невалиден, пересоздаем")
+            await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+
+    started = time.perf_counter()
+    await conn.execute(CreateIndex(index, if_not_exists=True))
+    logger.info(f"Индекс {index.name} готов за {time.perf_counter() - started:.2f} с")
+
+
+async def _drop_index(conn: AsyncConnection, name: str) -> None:
+    """Удалить индекс, если он есть"""
+    concurrently = "CONCURRENTLY " if conn.dialect.name == "postgresql" else ""
+    await conn.execute(text(f'DROP INDEX {concurrently}IF EXISTS "{name}"'))
+    logger.info(f"Индекс {name} удален")
+
+
+async def _apply(conn: AsyncConnection, current: int) -> int:
+    """Применить миграции новее current, вернуть итоговую версию"""
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        if migration.version <= current:
+            continue
+
+        logger.info(f"Миграция {migration.version}: {migration.name}")
+        for index in migration.indexes:
+            await _build_index(conn, index)
+        for name in migration.drop_indexes:
+            await _drop_index(conn, name)
+
+        await conn.execute(
+            SchemaMigration.__table__.insert().values(version=migration.version, name=migration.name)
+        )
+        current = migration.version
+
+    return current
+
+
+async def run_migrations(engine: AsyncEngine) -> int:
+    """
+    Привести схему к последней версии.
+    Если база уже актуальна - один SELECT и выход.
+    """
+    async with engine.connect() as conn:
+        # Autocommit: CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        current = await get_current_version(conn)
+        if current >= LATEST_VERSION:
+            return current
+
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+        try:
+            # Пока ждали блокировку, миграции мог применить другой процесс
+            current = await _apply(conn, await get_current_version(conn))
+        finally:
+            if conn.dialect.name == "postgresql":
+                await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATIONS_LOCK_KEY})
+
+    logger.info(f"Схема базы данных обновлена до версии {current}")
+    return current
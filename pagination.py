@@ -0,0 +1,138 @@
+"""
+Постраничные списки по ключу (keyset pagination)
+Страница выбирается условием (sort_key, id) < курсор и LIMIT n, без OFFSET:
+стоимость страницы не зависит от размера таблицы и номера страницы.
+Курсор - ключ первой/последней записи страницы, передается в callback data.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Optional
+
+from sqlalchemy import Column, DateTime, Numeric, Select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Направления листания
+NEXT = "n"
+PREV = "p"
+
+_EPOCH = datetime(1970, 1, 1)
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+# items - записи страницы в порядке отображения,
+# next_cursor/prev_cursor - курсоры соседних страниц (None - страницы нет)
+Page = namedtuple("Page", ["items", "next_cursor", "prev_cursor"])
+
+
+def _to_base36(number: int) -> str:
+    """Целое неотрицательное число в base36 (короче для callback data)"""
+    if number == 0:
+        return "0"
+    digits = []
+    while number:
+        number, remainder = divmod(number, 36)
+        digits.append(_DIGITS[remainder])
+    return "".join(reversed(digits))
+
+
+def encode_cursor(sort_value, row_id: int) -> str:
+    """
+    Курсор из ключа записи: дата - микросекунды от эпохи в base36,
+    число - строкой. Разделитель '_', символ ':' оставлен для callback data
+    """
+    if isinstance(sort_value, datetime):
+        sort_part = _to_base36((sort_value - _EPOCH) // timedelta(microseconds=1))
+    else:
+        sort_part = str(sort_value)
+    return f"{sort_part}_{_to_base36(row_id)}"
+
+
+def decode_cursor(cursor: str, sort_column: Column) -> Optional[tuple]:
+    """Ключ (sort_value, id) из курсора или None, если курсор поврежден"""
+    try:
+        sort_part, id_part = cursor.split("_")
+        if isinstance(sort_column.type, DateTime):
+            sort_value = _EPOCH + timedelta(microseconds=int(sort_part, 36))
+        elif isinstance(sort_column.type, Numeric):
+            sort_value = Decimal(sort_part)
+        else:
+            sort_value = int(sort_part)
+        return sort_value, int(id_part, 36)
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def parse_page_callback(data: str) -> tuple:
+    """
+    Разбор callback data кнопки листания '<префикс>:<n|p>:<курсор>'.
+    Возвращает (direction, cursor); для первой страницы (NEXT, None)
+    """
+    parts = data.rsplit(":", 2)
+    if len(parts) == 3 and parts[1] in (NEXT, PREV):
+        return parts[1], parts[2]
+    return NEXT, None
+
+
+async def fetch_page(
+    session: AsyncSession,
+    query: Select,
+    sort_column: Column,
+    id_column: Column,
+    cursor: Optional[str] = None,
+    direction: str = NEXT,
+    limit: int = 10,
+    descending: bool = True,
+    row_factory: Optional[Callable] = None
+) -> Page:
+    """
+    Страница записей query, упорядоченных по (sort_column, id_column).
+    cursor - ключ последней (NEXT) или первой (PREV) записи текущей страницы.
+    Запрашивается limit + 1 запись: лишняя показывает, есть ли следующая страница.
+    row_factory - для запросов по колонкам: строка результата -> объект страницы
+    (иначе query выбирает одну сущность и страница состоит из ORM-объектов).
+    """
+    key = tuple_(sort_column, id_column)
+    position = decode_cursor(cursor, sort_column) if cursor else None
+    if position is None:
+        direction = NEXT
+
+    # Назад - тот же запрос в обратном порядке, результат переворачивается
+    forward_desc = descending == (direction == NEXT)
+    page_query = query
+    if position is not None:
+        page_query = page_query.where(key < position if forward_desc else key > position)
+
+    if forward_desc:
+        page_query = page_query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        page_query = page_query.order_by(sort_column.asc(), id_column.asc())
+
+    result = await session.execute(page_query.limit(limit + 1))
+    if row_factory is not None:
+        items = [row_factory(*row) for row in result]
+    else:
+        items = list(result.scalars().all())
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    if direction == PREV:
+        items.reverse()
+        has_next, has_prev = True, has_more
+    else:
+        has_next, has_prev = has_more, position is not None
+
+    if not items:
+        # Записи за курсором пропали (обработаны/удалены) - показываем первую страницу
+        if position is not None:
+            return await fetch_page(
+                session, query, sort_column, id_column,
+                limit=limit, descending=descending, row_factory=row_factory
+            )
+        return Page(items, None, None)
+
+    first, last = items[0], items[-1]
+    return Page(
+        items,
+        encode_cursor(getattr(last, sort_column.key), getattr(last, id_column.key)) if has_next else None,
+        encode_cursor(getattr(first, sort_column.key), getattr(first, id_column.key)) if has_prev else None
+    )
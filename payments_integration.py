@@ -11,10 +11,13 @@ from aiogram.types import (
     PreCheckoutQuery, InlineKeyboardMarkup, InlineKeyboardButton
 )
 from aiogram.filters import Command
+from aiogram.methods import SendMessage
+from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 
-from database import DatabaseManager, async_session_maker
+from database import DatabaseManager, async_session_maker, bot_settings
 from config import ADMIN_IDS
+from sender import send_queue
 
 router = Router()
 
@@ -23,12 +26,9 @@ router = Router()
 class PaymentConfig:
     """Конфигурация платежной системы"""
     
-    # SmartGlocal Provider Token (получить на https://smart-glocal.com)
-    # Для тестирования используйте тестовый токен
-    PROVIDER_TOKEN = None  # Устанавливается через админ-панель или .env
-    
-    # Валюта (ISO 4217)
-    CURRENCY = "USD"  # USD, EUR, RUB и т.д.
+    # SmartGlocal Provider Token (получить на https://smart-glocal.com),
+    # валюта (ISO 4217) и комиссия берутся из настроек бота (админ-панель),
+    # а если там не заданы - из .env
     
     # Поддерживаемые методы оплаты
     PAYMENT_METHODS = {
@@ -41,36 +41,31 @@ class PaymentConfig:
     MIN_AMOUNT = 10
     MAX_AMOUNT = 10000
     
-    # Комиссия (если есть)
-    COMMISSION_PERCENT = 0  # 0% - без комиссии, 3.5 для 3.5%
-    
     # Описание для чека
     PAYMENT_DESCRIPTION = "Депозит в систему"
     
     @classmethod
     def get_provider_token(cls) -> Optional[str]:
         """Получить токен провайдера"""
-        if cls.PROVIDER_TOKEN:
-            return cls.PROVIDER_TOKEN
-        
-        # Пытаемся получить из переменных окружения
-        import os
-        token = os.getenv("PAYMENT_PROVIDER_TOKEN")
-        if token:
-            cls.PROVIDER_TOKEN = token
-            return token
-        
-        return None
+        return bot_settings.get("payment_provider_token")
+    
+    @classmethod
+    def get_currency(cls) -> str:
+        """Валюта платежей"""
+        return bot_settings.get("payment_currency")
+    
+    @classmethod
+    def get_commission_percent(cls) -> float:
+        """Комиссия в процентах (0 - без комиссии, 3.5 для 3.5%)"""
+        return bot_settings.get("payment_commission")
     
     @classmethod
     async def get_token_from_db(cls):
-        """Получить токен из базы данных"""
-        async with async_session_maker() as session:
-            token = await DatabaseManager.get_setting(session, "payment_provider_token")
-            if token:
-                cls.PROVIDER_TOKEN = token
-                return token
-        return None
+        """Получить токен, загрузив настройки из базы, если они еще не загружены"""
+        if not bot_settings.loaded:
+            async with async_session_maker() as session:
+                await DatabaseManager.load_settings(session)
+        return cls.get_provider_token()
     
     @classmethod
     def is_configured(cls) -> bool:
@@ -83,8 +78,9 @@ class PaymentConfig:
         Рассчитать финальную сумму с комиссией
         Возвращает сумму в минимальных единицах (копейки, центы)
         """
-        if cls.COMMISSION_PERCENT > 0:
-            total = base_amount * (1 + cls.COMMISSION_PERCENT / 100)
+        commission_percent = cls.get_commission_percent()
+        if commission_percent > 0:
+            total = base_amount * (1 + commission_percent / 100)
         else:
             total = base_amount
         
@@ -142,7 +138,7 @@ def get_payment_confirm_keyboard(amount: float, lang: str = "ru") -> InlineKeybo
 # ==================== ОБРАБОТЧИКИ ПЛАТЕЖЕЙ ====================
 
 @router.callback_query(F.data == "menu_deposit_payment")
-async def start_payment_deposit(callback: CallbackQuery):
+async def start_payment_deposit(callback: CallbackQuery, session: AsyncSession):
     """Начало процесса оплаты депозита"""
     user_id = callback.from_user.id
     
@@ -165,23 +161,22 @@ async def start_payment_deposit(callback: CallbackQuery):
         )
         return
     
-    async with async_session_maker() as session:
-        # Проверяем лимиты
-        can_proceed, error_message = await DatabaseManager.check_user_rate_limit(session, user_id)
-        lang = await DatabaseManager.get_user_language(session, user_id)
-        
-        if not can_proceed:
-            await callback.answer("❌ Лимит достигнут", show_alert=True)
-            await callback.message.edit_text(
-                f"❌ {error_message}",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_menu")]
-                ])
-            )
-            return
-        
-        # Получаем доступные номиналы
-        amounts = await DatabaseManager.get_deposit_amounts(session)
+    # Проверяем лимиты (списываются при подтверждении оплаты в pre_checkout)
+    decision = await DatabaseManager.check_user_rate_limit(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
+    
+    if not decision.allowed:
+        await callback.answer("❌ Лимит достигнут", show_alert=True)
+        await callback.message.edit_text(
+            f"❌ {decision.message}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_menu")]
+            ])
+        )
+        return
+    
+    # Получаем доступные номиналы
+    amounts = await DatabaseManager.get_deposit_amounts(session)
     
     # Показываем доступные суммы для оплаты
     text = (
@@ -212,24 +207,24 @@ async def start_payment_deposit(callback: CallbackQuery):
     )
 
 @router.callback_query(F.data.startswith("payment_amount_"))
-async def select_payment_amount(callback: CallbackQuery):
+async def select_payment_amount(callback: CallbackQuery, session: AsyncSession):
     """Выбор суммы для оплаты"""
     user_id = callback.from_user.id
     amount = float(callback.data.split("_")[2])
     
     await callback.answer()
     
-    async with async_session_maker() as session:
-        lang = await DatabaseManager.get_user_language(session, user_id)
+    lang = await DatabaseManager.get_user_language(session, user_id)
     
     # Рассчитываем финальную сумму
     amount_cents = PaymentConfig.calculate_amount(amount)
     final_amount = amount_cents / 100
     
     commission_text = ""
-    if PaymentConfig.COMMISSION_PERCENT > 0:
-        commission = amount * PaymentConfig.COMMISSION_PERCENT / 100
-        commission_text = f"\n💼 Комиссия: ${commission:.2f} ({PaymentConfig.COMMISSION_PERCENT}%)"
+    commission_percent = PaymentConfig.get_commission_percent()
+    if commission_percent > 0:
+        commission = amount * commission_percent / 100
+        commission_text = f"\n💼 Комиссия: ${commission:.2f} ({commission_percent}%)"
     
     text = (
         "💳 <b>Подтверждение оплаты</b>\n\n"
@@ -255,7 +250,7 @@ async def select_payment_amount(callback: CallbackQuery):
             description=f"{PaymentConfig.PAYMENT_DESCRIPTION}\n\nСумма: ${amount}",
             payload=f"deposit_{user_id}_{amount}_{int(datetime.utcnow().timestamp())}",
             provider_token=provider_token,
-            currency=PaymentConfig.CURRENCY,
+            currency=PaymentConfig.get_currency(),
             prices=prices,
             start_parameter="deposit",
             reply_markup=get_payment_confirm_keyboard(final_amount, lang)
@@ -277,7 +272,7 @@ async def select_payment_amount(callback: CallbackQuery):
         )
 
 @router.pre_checkout_query()
-async def pre_checkout_handler(pre_checkout_query: PreCheckoutQuery):
+async def pre_checkout_handler(pre_checkout_query: PreCheckoutQuery, session: AsyncSession):
     """
     Обработка pre-checkout запроса
     Здесь можно проверить доступность товара, корректность данных и т.д.
@@ -304,16 +299,16 @@ async def pre_checkout_handler(pre_checkout_query: PreCheckoutQuery):
                 )
                 return
             
-            # Проверяем лимиты
-            async with async_session_maker() as session:
-                can_proceed, error_message = await DatabaseManager.check_user_rate_limit(session, user_id)
-                
-                if not can_proceed:
-                    await pre_checkout_query.answer(
-                        ok=False,
-                        error_message=f"Превышен лимит: {error_message}"
-                    )
-                    return
+            # Только проверяем лимиты: отклоненная или брошенная оплата их не тратит,
+            # списание - при успешной оплате вместе с созданием заявки
+            decision = await DatabaseManager.check_user_rate_limit(session, user_id)
+            
+            if not decision.allowed:
+                await pre_checkout_query.answer(
+                    ok=False,
+                    error_message=f"Превышен лимит: {decision.message}"
+                )
+                return
         
         # Все проверки пройдены - разрешаем оплату
         await pre_checkout_query.answer(ok=True)
@@ -327,7 +322,7 @@ async def pre_checkout_handler(pre_checkout_query: PreCheckoutQuery):
         )
 
 @router.message(F.successful_payment)
-async def successful_payment_handler(message: Message):
+async def successful_payment_handler(message: Message, session: AsyncSession):
     """
     Обработка успешной оплаты
     Вызывается после того, как платеж прошел успешно
@@ -341,111 +336,125 @@ async def successful_payment_handler(message: Message):
     logger.info(f"Provider payment charge ID: {payment_info.provider_payment_charge_id}")
     logger.info(f"Telegram payment charge ID: {payment_info.telegram_payment_charge_id}")
     
+    # Повторная доставка того же платежа: код уже выдан, второй раз не зачисляем
+    payment_key = f"payment:{payment_info.telegram_payment_charge_id}"
+    if not DatabaseManager.claim_recent_key(session, payment_key):
+        logger.warning(f"Платеж {payment_info.telegram_payment_charge_id} уже обрабатывается, повтор пропущен")
+        return
+    
     try:
+        # Страховка на случай повтора в другом процессе: уникальный ключ в транзакции зачисления
+        if not await DatabaseManager.record_processed_event(session, payment_key):
+            return
+        
         # Парсим payload
         payload_parts = payment_info.invoice_payload.split("_")
         amount = float(payload_parts[2]) if len(payload_parts) >= 3 else 0
         
-        async with async_session_maker() as session:
-            # Создаем заявку с автоматическим одобрением
-            application = await DatabaseManager.create_application(
+        # Создаем заявку с автоматическим одобрением
+        application = await DatabaseManager.create_application(
+            session=session,
+            user_id=user_id,
+            user_name=message.from_user.full_name or message.from_user.username or f"User{user_id}",
+            login=f"payment_{payment_info.telegram_payment_charge_id[:10]}",
+            amount=amount,
+            file_id="payment"  # Специальный маркер для платежей
+        )
+        
+        # Списываем лимиты в транзакции заявки. Деньги уже получены, поэтому
+        # отказ (параллельная оплата прошла проверку раньше) только логируем
+        decision = await DatabaseManager.acquire_rate_limit(session, user_id)
+        if not decision.allowed:
+            logger.warning(f"Оплата пользователя {user_id} сверх лимита ({decision.message}), заявка создается")
+        
+        # Сразу одобряем заявку (оплата уже прошла)
+        code = await DatabaseManager.claim_activation_code(session, amount)
+        
+        if code:
+            await DatabaseManager.update_application_status(
                 session=session,
-                user_id=user_id,
-                user_name=message.from_user.full_name or message.from_user.username or f"User{user_id}",
-                login=f"payment_{payment_info.telegram_payment_charge_id[:10]}",
-                amount=amount,
-                file_id="payment"  # Специальный маркер для платежей
+                application_id=application.id,
+                status="approved",
+                admin_id=0,  # 0 = автоматическое одобрение
+                activation_code_id=code.id,
+                admin_comment=f"Оплачено онлайн. TG Charge ID: {payment_info.telegram_payment_charge_id}"
             )
             
-            # Сразу одобряем заявку (оплата уже прошла)
-            code = await DatabaseManager.get_activation_code(session, amount)
+            # Логируем транзакцию
+            await DatabaseManager.log_transaction(
+                session=session,
+                application_id=application.id,
+                action="approved",
+                admin_id=0,
+                comment=f"Автоматическое одобрение после онлайн-оплаты. Provider ID: {payment_info.provider_payment_charge_id}"
+            )
             
-            if code:
-                await DatabaseManager.update_application_status(
-                    session=session,
-                    application_id=application.id,
-                    status="approved",
-                    admin_id=0,  # 0 = автоматическое одобрение
-                    activation_code_id=code.id,
-                    admin_comment=f"Оплачено онлайн. TG Charge ID: {payment_info.telegram_payment_charge_id}"
-                )
-                
-                await DatabaseManager.mark_code_as_used(session, code.id)
-                
-                # Логируем транзакцию
-                await DatabaseManager.log_transaction(
-                    session=session,
-                    application_id=application.id,
-                    action="approved",
-                    admin_id=0,
-                    comment=f"Автоматическое одобрение после онлайн-оплаты. Provider ID: {payment_info.provider_payment_charge_id}"
-                )
-                
-                # Логируем действие администратора (автоматическое)
-                await DatabaseManager.log_admin_action(
-                    session=session,
-                    admin_id=0,
-                    action="auto_approve_payment",
-                    target_id=application.id,
-                    details=f"Автоодобрение заявки #{application.id} после оплаты ${amount}. Код: {code.code_value}"
-                )
-                
-                # Обновляем лимиты пользователя
-                await DatabaseManager.update_user_rate_limit(session, user_id)
-                
-                lang = await DatabaseManager.get_user_language(session, user_id)
-                
-                # Отправляем пользователю код активации
-                success_text = (
-                    "✅ <b>Оплата прошла успешно!</b>\n\n"
-                    f"💰 Сумма: ${amount}\n"
-                    f"🎟️ <b>Ваш код активации:</b>\n"
-                    f"<code>{code.code_value}</code>\n\n"
-                    f"📋 Заявка #{application.id} автоматически одобрена.\n\n"
-                    "Используйте этот код для активации вашей подписки.\n"
-                    "Спасибо за оплату! 🎉"
-                )
-                
-                await message.answer(
-                    success_text,
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
-                    ])
-                )
-                
-                # Уведомляем админов о платеже
-                await notify_admins_payment(message.bot, application, payment_info)
-                
-            else:
-                # Нет доступных кодов - создаем заявку в ожидании
-                await DatabaseManager.log_transaction(
-                    session=session,
-                    application_id=application.id,
-                    action="created",
-                    comment=f"Оплачено онлайн, но нет кодов. Provider ID: {payment_info.provider_payment_charge_id}"
-                )
-                
-                lang = await DatabaseManager.get_user_language(session, user_id)
-                
-                await message.answer(
-                    "✅ <b>Оплата прошла успешно!</b>\n\n"
-                    f"💰 Сумма: ${amount}\n"
-                    f"📋 Заявка #{application.id} создана.\n\n"
-                    "⏳ Ваша заявка обрабатывается администратором.\n"
-                    "Код активации будет выдан в ближайшее время.\n\n"
-                    "Спасибо за оплату! 🎉",
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
-                    ])
-                )
-                
-                # Уведомляем админов (срочно - нужны коды!)
-                await notify_admins_payment(message.bot, application, payment_info, urgent=True)
+            # Логируем действие администратора (автоматическое)
+            await DatabaseManager.log_admin_action(
+                session=session,
+                admin_id=0,
+                action="auto_approve_payment",
+                target_id=application.id,
+                details=f"Автоодобрение заявки #{application.id} после оплаты ${amount}. Код: {code.code_value}"
+            )
+            
+            lang = await DatabaseManager.get_user_language(session, user_id)
+            
+            # Фиксируем оплату и выдачу кода одним коммитом до уведомлений
+            await session.commit()
+            
+            # Отправляем пользователю код активации
+            success_text = (
+                "✅ <b>Оплата прошла успешно!</b>\n\n"
+                f"💰 Сумма: ${amount}\n"
+                f"🎟️ <b>Ваш код активации:</b>\n"
+                f"<code>{code.code_value}</code>\n\n"
+                f"📋 Заявка #{application.id} автоматически одобрена.\n\n"
+                "Используйте этот код для активации вашей подписки.\n"
+                "Спасибо за оплату! 🎉"
+            )
+            
+            await message.answer(
+                success_text,
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
+                ])
+            )
+            
+            # Уведомляем админов о платеже
+            notify_admins_payment(message.bot, application, payment_info)
+            
+        else:
+            # Нет доступных кодов - создаем заявку в ожидании
+            await DatabaseManager.log_transaction(
+                session=session,
+                application_id=application.id,
+                action="created",
+                comment=f"Оплачено онлайн, но нет кодов. Provider ID: {payment_info.provider_payment_charge_id}"
+            )
+            lang = await DatabaseManager.get_user_language(session, user_id)
+            await session.commit()
+            
+            await message.answer(
+                "✅ <b>Оплата прошла успешно!</b>\n\n"
+                f"💰 Сумма: ${amount}\n"
+                f"📋 Заявка #{application.id} создана.\n\n"
+                "⏳ Ваша заявка обрабатывается администратором.\n"
+                "Код активации будет выдан в ближайшее время.\n\n"
+                "Спасибо за оплату! 🎉",
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🏠 Главное меню", callback_data="back_to_menu")]
+                ])
+            )
+            
+            # Уведомляем админов (срочно - нужны коды!)
+            notify_admins_payment(message.bot, application, payment_info, urgent=True)
         
     except Exception as e:
         logger.error(f"Ошибка обработки успешной оплаты: {e}", exc_info=True)
+        await session.rollback()
         await message.answer(
             "⚠️ <b>Оплата прошла, но возникла ошибка</b>\n\n"
             "Ваш платеж принят, но произошла ошибка при обработке.\n"
@@ -456,8 +465,8 @@ async def successful_payment_handler(message: Message):
         )
 
 
-async def notify_admins_payment(bot, application, payment_info, urgent: bool = False):
-    """Уведомление администраторов о платеже"""
+def notify_admins_payment(bot, application, payment_info, urgent: bool = False):
+    """Уведомление администраторов о платеже (ставится в очередь отправки)"""
     urgent_marker = "🚨 СРОЧНО - НЕТ КОДОВ! " if urgent else ""
     
     text = (
@@ -474,14 +483,11 @@ async def notify_admins_payment(bot, application, payment_info, urgent: bool = F
     )
     
     for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(
-                admin_id,
-                text,
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления админу {admin_id}: {e}")
+        send_queue.submit(
+            bot,
+            SendMessage(chat_id=admin_id, text=text, parse_mode="HTML"),
+            description=f"уведомление об оплате заявки #{application.id} админу {admin_id}"
+        )
 
 
 # ==================== ТЕСТОВЫЙ ПЛАТЕЖ ====================
@@ -512,7 +518,7 @@ async def test_payment(message: Message):
             description="Это тестовый платеж для проверки интеграции",
             payload=f"test_{user_id}_{int(datetime.utcnow().timestamp())}",
             provider_token=PaymentConfig.get_provider_token(),
-            currency=PaymentConfig.CURRENCY,
+            currency=PaymentConfig.get_currency(),
             prices=[LabeledPrice(label="Тест", amount=amount_cents)],
             start_parameter="test"
         )
@@ -0,0 +1,249 @@
+"""
+Очередь исходящих сообщений
+Обработчики ставят отправку в очередь и сразу возвращаются. Очередь соблюдает
+лимиты Telegram корзинами токенов: общий (~30 сообщений/с на бота) и на чат
+(~1/с в личный чат, 20 в минуту в группу). Сообщения одного чата уходят по
+порядку, разные чаты - параллельно. На flood control (retry_after) отправка
+приостанавливается на указанное время, ошибки сети и 5xx повторяются с
+растущей паузой со случайным разбросом.
+При шардировании (SHARD_WORKERS) общий лимит делится между процессами-воркерами;
+лимит чата - нет: все апдейты пользователя обрабатывает один воркер (в чаты
+админов пишут все воркеры; редкое превышение там гасит пауза по retry_after).
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramMigrateToChat, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.methods import TelegramMethod
+from loguru import logger
+
+from cache import TTLCache
+from config import (
+    SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_RATE, SEND_CHAT_BURST,
+    SEND_MAX_ATTEMPTS, SEND_QUEUE_SIZE, SHARD_WORKERS
+)
+
+# Пауза перед повтором после ошибки сети: 0.5, 1, 2, ... с, не больше 30 с (со случайным разбросом)
+RETRY_DELAY_BASE = 0.5
+RETRY_DELAY_MAX = 30
+# Сколько ждать отправки очереди при остановке (с)
+DRAIN_TIMEOUT = 10
+# Доля общего лимита Telegram на процесс
+_PROCESS_SHARE = 1 / SHARD_WORKERS if SHARD_WORKERS > 1 else 1
+
+
+class TokenBucket:
+    """Корзина токенов: rate в секунду, до burst подряд"""
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Дождаться токена и забрать его"""
+        while True:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendJob:
+    """Отправка: метод Telegram API и запасной метод на случай его ошибки"""
+    __slots__ = ("bot", "method", "fallback", "description")
+
+    def __init__(self, bot: Bot, method: TelegramMethod, fallback: Optional[TelegramMethod], description: str):
+        self.bot = bot
+        self.method = method
+        self.fallback = fallback
+        self.description = description
+
+
+class SendQueue:
+    """
+    Очередь отправки: у каждого чата своя очередь и своя задача, которая
+    существует, пока в очереди есть сообщения. Не потокобезопасна: рассчитана
+    на один event loop
+    """
+
+    def __init__(
+        self,
+        global_rate: float = SEND_GLOBAL_RATE * _PROCESS_SHARE,
+        chat_rate: float = SEND_CHAT_RATE,
+        group_rate: float = SEND_GROUP_RATE,
+        chat_burst: int = SEND_CHAT_BURST,
+        max_attempts: int = SEND_MAX_ATTEMPTS,
+        max_size: int = SEND_QUEUE_SIZE
+    ):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.max_size = max_size
+        self.chats: Dict[int, Deque[SendJob]] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+        # Корзины чатов переживают паузы между сообщениями (за минуту корзина полностью наполняется)
+        self.chat_buckets = TTLCache(maxsize=100000, ttl=60)
+        self.paused_until = 0.0
+        self.size = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+        self.flood_waits = 0
+
+    def submit(
+        self,
+        bot: Bot,
+        method: TelegramMethod,
+        fallback: Optional[TelegramMethod] = None,
+        description: str = ""
+    ) -> bool:
+        """
+        Поставить отправку в очередь чата method.chat_id (не ждет отправки).
+        fallback отправляется, если method завершился ошибкой без повторов
+        (например, документ не отправился - отправить как фото).
+        False - очередь заполнена, сообщение отброшено
+        """
+        if self.size >= self.max_size:
+            self.dropped += 1
+            logger.error(f"Очередь отправки заполнена ({self.max_size}), отброшено: {description or type(method).__name__}")
+            return False
+
+        chat_id = method.chat_id
+        self.chats.setdefault(chat_id, deque()).append(SendJob(bot, method, fallback, description))
+        self.size += 1
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self._run_chat(chat_id))
+        return True
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id, None)
+        if bucket is None:
+            # Отрицательный id - группа или канал
+            bucket = TokenBucket(self.chat_rate if chat_id > 0 else self.group_rate, self.chat_burst)
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _run_chat(self, chat_id: int) -> None:
+        jobs = self.chats[chat_id]
+        try:
+            while jobs:
+                await self._deliver(jobs[0], chat_id)
+                jobs.popleft()
+                self.size -= 1
+        finally:
+            self.size -= len(jobs)
+            del self.chats[chat_id]
+            del self.tasks[chat_id]
+
+    async def _wait_pause(self) -> None:
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, job: SendJob, chat_id: int) -> None:
+        """Отправить с повторами; ошибки логируются, наружу не выходят"""
+        method, fallback = job.method, job.fallback
+        attempt = 0
+        while True:
+            await self._wait_pause()
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                await job.bot(method)
+                self.sent += 1
+                if job.description:
+                    logger.info(f"Отправлено: {job.description}")
+                return
+            except TelegramRetryAfter as e:
+                # Flood control касается бота: пауза для всех чатов, попытка не расходуется
+                self.flood_waits += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logger.warning(f"Flood control в чате {chat_id}: отправка приостановлена на {e.retry_after} с")
+            except TelegramMigrateToChat as e:
+                method = method.model_copy(update={"chat_id": e.migrate_to_chat_id})
+                if fallback is not None:
+                    fallback = fallback.model_copy(update={"chat_id": e.migrate_to_chat_id})
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"Не отправлено после {attempt} попыток ({job.description or chat_id}): {e}")
+                    return
+                self.retries += 1
+                delay = min(RETRY_DELAY_BASE * 2 ** (attempt - 1), RETRY_DELAY_MAX)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            except Exception as e:
+                if fallback is not None:
+                    logger.warning(f"Ошибка отправки ({job.description or chat_id}): {e}, пробуем запасной вариант")
+                    method, fallback = fallback, None
+                    continue
+                self.failed += 1
+                logger.error(f"Ошибка отправки ({job.description or chat_id}): {e}")
+                return
+
+    async def join(self) -> None:
+        """Дождаться отправки всего, что уже в очереди"""
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        """Дослать очередь (не дольше timeout), остальное отменить"""
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено при остановке: {self.size} сообщений")
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+
+    def stats(self) -> dict:
+        """Счетчики очереди"""
+        return {
+            "queued": self.size,
+            "chats": len(self.chats),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retries,
+            "flood_waits": self.flood_waits
+        }
+
+    def prometheus_lines(self) -> List[str]:
+        """Метрики очереди для /metrics"""
+        lines = [
+            "# HELP bot_send_queued Сообщения в очереди отправки",
+            "# TYPE bot_send_queued gauge",
+            f"bot_send_queued {self.size}",
+        ]
+        for name, help_text, value in (
+            ("bot_send_sent_total", "Отправленные сообщения", self.sent),
+            ("bot_send_failed_total", "Сообщения, не отправленные после повторов", self.failed),
+            ("bot_send_dropped_total", "Сообщения, отброшенные при заполненной очереди", self.dropped),
+            ("bot_send_retries_total", "Повторы после ошибок сети и 5xx", self.retries),
+            ("bot_send_flood_waits_total", "Паузы по flood control (retry_after)", self.flood_waits),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+        return lines
+
+
+# Очередь отправки процесса
+send_queue = SendQueue()
@@ -0,0 +1,543 @@
+"""
+Горизонтальное масштабирование: фронт-процесс и N процессов-воркеров
+Фронт получает апдейты (polling или webhook) и передает каждый воркеру,
+выбранному по консистентному хешу from_user.id: все апдейты пользователя
+обрабатывает один процесс, строго по порядку, и его кэши и лимитер остаются
+локальными. Платежи (pre_checkout_query, successful_payment) обрабатываются
+вне очереди, а пока воркер пользователя перезапускается - соседним воркером.
+Фронт перезапускает упавшие и зависшие воркеры; апдейты, получение которых
+воркер не подтвердил, передаются ему заново после перезапуска.
+Фронт и воркеры связаны TCP-соединениями на 127.0.0.1 (JSON, строка на сообщение).
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import signal
+import time
+from bisect import bisect
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, List, Optional
+
+from aiogram import Bot, Dispatcher
+from loguru import logger
+
+from config import (
+    DATABASE_URL, METRICS_PORT, WEBHOOK_HOST, SHARD_WORKERS, SHARD_LANES, SHARD_FAST_LANES,
+    SHARD_QUEUE_SIZE, SHARD_INDEX, SHARD_FRONT_PORT, SHARD_TOKEN
+)
+from metrics import metrics
+from webhook import stop_event_on_signals
+
+# Точек кольца на воркер (чем больше, тем равномернее распределение пользователей)
+RING_VNODES = 160
+# Воркер присылает ping раз в HEARTBEAT_INTERVAL; без сообщений дольше HEARTBEAT_TIMEOUT - перезапуск
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 60
+# Сколько ждать подключения запущенного воркера (с)
+CONNECT_TIMEOUT = 60
+# Пауза перед перезапуском упавшего воркера растет от 1 до 30 с
+# и сбрасывается, если воркер проработал дольше STABLE_AFTER
+RESTART_DELAY_MIN = 1
+RESTART_DELAY_MAX = 30
+STABLE_AFTER = 60
+# Сколько ждать обработки очередей при остановке (с)
+DRAIN_TIMEOUT = 10
+# Сколько ждать выхода воркеров после закрытия соединений (с)
+EXIT_TIMEOUT = 10
+# Long polling: сколько Telegram держит запрос getUpdates без апдейтов (с);
+# пауза после ошибки растет от 1 до 30 с и сбрасывается после успешного запроса
+POLLING_TIMEOUT = 10
+POLLING_DELAY_MIN = 1
+POLLING_DELAY_MAX = 30
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def update_user_id(update: dict) -> int:
+    """Пользователь апдейта (from.id), иначе чат, иначе сам update_id"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        if value.get("chat"):
+            return value["chat"]["id"]
+    return update["update_id"]
+
+
+def is_fast_lane(update: dict) -> bool:
+    """Платеж: ответ на pre_checkout_query Telegram ждет не дольше 10 секунд"""
+    return "pre_checkout_query" in update or "successful_payment" in (update.get("message") or {})
+
+
+class HashRing:
+    """
+    Консистентный хеш пользователей на воркеры: при изменении числа воркеров
+    меняет воркер только часть пользователей
+    """
+
+    def __init__(self, nodes: int, vnodes: int = RING_VNODES):
+        points = sorted((_hash(f"{node}:{vnode}"), node) for node in range(nodes) for vnode in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key: int, available: Optional[Callable[[int], bool]] = None) -> int:
+        """
+        Воркер для ключа. С available - первый доступный по кольцу
+        (если доступных нет - основной)
+        """
+        start = bisect(self.points, _hash(str(key))) % len(self.points)
+        if available is not None:
+            for step in range(len(self.nodes)):
+                node = self.nodes[(start + step) % len(self.nodes)]
+                if available(node):
+                    return node
+        return self.nodes[start]
+
+
+class Shard:
+    """Состояние одного воркера во фронт-процессе"""
+
+    def __init__(self, index: int, queue_size: int):
+        self.index = index
+        # Ожидают отправки: платежи отдельно, они уходят первыми
+        self.pending: deque = deque()
+        self.fast: deque = deque()
+        # Отправлены, но не подтверждены: update_id -> (апдейт, платеж ли)
+        self.inflight: "OrderedDict[int, tuple]" = OrderedDict()
+        # Обычных апдейтов в очереди и в обработке не больше queue_size
+        self.slots = asyncio.Semaphore(queue_size)
+        self.has_items = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        self.disconnected.set()
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.started_at = 0.0
+        self.last_seen = 0.0
+        self.restarts = 0
+        self.processed = 0
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    @property
+    def backlog(self) -> int:
+        return len(self.pending) + len(self.fast) + len(self.inflight)
+
+    def put(self, update: dict, fast: bool) -> None:
+        (self.fast if fast else self.pending).append(update)
+        self.has_items.set()
+
+    def requeue(self) -> int:
+        """Неподтвержденные апдейты - снова в начало очередей, в прежнем порядке"""
+        for update, fast in reversed(self.inflight.values()):
+            (self.fast if fast else self.pending).appendleft(update)
+        count = len(self.inflight)
+        self.inflight.clear()
+        if count:
+            self.has_items.set()
+        return count
+
+
+class ShardSupervisor:
+    """
+    Фронт: распределение апдейтов по воркерам, запуск и перезапуск их процессов.
+    command - команда запуска воркера; номер воркера, порт и токен фронта
+    передаются в переменных окружения SHARD_INDEX, SHARD_FRONT_PORT, SHARD_TOKEN
+    """
+
+    def __init__(self, command: List[str], workers: int = SHARD_WORKERS, queue_size: int = SHARD_QUEUE_SIZE):
+        self.command = command
+        self.shards = [Shard(index, queue_size) for index in range(workers)]
+        self.ring = HashRing(workers)
+        self.token = secrets.token_urlsafe(16)
+        self.port = 0
+        self.rerouted = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._tasks = []
+        self._stopping = False
+
+    async def start(self, host: str = "127.0.0.1") -> None:
+        self._server = await asyncio.start_server(self._on_connect, host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._tasks = [asyncio.create_task(self._supervise(shard)) for shard in self.shards]
+        logger.info(f"Шардирование: {len(self.shards)} воркеров, фронт на {host}:{self.port}")
+
+    async def dispatch(self, update: dict) -> None:
+        """
+        Передать апдейт воркеру пользователя. Ждет, если у воркера заполнена очередь;
+        платеж при отключенном воркере уходит следующему по кольцу
+        """
+        user_id = update_user_id(update)
+        index = self.ring.node(user_id)
+        if is_fast_lane(update):
+            available = self.ring.node(user_id, lambda node: self.shards[node].connected)
+            if available != index:
+                self.rerouted += 1
+            self.shards[available].put(update, True)
+            return
+
+        shard = self.shards[index]
+        await shard.slots.acquire()
+        shard.put(update, False)
+
+    def _ack(self, shard: Shard, update_id: int) -> None:
+        entry = shard.inflight.pop(update_id, None)
+        if entry is None:
+            return
+        shard.processed += 1
+        if not entry[1]:
+            shard.slots.release()
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Соединение от воркера: приветствие с номером и токеном, затем подтверждения"""
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), CONNECT_TIMEOUT))
+            shard = self.shards[hello["worker"]]
+            if not hmac.compare_digest(str(hello.get("token", "")), self.token):
+                raise ValueError("неверный токен")
+        except (asyncio.TimeoutError, ValueError, KeyError, IndexError, TypeError) as e:
+            logger.warning(f"Отклонено подключение к фронту: {e}")
+            writer.close()
+            return
+
+        shard.writer = writer
+        shard.last_seen = time.monotonic()
+        shard.disconnected.clear()
+        logger.info(f"Воркер {shard.index} подключен (pid {hello.get('pid')})")
+        sender = asyncio.create_task(self._send(shard, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                shard.last_seen = time.monotonic()
+                message = json.loads(line)
+                if "done" in message:
+                    self._ack(shard, message["done"])
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Соединение с воркером {shard.index} прервано: {e}")
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+            shard.writer = None
+            requeued = shard.requeue()
+            if requeued:
+                logger.warning(f"Воркер {shard.index} отключился, {requeued} апдейтов будут переданы заново")
+            writer.close()
+            shard.disconnected.set()
+
+    @staticmethod
+    async def _send(shard: Shard, writer: asyncio.StreamWriter) -> None:
+        while True:
+            await shard.has_items.wait()
+            shard.has_items.clear()
+            while shard.fast or shard.pending:
+                fast = bool(shard.fast)
+                update = (shard.fast if fast else shard.pending).popleft()
+                shard.inflight[update["update_id"]] = (update, fast)
+                writer.write(json.dumps(update, ensure_ascii=False).encode() + b"\n")
+            await writer.drain()
+
+    def _worker_env(self, shard: Shard) -> dict:
+        env = dict(os.environ)
+        env.update(
+            SHARD_INDEX=str(shard.index),
+            SHARD_FRONT_PORT=str(self.port),
+            SHARD_TOKEN=self.token,
+            # Метрики воркеров - на следующих портах после фронта
+            METRICS_PORT=str(METRICS_PORT + 1 + shard.index if METRICS_PORT else 0)
+        )
+        return env
+
+    async def _supervise(self, shard: Shard) -> None:
+        """Запуск воркера и перезапуск после падения или зависания"""
+        delay = RESTART_DELAY_MIN
+        while not self._stopping:
+            try:
+                shard.process = await asyncio.create_subprocess_exec(*self.command, env=self._worker_env(shard))
+            except OSError as e:
+                logger.error(f"Не удалось запустить воркер {shard.index}: {e}")
+                reason = "не запустился"
+            else:
+                shard.started_at = time.monotonic()
+                logger.info(f"Воркер {shard.index} запущен (pid {shard.process.pid})")
+                reason = await self._watch(shard)
+                if self._stopping:
+                    return
+                if time.monotonic() - shard.started_at >= STABLE_AFTER:
+                    delay = RESTART_DELAY_MIN
+
+            shard.restarts += 1
+            logger.error(f"Воркер {shard.index} {reason}, перезапуск через {delay} с")
+            # Неподтвержденные апдейты возвращаются в очередь до запуска нового процесса
+            if shard.writer is not None:
+                shard.writer.close()
+            await shard.disconnected.wait()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+
+    async def _watch(self, shard: Shard) -> str:
+        """Ждать выхода процесса; зависший или не подключившийся воркер завершается"""
+        process = shard.process
+        while True:
+            try:
+                code = await asyncio.wait_for(process.wait(), HEARTBEAT_INTERVAL)
+                return f"завершился с кодом {code}"
+            except asyncio.TimeoutError:
+                pass
+            if self._stopping:
+                continue
+
+            now = time.monotonic()
+            if shard.connected and now - shard.last_seen > HEARTBEAT_TIMEOUT:
+                reason = f"не отвечает {now - shard.last_seen:.0f} с"
+            elif not shard.connected and now - shard.started_at > CONNECT_TIMEOUT:
+                reason = "не подключился к фронту"
+            else:
+                continue
+
+            logger.error(f"Воркер {shard.index} {reason}, процесс завершается")
+            process.kill()
+            await process.wait()
+            return reason
+
+    async def wait_connected(self, timeout: float = CONNECT_TIMEOUT) -> bool:
+        """Дождаться подключения всех воркеров"""
+        deadline = time.monotonic() + timeout
+        while not all(shard.connected for shard in self.shards):
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def wait_drained(self) -> None:
+        """Дождаться обработки всех переданных апдейтов"""
+        while any(shard.backlog for shard in self.shards):
+            await asyncio.sleep(0.01)
+
+    async def stop(self) -> None:
+        """Дообработать очереди, закрыть соединения (воркеры завершатся сами) и дождаться выхода"""
+        try:
+            await asyncio.wait_for(self.wait_drained(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {sum(shard.backlog for shard in self.shards)} апдейтов")
+
+        self._stopping = True
+        if self._server is not None:
+            self._server.close()
+        for shard in self.shards:
+            if shard.writer is not None:
+                shard.writer.close()
+
+        processes = [shard.process for shard in self.shards if shard.process and shard.process.returncode is None]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in processes)), EXIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    logger.warning(f"Воркер (pid {process.pid}) не завершился, процесс убит")
+                    process.kill()
+                    await process.wait()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info(f"Шардирование остановлено: {self.stats()}")
+
+    def stats(self) -> dict:
+        """Очереди, обработанные апдейты и перезапуски по воркерам"""
+        return {
+            "shards": [
+                {
+                    "worker": shard.index,
+                    "pid": shard.process.pid if shard.process else None,
+                    "connected": shard.connected,
+                    "queued": len(shard.pending) + len(shard.fast),
+                    "in_flight": len(shard.inflight),
+                    "processed": shard.processed,
+                    "restarts": shard.restarts
+                }
+                for shard in self.shards
+            ],
+            "payments_rerouted": self.rerouted
+        }
+
+    def prometheus_lines(self) -> List[str]:
+        """Метрики воркеров для /metrics фронта"""
+        lines = []
+        for name, kind, help_text, value in (
+            ("bot_shard_connected", "gauge", "Воркер подключен к фронту", lambda s: int(s.connected)),
+            ("bot_shard_queued", "gauge", "Апдейты, ожидающие отправки воркеру", lambda s: len(s.pending) + len(s.fast)),
+            ("bot_shard_in_flight", "gauge", "Апдейты, отправленные воркеру и не подтвержденные", lambda s: len(s.inflight)),
+            ("bot_shard_processed_total", "counter", "Апдейты, обработанные воркером", lambda s: s.processed),
+            ("bot_shard_restarts_total", "counter", "Перезапуски воркера", lambda s: s.restarts),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines += [f'{name}{{worker="{shard.index}"}} {value(shard)}' for shard in self.shards]
+        return lines
+
+
+class ShardWorker:
+    """
+    Процесс-воркер: апдейты от фронта обрабатываются в dp.
+    Апдейты одного пользователя идут в одну из lanes очередей и обрабатываются
+    по одному; платежи - в отдельной очереди с fast_lanes обработчиками
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        dp: Dispatcher,
+        index: int,
+        lanes: int = SHARD_LANES,
+        fast_lanes: int = SHARD_FAST_LANES
+    ):
+        self.bot = bot
+        self.dp = dp
+        self.index = index
+        self.lanes = [asyncio.Queue() for _ in range(lanes)]
+        self.fast = asyncio.Queue()
+        self.fast_lanes = fast_lanes
+        self.processed = 0
+        self.failed = 0
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    def _send(self, message: dict) -> None:
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(json.dumps(message).encode() + b"\n")
+
+    async def run(self, port: int, token: str, host: str = "127.0.0.1") -> None:
+        """Работать до закрытия соединения фронтом или SIGTERM, затем дообработать очереди"""
+        reader, self._writer = await asyncio.open_connection(host, port)
+        self._send({"worker": self.index, "token": token, "pid": os.getpid()})
+
+        tasks = [asyncio.create_task(self._lane(queue)) for queue in self.lanes]
+        tasks += [asyncio.create_task(self._lane(self.fast)) for _ in range(self.fast_lanes)]
+        tasks.append(asyncio.create_task(self._heartbeat()))
+
+        # Ctrl+C в терминале получает вся группа процессов: воркер останавливает фронт
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        stop_event = stop_event_on_signals(signal.SIGTERM)
+        receiver = asyncio.create_task(self._receive(reader))
+        stopper = asyncio.create_task(stop_event.wait())
+        try:
+            await asyncio.wait({receiver, stopper}, return_when=asyncio.FIRST_COMPLETED)
+            receiver.cancel()
+            stopper.cancel()
+            try:
+                await asyncio.wait_for(self._drain(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Воркер {self.index}: не дождались обработки очередей")
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._writer.close()
+        logger.info(f"Воркер {self.index} остановлен: обработано {self.processed}, ошибок {self.failed}")
+
+    async def _receive(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            update = json.loads(line)
+            if is_fast_lane(update):
+                self.fast.put_nowait(update)
+            else:
+                self.lanes[update_user_id(update) % len(self.lanes)].put_nowait(update)
+
+    async def _lane(self, queue: asyncio.Queue) -> None:
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+            finally:
+                # Подтверждение и после ошибки: повтор того же апдейта не поможет
+                self._send({"done": update["update_id"]})
+                queue.task_done()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            self._send({"ping": time.time()})
+
+    async def _drain(self) -> None:
+        for queue in self.lanes + [self.fast]:
+            await queue.join()
+
+
+async def poll_updates(bot: Bot, dp: Dispatcher, handler: Callable[[dict], Awaitable]) -> None:
+    """Получать апдейты через getUpdates и передавать их handler до сигнала остановки"""
+    stop_event = stop_event_on_signals()
+    allowed_updates = dp.resolve_used_update_types()
+
+    async def listen():
+        offset = None
+        delay = POLLING_DELAY_MIN
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset,
+                    timeout=POLLING_TIMEOUT,
+                    allowed_updates=allowed_updates,
+                    request_timeout=POLLING_TIMEOUT + 10
+                )
+            except Exception as e:
+                logger.error(f"Ошибка getUpdates: {e}, повтор через {delay} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, POLLING_DELAY_MAX)
+                continue
+            delay = POLLING_DELAY_MIN
+            for update in updates:
+                await handler(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                # Следующий запрос подтверждает Telegram получение этого апдейта
+                offset = update.update_id + 1
+
+    listener = asyncio.create_task(listen())
+    stopper = asyncio.create_task(stop_event.wait())
+    await asyncio.wait({listener, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    stopper.cancel()
+    if listener.done():
+        # Чтение апдейтов завершилось само - только с ошибкой обработчика
+        listener.result()
+    listener.cancel()
+    await asyncio.gather(listener, return_exceptions=True)
+
+
+async def run_front(bot: Bot, dp: Dispatcher, command: List[str], workers: int = SHARD_WORKERS) -> None:
+    """Фронт-процесс: запустить воркеры и распределять им апдейты до сигнала остановки"""
+    if DATABASE_URL.startswith("sqlite"):
+        logger.warning("Несколько процессов пишут в один файл SQLite - для шардирования рекомендуется PostgreSQL")
+
+    supervisor = ShardSupervisor(command, workers)
+    await supervisor.start()
+    metrics.add_collector(supervisor.prometheus_lines)
+    try:
+        if WEBHOOK_HOST:
+            from webhook import run_webhook
+            # Один обработчик очереди webhook: воркеры получают апдейты в порядке поступления
+            await run_webhook(bot, dp, handler=supervisor.dispatch, workers=1, status=supervisor.stats)
+        else:
+            # getUpdates не работает, пока зарегистрирован webhook
+            await bot.delete_webhook()
+            await poll_updates(bot, dp, supervisor.dispatch)
+    finally:
+        await supervisor.stop()
+
+
+async def run_worker(bot: Bot, dp: Dispatcher) -> None:
+    """Процесс-воркер (SHARD_INDEX задан фронтом): обработка апдейтов от фронта"""
+    await ShardWorker(bot, dp, SHARD_INDEX).run(SHARD_FRONT_PORT, SHARD_TOKEN)
@@ -0,0 +1,207 @@
+"""
+Режим webhook: aiohttp-сервер вместо long polling
+Апдейт от Telegram проверяется по секретному токену, ставится в ограниченную
+очередь и сразу получает ответ 200; обрабатывают его фоновые воркеры.
+Если очередь заполнена - ответ 503, и Telegram повторит доставку позже
+(повторы отсекает IdempotencyMiddleware).
+Кроме webhook сервер отдает /status и /health.
+При шардировании (SHARD_WORKERS) сервер работает во фронт-процессе и только
+передает апдейты воркерам.
+"""
+import asyncio
+import hmac
+import secrets
+import signal
+import time
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from loguru import logger
+from sqlalchemy import text
+
+from config import (
+    WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_LISTEN_HOST, WEBHOOK_SECRET,
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_MAX_CONNECTIONS
+)
+from database import async_session_maker
+
+# Заголовок с секретом, который Telegram передает в каждом запросе webhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Сколько ждать обработки очереди при остановке (с)
+DRAIN_TIMEOUT = 10
+# Таймаут проверки базы в /health (с)
+HEALTH_DB_TIMEOUT = 2
+
+
+class WebhookServer:
+    """
+    Прием апдейтов по HTTP и их обработка пулом из workers задач.
+    Очередь ограничена queue_size: при переполнении запрос отклоняется,
+    а не копится в памяти.
+    handler - обработка апдейта (по умолчанию dp.feed_raw_update),
+    status - дополнительные поля для /status.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        dp: Dispatcher,
+        secret: str,
+        path: str = WEBHOOK_PATH,
+        workers: int = WEBHOOK_WORKERS,
+        queue_size: int = WEBHOOK_QUEUE_SIZE,
+        handler: Optional[Callable[[dict], Awaitable]] = None,
+        status: Optional[Callable[[], dict]] = None
+    ):
+        self.bot = bot
+        self.dp = dp
+        self.handler = handler or (lambda update: dp.feed_raw_update(bot, update))
+        self.status = status
+        self.secret = secret
+        self.path = path
+        self.workers = workers
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+        self._runner: Optional[web.AppRunner] = None
+        self.started_at = time.time()
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.unauthorized = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/status", self.handle_status)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Апдейт от Telegram: проверка секрета, в очередь, сразу 200"""
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.unauthorized += 1
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"Очередь webhook заполнена ({self.queue.maxsize}), апдейт отклонен")
+            return web.Response(status=503, headers={"Retry-After": "1"})
+
+        self.received += 1
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.handler(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> dict:
+        """Счетчики сервера"""
+        stats = {
+            "mode": "webhook",
+            "uptime_seconds": int(time.time() - self.started_at),
+            "workers": self.workers,
+            "queued": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "unauthorized": self.unauthorized
+        }
+        if self.status is not None:
+            stats.update(self.status())
+        return stats
+
+    async def handle_status(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "running", **self.stats()})
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """Живость процесса и доступность базы (503 - база недоступна)"""
+        try:
+            async with async_session_maker() as session:
+                await asyncio.wait_for(session.execute(text("SELECT 1")), HEALTH_DB_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Проверка здоровья: база недоступна: {e!r}")
+            return web.json_response({"status": "error", "database": "unavailable"}, status=503)
+        return web.json_response({"status": "ok", "queued": self.queue.qsize()})
+
+    async def start(self, host: str = WEBHOOK_LISTEN_HOST, port: int = WEBHOOK_PORT) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Webhook сервер: http://{host}:{port}{self.path}, воркеров {self.workers}")
+
+    async def stop(self) -> None:
+        """Перестать принимать запросы, дообработать очередь и остановить воркеры"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+        try:
+            await asyncio.wait_for(self.queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {self.queue.qsize()} апдейтов из очереди")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info(f"Webhook сервер остановлен: {self.stats()}")
+
+
+def stop_event_on_signals(*signals: int) -> asyncio.Event:
+    """Событие, которое устанавливается по SIGINT/SIGTERM (или переданным сигналам)"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in signals or (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка через KeyboardInterrupt
+            pass
+    return stop_event
+
+
+async def run_webhook(
+    bot: Bot,
+    dp: Dispatcher,
+    handler: Optional[Callable[[dict], Awaitable]] = None,
+    workers: int = WEBHOOK_WORKERS,
+    status: Optional[Callable[[], dict]] = None
+) -> None:
+    """
+    Запустить сервер, зарегистрировать webhook в Telegram и работать до сигнала остановки.
+    Webhook при остановке не удаляется: апдейты ждут у Telegram до перезапуска
+    """
+    # Без заданного секрета - случайный на каждый запуск (webhook регистрируется заново)
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(bot, dp, secret, workers=workers, handler=handler, status=status)
+    await server.start()
+
+    stop_event = stop_event_on_signals()
+
+    try:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_HOST.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS
+        )
+        logger.info(f"Webhook зарегистрирован: {WEBHOOK_HOST.rstrip('/')}{WEBHOOK_PATH}")
+        await stop_event.wait()
+    finally:
+        await server.stop()